@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Benchmark bulk normalisation and sorting of version strings.
+
+This generates a list of katversion-style version strings (releases,
+development versions and unknown versions, with a sprinkling of foreign
+PEP 440 strings) and compares calling `normalised` in a loop and sorting
+with `Version.parse` against `normalise_many` and `sort_versions`, with a
+cold and a warm parse cache, e.g.
+
+    $ python benchmarks/bench_normalise.py --versions 50000
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+# Benchmark the katversion in this source tree, not some installed version
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import katversion.version as kv  # noqa: E402
+
+
+def make_versions(number, foreign_fraction, seed=1):
+    """Generate `number` version strings, some of them in foreign formats."""
+    rnd = random.Random(seed)
+    branches = ['master', 'new.shiny.feature', 'user.fix.123', 'release.2']
+    versions = []
+    for _ in range(number):
+        major, minor = rnd.randint(0, 5), rnd.randint(0, 30)
+        kind = rnd.random()
+        if kind < foreign_fraction:
+            versions.append('v%d.%dRC%d' % (major, minor, rnd.randint(1, 3)))
+        elif kind < 0.2:
+            versions.append('%d.%d' % (major, minor))
+        elif kind < 0.25:
+            versions.append('0.0+unknown.git.2020%08d' % rnd.randint(0, 1e8))
+        else:
+            versions.append('%d.%d.dev%d+%s.g%07x' % (
+                major, minor, rnd.randint(1, 500), rnd.choice(branches),
+                rnd.randint(0, 0xfffffff)))
+    return versions
+
+
+def timed(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def run(args):
+    versions = make_versions(args.versions, args.foreign)
+
+    def cold(func):
+        def run_cold():
+            kv._parsed_versions.clear()
+            func()
+        return run_cold
+    loop = lambda: [kv.normalised(v) for v in versions]  # noqa: E731
+    many = lambda: kv.normalise_many(versions)  # noqa: E731
+    sort_loop = lambda: sorted(versions, key=kv.Version.parse)  # noqa: E731
+    sort_many = lambda: kv.sort_versions(versions)  # noqa: E731
+    results = {
+        'versions': args.versions, 'foreign_fraction': args.foreign,
+        'normalised_loop': timed(loop, args.repeats),
+        'normalise_many_cold': timed(cold(many), args.repeats),
+        'normalise_many_warm': timed(many, args.repeats),
+        'sorted_by_version_parse': timed(sort_loop, args.repeats),
+        'sort_versions_cold': timed(cold(sort_many), args.repeats),
+        'sort_versions_warm': timed(sort_many, args.repeats),
+    }
+    for name in ('normalise_many_cold', 'normalise_many_warm'):
+        results[name + '_speedup'] = (results['normalised_loop'] /
+                                      max(results[name], 1e-9))
+    for name in ('sort_versions_cold', 'sort_versions_warm'):
+        results[name + '_speedup'] = (results['sorted_by_version_parse'] /
+                                      max(results[name], 1e-9))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--versions', type=int, default=20000,
+                        help='Number of version strings (default 20000)')
+    parser.add_argument('--foreign', type=float, default=0.05,
+                        help='Fraction of non-katversion strings (default 0.05)')
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help='Number of timed runs per measurement')
+    json.dump(run(parser.parse_args()), sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write('\n')
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Benchmark katversion on synthetic git repositories of varying scale.
+
+Each scenario builds a throwaway repository with `git fast-import`, with a
+controlled number of commits, version tags, other tags and tracked files,
+and optionally a modified file. The benchmark then measures wall time, the
+number of subprocesses started and the peak Python memory allocation of
+`get_version`, `get_version_list` and `build_info`, with cold and warm caches
+and for each git backend, as well as the time taken by `import katversion`.
+
+The results are written as JSON so that releases can be compared, e.g.
+
+    $ python benchmarks/bench_version.py --commits 1,1000,100000 -o new.json
+    $ python benchmarks/bench_version.py --compare old.json new.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Benchmark the katversion in this source tree, not some installed version
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import katversion  # noqa: E402
+import katversion.version as kv  # noqa: E402
+from katversion import cache, gitbatch  # noqa: E402
+
+GIT_ENV = {'GIT_AUTHOR_NAME': 'Bench', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+           'GIT_COMMITTER_NAME': 'Bench',
+           'GIT_COMMITTER_EMAIL': 'bench@example.com'}
+FUNCTIONS = {
+    'get_version': lambda path: kv.get_version(path),
+    'get_version_list': lambda path: kv.get_version_list(path),
+    'build_info': lambda path: kv.build_info('bench', path),
+}
+
+
+def build_repo(path, commits, tag_every, junk_tags_every, files, dirty):
+    """Create git repository in `path` with synthetic history."""
+    env = dict(os.environ, **GIT_ENV)
+    subprocess.check_call(['git', 'init', '-q', path], env=env)
+    stream = []
+    for n in range(1, commits + 1):
+        stream.append('commit refs/heads/master\nmark :%d\n'
+                      'committer Bench <bench@example.com> %d +0000\n'
+                      'data 9\ncommit %d\n' % (n, 1500000000 + n, n % 10))
+        if n > 1:
+            stream.append('from :%d\n' % (n - 1,))
+        # First commit adds all files, the rest each modify one file
+        for f in (range(files) if n == 1 else [n % files]):
+            data = 'file %d changed in commit %d\n' % (f, n)
+            stream.append('M 644 inline file%05d.txt\ndata %d\n%s\n'
+                          % (f, len(data), data))
+        if tag_every and n % tag_every == 0:
+            stream.append('reset refs/tags/v%d.%d\nfrom :%d\n\n'
+                          % (n // tag_every // 10, n // tag_every % 10, n))
+        if junk_tags_every and n % junk_tags_every == 0:
+            stream.append('reset refs/tags/build-%d\nfrom :%d\n\n' % (n, n))
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                            env=env, stdin=subprocess.PIPE)
+    proc.communicate(''.join(stream).encode('ascii'))
+    subprocess.check_call(['git', 'checkout', '-q', '-f', 'master'],
+                          cwd=path, env=env)
+    subprocess.check_call(['git', 'gc', '-q'], cwd=path, env=env)
+    if dirty:
+        with open(os.path.join(path, 'file00000.txt'), 'a') as f:
+            f.write('dirty\n')
+
+
+class PopenCounter(object):
+    """Count the processes started by katversion via subprocess.Popen."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        # Modules that did "from subprocess import Popen" need patching too
+        self._originals = (subprocess.Popen, kv.Popen, gitbatch.Popen)
+        original = subprocess.Popen
+
+        def counting_popen(*args, **kwargs):
+            self.count += 1
+            return original(*args, **kwargs)
+        subprocess.Popen = kv.Popen = gitbatch.Popen = counting_popen
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen, kv.Popen, gitbatch.Popen = self._originals
+
+
+def reset_caches(path):
+    """Forget everything katversion remembers about repository at `path`."""
+    kv.clear_cache()
+    gitbatch.close_sessions()
+    for filename in (cache.CACHE_FILENAME, cache.COUNTS_FILENAME,
+                     cache.SHARED_FILENAME):
+        try:
+            os.remove(os.path.join(path, '.git', filename))
+        except OSError:
+            pass
+
+
+def measure(func, path, repeats, warm):
+    """Time `func(path)` and count its subprocesses and memory use."""
+    times = []
+    processes = peak = 0
+    for n in range(repeats + (1 if warm else 0)):
+        if not warm:
+            reset_caches(path)
+        if tracemalloc:
+            tracemalloc.start()
+        with PopenCounter() as counter:
+            start = time.time()
+            func(path)
+            elapsed = time.time() - start
+        if tracemalloc:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        # The first call of a warm run only fills the caches
+        if warm and n == 0:
+            continue
+        times.append(elapsed)
+        processes = max(processes, counter.count)
+    times.sort()
+    return {'wall_median': times[len(times) // 2], 'wall_min': times[0],
+            'subprocesses': processes, 'peak_python_kb': peak // 1024}
+
+
+def measure_import(repeats):
+    """Time `import katversion` in a fresh interpreter."""
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=top)
+    times = []
+    for n in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'import katversion'],
+                              env=env)
+        times.append(time.time() - start)
+    times.sort()
+    return {'function': 'import katversion', 'wall_median': times[len(times) // 2],
+            'wall_min': times[0]}
+
+
+def git_version():
+    return subprocess.check_output(['git', '--version'],
+                                   universal_newlines=True).strip()
+
+
+def run(args):
+    results = [measure_import(args.repeats)]
+    scenarios = itertools.product(args.commits, args.tag_every, args.files,
+                                  [False, True] if args.dirty else [False])
+    for commits, tag_every, files, dirty in scenarios:
+        scenario = {'commits': commits, 'tag_every': tag_every,
+                    'junk_tags_every': args.junk_tags_every, 'files': files,
+                    'dirty': dirty}
+        sys.stderr.write('Building repo %s\n' % (scenario,))
+        tempdir = tempfile.mkdtemp(prefix='katversion-bench-')
+        try:
+            build_repo(tempdir, commits, tag_every, args.junk_tags_every,
+                       files, dirty)
+            for backend, warm, name in itertools.product(
+                    args.backends, (False, True), sorted(FUNCTIONS)):
+                os.environ[kv.GIT_BACKEND_ENV] = backend
+                result = dict(scenario, function=name, backend=backend,
+                              cache='warm' if warm else 'cold')
+                result.update(measure(FUNCTIONS[name], tempdir,
+                                      args.repeats, warm))
+                sys.stderr.write('  %(function)s [%(backend)s, %(cache)s]: '
+                                 '%(wall_median).4f s, %(subprocesses)d '
+                                 'processes, %(peak_python_kb)d kB\n' % result)
+                results.append(result)
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+    return {'katversion': katversion.__version__, 'git': git_version(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def _result_key(result):
+    return tuple((k, result[k]) for k in sorted(result)
+                 if k not in ('wall_median', 'wall_min', 'subprocesses',
+                              'peak_python_kb'))
+
+
+def compare(old_filename, new_filename):
+    """Print ratio of new to old median wall time per matching result."""
+    with open(old_filename) as f:
+        old = dict((_result_key(r), r) for r in json.load(f)['results'])
+    with open(new_filename) as f:
+        new = json.load(f)['results']
+    for result in new:
+        key = _result_key(result)
+        if key not in old:
+            continue
+        ratio = result['wall_median'] / max(old[key]['wall_median'], 1e-9)
+        label = ', '.join('%s=%s' % item for item in key)
+        print('%6.2fx  %.4f s -> %.4f s  %s' % (ratio, old[key]['wall_median'],
+                                                result['wall_median'], label))
+
+
+def _int_list(text):
+    return [int(v) for v in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--commits', type=_int_list, default=[1, 100, 10000],
+                        help='History depths to try (default %(default)s)')
+    parser.add_argument('--tag-every', type=_int_list, default=[0, 50],
+                        help='Version tag every N commits, 0 for none '
+                             '(default %(default)s)')
+    parser.add_argument('--junk-tags-every', type=int, default=5,
+                        help='Non-version tag every N commits (default 5)')
+    parser.add_argument('--files', type=_int_list, default=[10, 2000],
+                        help='Numbers of tracked files (default %(default)s)')
+    parser.add_argument('--dirty', action='store_true',
+                        help='Also benchmark repos with a modified file')
+    parser.add_argument('--backends', type=lambda s: s.split(','),
+                        default=['subprocess', 'python', 'batch'],
+                        help='Git backends to try (default %(default)s)')
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help='Number of timed runs per measurement')
+    parser.add_argument('-o', '--output', help='JSON file for results '
+                                               '(default is stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two JSON result files instead')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
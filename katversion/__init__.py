@@ -14,9 +14,13 @@
 # limitations under the License.
 ################################################################################
 
-from .version import get_version, build_info  # noqa: F401 (used in other packages)
+from .version import get_version, get_versions, build_info  # noqa: F401 (public API)
+from .version import Version, get_version_object  # noqa: F401 (public API)
+from .version import normalise_many, sort_versions  # noqa: F401 (public API)
+from .version import clear_cache, install_lazy_version  # noqa: F401 (public API)
+from .watch import VersionWatcher  # noqa: F401 (public API)
 
 # BEGIN VERSION CHECK
 # Get package version when locally imported from repo or via -e develop install
-__version__ = get_version(__path__[0])
+install_lazy_version(globals())
 # END VERSION CHECK
@@ -0,0 +1,488 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Versions of the main katversion functions for use inside asyncio.
+
+The git commands run as asyncio subprocesses so that the event loop keeps
+going while git does its work. The history walk, the commit count and the
+dirty check of a single lookup are independent and run concurrently, and
+many lookups can share one loop with a limit on how many run at a time.
+The results come from and go into the same caches as :func:`get_version`,
+concurrent processes share a single git query in the same way and the same
+time budget applies, with the same fallbacks if it runs out.
+
+This module needs Python 3.5 or newer.
+
+"""
+
+import time
+import asyncio
+from asyncio.subprocess import PIPE
+
+from . import cache, trace
+from .gitreader import GitReaderError, GitRepository, find_git_dir, find_work_tree
+from .version import (GitTimeoutError, Version, _cached_git_info,
+                      _clean_branch_name, _cmd_env, _cmd_name, _count_plan,
+                      _dirty_check_mode, _fallback_version, _finish_count,
+                      _git_backend, _git_info_in_process, _memo_name,
+                      _monorepo_scope, _parse_head_line, _source_dir,
+                      _tag_index, _TimeBudget, _timeout_from_env,
+                      _unambiguous_branch, _version_from_manifest,
+                      _version_stage, date_version, get_build_manifest,
+                      get_version_from_file, get_version_from_metadata,
+                      get_version_from_module, get_version_from_unpacked_sdist)
+from .version import _version_from_scm as _blocking_version_from_scm
+
+
+# Loop running the current coroutine (get_running_loop is new in Python 3.7)
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class _CommandError(RuntimeError):
+    """A command printed an error, as opposed to asyncio failing to run it."""
+
+
+async def _run_cmd(path, *cmd):
+    """Run command asynchronously and return its exit status and output.
+
+    Raises
+    ------
+    _CommandError
+        If the command printed anything to stderr
+
+    """
+    with trace.span('command', _cmd_name(cmd), cmd=cmd, path=path) as span:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=path, stdout=PIPE, stderr=PIPE, env=_cmd_env())
+        try:
+            stdout, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            # Out of time (or no longer wanted), so don't leave git running
+            _kill(proc)
+            await proc.wait()
+            raise
+        span['returncode'] = proc.returncode
+    if stderr:
+        raise _CommandError('###\nCalled process gave error:\n%s\n###'
+                            % stderr.decode('utf-8', 'replace'))
+    return proc.returncode, stdout.decode('utf-8', 'replace')
+
+
+def _kill(proc):
+    """Kill asyncio subprocess `proc` if it is still running."""
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+def _time_left(deadline):
+    """Seconds left until `deadline` (None if there is no deadline)."""
+    return None if deadline is None else max(0.0, deadline - time.time())
+
+
+async def _in_thread(func, *args, deadline=None):
+    """Run blocking `func` in the default executor of the running loop.
+
+    The git commands that `func` runs are limited by the time budget that
+    is left until `deadline`, as the thread can't be cancelled.
+
+    """
+    def call():
+        with _TimeBudget(_time_left(deadline)):
+            return func(*args)
+    return await _running_loop().run_in_executor(None, call)
+
+
+async def _wait_for(coroutine, timeout):
+    """Like :func:`asyncio.wait_for`, but let the coroutine clean up first.
+
+    On timeout the coroutine is cancelled and then awaited, so that it has
+    killed its git processes before this returns (Python 3.6 and older don't
+    wait for it).
+
+    """
+    task = asyncio.ensure_future(coroutine)
+    try:
+        done, _ = await asyncio.wait([task], timeout=timeout)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        task.cancel()
+        await asyncio.wait([task])
+        raise asyncio.TimeoutError()
+    return task.result()
+
+
+async def _is_git(path):
+    """Return True if this is a git repo."""
+    try:
+        status, repo_dir = await _run_cmd(path, 'git', 'rev-parse', '--git-dir')
+    except (OSError, _CommandError):
+        return False
+    return status == 0 and bool(repo_dir)
+
+
+async def _walk_history(path, tag_index):
+    """Stream git log until the first version tag in `tag_index` is found.
+
+    Returns
+    -------
+    short_hash : string
+        Short hash of HEAD
+    branch_name : string or None
+        Name of branch from HEAD decoration, if any
+    version_numbers : list of int
+        First version found in history (empty if none)
+    tagged_head : bool
+        True if version tag is on HEAD
+    num_commits : int
+        Number of commits walked, which is the size of the history if no
+        version was found
+
+    """
+    cmd = ('git', 'log', '--pretty=%H %h%d')
+    short_hash, branch_name, version_numbers, n = '', None, [], -1
+    with trace.span('command', _cmd_name(cmd), cmd=cmd, path=path) as span:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=path, stdout=PIPE, stderr=PIPE, env=_cmd_env())
+        finished = False
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    finished = True
+                    break
+                n += 1
+                line = line.decode('utf-8', 'replace').rstrip('\n')
+                if n == 0:
+                    short_hash, branch_name = _parse_head_line(line)
+                version_numbers = tag_index.get(line[:40], [])
+                if version_numbers:
+                    break
+        finally:
+            if not finished:
+                # Stopped early (or cancelled), so git is not needed anymore
+                _kill(proc)
+            stderr = await proc.stderr.read()
+            await proc.wait()
+        span['lines'] = n + 1
+    if stderr and not version_numbers:
+        raise _CommandError('###\nCalled process gave error:\n%s\n###'
+                            % stderr.decode('utf-8', 'replace'))
+    return short_hash, branch_name, list(version_numbers), n == 0, n + 1
+
+
+async def _commit_count(path, git_dir, head):
+    """Asynchronous version of :func:`katversion.version._commit_count`."""
+    if head is None:
+        # Without knowing the HEAD commit the cached counts are no use
+        _, count = await _run_cmd(path, 'git', 'rev-list', '--count', 'HEAD')
+        return int(count.strip())
+    count, cmd = _count_plan(git_dir, head)
+    if cmd is None:
+        return count
+    try:
+        count = _finish_count(count, (await _run_cmd(path, *cmd))[1])
+    except (_CommandError, ValueError, IndexError):
+        # The base commit is gone (or the cache is bad), so count it all
+        if '--left-right' not in cmd:
+            raise
+        _, count = await _run_cmd(path, 'git', 'rev-list', '--count', head)
+        count = int(count.strip())
+    cache.store_count(git_dir, head, count)
+    return count
+
+
+async def _git_info_subprocess(path, git_dir, deadline=None):
+    """Asynchronous version of :func:`katversion.version._git_info_subprocess`.
+
+    If the history has version tags, the walk could stop early and the
+    commit count runs concurrently with it (unless the count is cached).
+    Otherwise the walk itself counts the commits.
+
+    """
+    # Building the index may run git for-each-ref
+    tag_index = await _in_thread(_tag_index, path, git_dir, deadline=deadline)
+    head = None
+    if git_dir:
+        try:
+            head = GitRepository(git_dir).head()[1]
+        except (GitReaderError, IOError, OSError):
+            pass
+    if tag_index:
+        walk, count = await asyncio.gather(_walk_history(path, tag_index),
+                                           _commit_count(path, git_dir, head))
+    else:
+        walk, count = await _walk_history(path, tag_index), None
+    short_hash, branch_name, version_numbers, tagged_head, walked = walk
+    if not version_numbers and walked:
+        # The walk went through the entire history already
+        count = walked
+        if git_dir and head:
+            cache.store_count(git_dir, head, count)
+    if branch_name is not None:
+        branch_name = _unambiguous_branch(git_dir, branch_name)
+    if branch_name is None:
+        # HEAD decoration could be suppressed by git config
+        branch_name = (await _run_cmd(path, 'git', 'rev-parse',
+                                      '--abbrev-ref', 'HEAD'))[1].strip()
+    return {'branch': _clean_branch_name(branch_name), 'commit': short_hash,
+            'tag': version_numbers, 'tagged_head': tagged_head and
+            bool(version_numbers), 'num_commits': count}
+
+
+async def _git_info(path, git_dir, deadline=None):
+    """Asynchronous version of :func:`katversion.version._git_info`."""
+    key, info = _cached_git_info(git_dir)
+    if info is not None:
+        return info
+    backend = _git_backend()
+    if backend in ('python', 'batch') and git_dir:
+        try:
+            info = await _in_thread(_git_info_in_process, git_dir, backend,
+                                    deadline=deadline)
+        except GitReaderError:
+            pass
+    if info is None:
+        info = await _git_info_subprocess(path, git_dir, deadline)
+    if key:
+        cache.store(git_dir, key, info)
+    return info
+
+
+async def _git_is_dirty(path, git_dir):
+    """Asynchronous version of :func:`katversion.version._git_is_dirty`."""
+    mode = _dirty_check_mode()
+    if mode == 'none':
+        return False
+    if mode == 'status':
+        _, mods = await _run_cmd(path, 'git', 'status', '--porcelain',
+                                 '--untracked-files=no')
+        return bool(mods.strip())
+    if mode == 'index' and git_dir is not None:
+        try:
+            work_tree = find_work_tree(path)
+            if GitRepository(git_dir).worktree_matches_head(work_tree):
+                return False
+        except (GitReaderError, IOError, OSError):
+            pass
+    # Exit status is 1 if there are differences (including staged ones)
+    status, _ = await _run_cmd(path, 'git', 'diff', '--quiet', 'HEAD', '--')
+    return status != 0
+
+
+async def _info_and_dirty(path, git_dir, deadline=None):
+    """Git info and dirty flag of repo at `path`, or None if it is not git."""
+    info, dirty = await asyncio.gather(_git_info(path, git_dir, deadline),
+                                       _git_is_dirty(path, git_dir),
+                                       return_exceptions=True)
+    if isinstance(info, (OSError, _CommandError)) and not await _is_git(path):
+        # Only asked git whether this is a repo at all once the query failed
+        return None
+    for result in (info, dirty):
+        if isinstance(result, BaseException):
+            raise result
+    return info, dirty
+
+
+async def _single_flight(git_dir, compute, name, deadline=None):
+    """Asynchronous version of :func:`katversion.cache.single_flight`.
+
+    Only the wait for the lock runs in a thread, while `compute` is a
+    coroutine function that runs on the loop.
+
+    """
+    state = cache.shared_state(git_dir)
+    if state is None:
+        return await compute()
+    wait = cache.LOCK_WAIT
+    if deadline is not None:
+        wait = min(wait, _time_left(deadline))
+    lock_file, hit, value = await _in_thread(cache.lock_shared, git_dir, name,
+                                             state, wait)
+    if hit:
+        return value
+    if lock_file is None:
+        return await compute()
+    with lock_file:
+        value = await compute()
+        cache.share(git_dir, name, state, value)
+    return value
+
+
+async def _version_from_scm(path, deadline=None):
+    """Asynchronous version of :func:`katversion.version._version_from_scm`."""
+    try:
+        git_dir = find_git_dir(path)
+    except GitReaderError:
+        git_dir = None
+    else:
+        if git_dir is None:
+            # There is no .git anywhere in or above path, so don't ask git
+            return None, None
+    if _monorepo_scope(path, git_dir):
+        # The shared history walk of monorepo mode runs in a thread instead
+        return await _in_thread(_blocking_version_from_scm, path,
+                                deadline=deadline)
+
+    def compute():
+        return _info_and_dirty(path, git_dir, deadline)
+    if git_dir is None:
+        result = await compute()
+    else:
+        hit, result = cache.memo_get(git_dir, _memo_name())
+        if hit:
+            return result
+        snapshot = cache.memo_snapshot(git_dir)
+        # Only one of many processes starting together has to ask git
+        result = await _single_flight(git_dir, compute, _memo_name(), deadline)
+    if result is None:
+        return None, None
+    info, dirty = result
+    result = 'git', Version.from_git_info(info, dirty)
+    if git_dir is not None:
+        cache.memo_put(git_dir, snapshot, result, _memo_name())
+    return result
+
+
+async def _resolve_version(path=None, module=None, timeout=None):
+    """Asynchronous version of :func:`katversion.version._resolve_version`."""
+    deadline = None if timeout is None else time.time() + timeout
+    # The non-git sources only read a few small files, so block for those
+    with trace.span('stage', 'manifest') as span:
+        manifest = get_build_manifest(path, module)
+        span['version'] = manifest and manifest['version']
+    if manifest:
+        return 'manifest', _version_from_manifest(manifest)
+    version = _version_stage('module', get_version_from_module, module)
+    if version:
+        return 'module', Version.parse(version)
+    path = _source_dir(path)
+    version = _version_stage('unpacked_sdist',
+                             get_version_from_unpacked_sdist, path)
+    if version:
+        return 'unpacked_sdist', Version.parse(version)
+    version = _version_stage('metadata', get_version_from_metadata, path)
+    if version:
+        return 'metadata', Version.parse(version)
+    with trace.span('stage', 'scm') as span:
+        try:
+            scm, version = await _wait_for(_version_from_scm(path, deadline),
+                                           _time_left(deadline))
+        except asyncio.TimeoutError:
+            return _fallback_version(path, GitTimeoutError(
+                'Git query of %s ran out of time budget' % (path,)))
+        except GitTimeoutError as err:
+            return _fallback_version(path, err)
+        span['version'] = (scm, version)
+    if version is not None:
+        return 'scm', version
+    version = _version_stage('file', get_version_from_file, path)
+    if version:
+        return 'file', Version.parse(version)
+    return 'date', Version.parse(date_version(scm))
+
+
+async def get_version_object_async(path=None, module=None, semaphore=None,
+                                   timeout=None):
+    """Return the version as a :class:`Version` object, without blocking.
+
+    Parameters
+    ----------
+    path, module : None or string, optional
+        See :func:`katversion.get_version`
+    semaphore : :class:`asyncio.Semaphore`, optional
+        Limits the number of concurrent lookups if shared between them
+    timeout : None or float, optional
+        Time budget for git in seconds (see :func:`katversion.get_version`)
+
+    """
+    if semaphore is not None:
+        async with semaphore:
+            return await get_version_object_async(path, module, None, timeout)
+    if timeout is None:
+        timeout = _timeout_from_env()
+    with trace.span('resolve', 'get_version', path=path, module=module) as span:
+        source, version = await _resolve_version(path, module, timeout)
+        span['source'] = source
+        span['version'] = str(version)
+    return version
+
+
+async def get_version_async(path=None, module=None, semaphore=None,
+                            timeout=None):
+    """Return the version string, without blocking the event loop.
+
+    This is the coroutine equivalent of :func:`katversion.get_version`.
+
+    Parameters
+    ----------
+    path : None or string, optional
+        A file or directory to use to find the SCM or sdist checkout path
+        (default is the current working directory)
+    module : None or string, optional
+        Get version via module name (e.g. __name__ variable), which takes
+        precedence over path if provided (ignore otherwise)
+    semaphore : :class:`asyncio.Semaphore`, optional
+        Limits the number of concurrent lookups if shared between them
+    timeout : None or float, optional
+        Time budget for git in seconds (see :func:`katversion.get_version`)
+
+    Returns
+    -------
+    version : string
+        A string representation of the package version
+
+    """
+    return str(await get_version_object_async(path, module, semaphore,
+                                              timeout))
+
+
+async def build_info_async(name, path=None, module=None, semaphore=None,
+                           timeout=None):
+    """Return the build info tuple, without blocking the event loop."""
+    version = await get_version_object_async(path, module, semaphore, timeout)
+    verlist = version.version_list
+    verlist[0] = name
+    return tuple(verlist)
+
+
+async def get_versions_async(paths, max_concurrency=8):
+    """Resolve versions of many paths concurrently on the running loop.
+
+    Parameters
+    ----------
+    paths : iterable of string
+        Paths to pass to :func:`get_version_async`
+    max_concurrency : int, optional
+        Maximum number of lookups in progress at the same time
+
+    Returns
+    -------
+    versions : dict
+        Mapping from path to its version string, or to the exception raised
+        while trying to get the version
+
+    """
+    paths = list(paths)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(
+        *[get_version_async(path, semaphore=semaphore) for path in paths],
+        return_exceptions=True)
+    return dict(zip(paths, results))
@@ -0,0 +1,125 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Time budget that limits how long git commands may run.
+
+A :class:`_TimeBudget` sets a deadline for the git commands run by the
+current thread, and each command is started with a :class:`_Watchdog`
+that kills it if it is still running when the deadline passes. The
+version lookup then raises :class:`GitTimeoutError` and falls back to
+sources that don't need git.
+
+"""
+
+import os
+import time
+import signal
+import threading
+
+
+# Environment variable with time budget of get_version in seconds
+TIMEOUT_ENV = 'KATVERSION_TIMEOUT'
+# Deadline of the get_version call in progress in each thread (if any)
+_budget = threading.local()
+
+
+class GitTimeoutError(Exception):
+    """A git command was killed because the time budget ran out."""
+
+
+def _timeout_from_env():
+    """Time budget in seconds from the environment, or None if not set."""
+    try:
+        timeout = float(os.environ.get(TIMEOUT_ENV, '').strip())
+    except ValueError:
+        return None
+    return timeout if timeout > 0 else None
+
+
+class _TimeBudget(object):
+    """Context manager that limits the time spent by git commands in it.
+
+    Nested budgets in the same thread can only shorten the deadline.
+
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = _timeout_from_env() if timeout is None else timeout
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = deadline = getattr(_budget, 'deadline', None)
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+            if self.previous is not None:
+                deadline = min(deadline, self.previous)
+        _budget.deadline = deadline
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _budget.deadline = self.previous
+
+
+def _time_left(cmd):
+    """Seconds left for running `cmd` (None if there is no time budget)."""
+    deadline = getattr(_budget, 'deadline', None)
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise GitTimeoutError('Ran out of time budget before running %r'
+                              % (' '.join(cmd),))
+    return remaining
+
+
+class _Watchdog(object):
+    """Kills a command that is still running when the time budget runs out."""
+
+    def __init__(self, proc, cmd, remaining, group):
+        self.proc = proc
+        self.cmd = cmd
+        self.group = group
+        self.fired = False
+        self.timer = None
+        if remaining is not None:
+            self.timer = threading.Timer(remaining, self._kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _kill(self):
+        if self.proc.poll() is not None:
+            return
+        self.fired = True
+        try:
+            if self.group:
+                # Also kill hooks and helpers started by git
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            pass
+
+    def stop(self):
+        """Stop watching the command, which has finished (or been killed)."""
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def check(self, span):
+        """Raise :class:`GitTimeoutError` if the command had to be killed."""
+        if self.fired:
+            span['killed'] = True
+            raise GitTimeoutError('Killed %r as it ran out of time budget'
+                                  % (' '.join(self.cmd),))
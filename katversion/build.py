@@ -28,34 +28,157 @@ else:
     from distutils.command.sdist import log, sdist as OriginalSdist
     from distutils.command.build_py import build_py as OriginalBuildPy
 
-from .version import get_version  # noqa: E402 (confused by if-statement above)
+from .version import (MANIFEST_MODULE, Version,  # noqa: E402 (see above)
+                      _get_version_and_source, _read_build_manifest,
+                      format_build_manifest)
+
+# Patch __init__.py files concurrently if there are at least this many
+PARALLEL_PATCH_THRESHOLD = 8
+
+
+def _patched_lines(init_file, version):
+    """Read lines of `init_file`, returning original and patched versions."""
+    version_cmd = "__version__ = '{0}'\n".format(version)
+    lines, pre_lines, block, post_lines = [], [], [], []
+    # Look for sentinels indicating version checking block (which could
+    # compute __version__ immediately or install a lazy __getattr__)
+    current = pre_lines
+    for line in init_file:
+        lines.append(line)
+        if current is pre_lines and line.strip() == "# BEGIN VERSION CHECK":
+            current = block
+        current.append(line)
+        if current is block and line.strip() == "# END VERSION CHECK":
+            current = post_lines
+    if current is block:
+        # Unterminated block is left alone
+        pre_lines.extend(block)
+        block = []
+    # Delete existing repo version checking block in file. Add a baked-in
+    # version string in its place (or at the end), unless already present
+    # (this happens in pip sdist installs).
+    if version_cmd not in pre_lines and version_cmd not in post_lines:
+        pre_lines += ["\n# Automatically added by katversion\n", version_cmd]
+    return lines, pre_lines + post_lines
 
 
 def patch_init_py(init_py, version):
-    """Patch __init__.py to remove version check and append hard-coded version."""
-    # Open top-level __init__.py and read whole file
+    """Patch __init__.py to remove version check and append hard-coded version.
+
+    The file is only rewritten if its contents actually change, so that its
+    modification time is preserved when the version is already baked in.
+
+    Returns
+    -------
+    changed : bool
+        True if the file was modified
+
+    """
+    with open(init_py, 'r') as init_file:
+        lines, patched_lines = _patched_lines(init_file, version)
+    if patched_lines == lines:
+        log.info("version '%s' already baked into %s", version, init_py)
+        return False
     log.info("patching %s to bake in version '%s'", init_py, version)
-    with open(init_py, 'r+') as init_file:
-        lines = init_file.readlines()
-        # Search for sentinels indicating version checking block
-        try:
-            begin = lines.index("# BEGIN VERSION CHECK\n")
-            end = lines.index("# END VERSION CHECK\n")
-        except ValueError:
-            begin = end = len(lines)
-        # Delete existing repo version checking block in file. Add a baked-in
-        # version string in its place (or at the end), unless already present
-        # (this happens in pip sdist installs).
-        init_file.seek(0)
-        pre_lines = lines[:begin]
-        post_lines = lines[end+1:]
-        init_file.writelines(pre_lines)
-        version_cmd = "__version__ = '{0}'\n".format(version)
-        if version_cmd not in pre_lines and version_cmd not in post_lines:
-            init_file.write("\n# Automatically added by katversion\n")
-            init_file.write(version_cmd)
-        init_file.writelines(post_lines)
-        init_file.truncate()
+    with open(init_py, 'w') as init_file:
+        init_file.writelines(patched_lines)
+    return True
+
+
+def patch_init_pys(init_pys, version):
+    """Patch many __init__.py files, concurrently if there are lots of them."""
+    init_pys = list(init_pys)
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        # No thread pool on Python 2 without the futures backport
+        ThreadPoolExecutor = None
+    if ThreadPoolExecutor is None or len(init_pys) < PARALLEL_PATCH_THRESHOLD:
+        for init_py in init_pys:
+            patch_init_py(init_py, version)
+        return
+    with ThreadPoolExecutor(max_workers=min(len(init_pys), 16)) as executor:
+        # Consume the results to raise any exceptions here
+        list(executor.map(lambda init_py: patch_init_py(init_py, version),
+                          init_pys))
+
+
+def distribution_version(dist):
+    """Version of distribution `dist`, resolved at most once per setup.py run.
+
+    The version and the name of its source are recorded on the Distribution
+    object as the `katversion_version` and `katversion_source` attributes
+    when first needed (or by :func:`setuptools_entry`) and reused by all
+    commands after that. An explicit version in setup.py is used as is, but
+    if it is the version that katversion finds anyway (e.g. via a call to
+    :func:`katversion.get_version` in setup.py) it keeps its git details.
+
+    """
+    if getattr(dist, 'katversion_version', None) is None:
+        source, version = _get_version_and_source()
+        if dist.metadata.version not in (None, str(version)):
+            source, version = 'setup.py', dist.metadata.version
+        _record_version(dist, source, version)
+    return dist.katversion_version
+
+
+def _record_version(dist, source, version):
+    """Remember `version` obtained from `source` on distribution `dist`."""
+    log.info("katversion: version '%s' obtained from %s", version, source)
+    dist.katversion_version = str(version)
+    dist.katversion_source = source
+    # Also keep the Version object, which knows its git branch and commit
+    if not isinstance(version, Version):
+        version = Version.parse(version)
+    dist.katversion_version_object = version
+    dist.metadata.version = dist.katversion_version
+
+
+def write_build_manifest(package_dir, version, source):
+    """Write build manifest module into package directory.
+
+    An existing manifest for the same version is kept, which happens when
+    building from an sdist that already contains the manifest (and which
+    knows the git details of the original checkout).
+
+    Parameters
+    ----------
+    package_dir : string
+        Directory of top-level package
+    version : :class:`katversion.Version` object
+        The package version
+    source : string
+        Name of the source of the version, e.g. 'scm'
+
+    Returns
+    -------
+    changed : bool
+        True if the manifest was written
+
+    """
+    filename = os.path.join(package_dir, MANIFEST_MODULE + '.py')
+    try:
+        existing = _read_build_manifest(filename)
+    except (IOError, OSError, ValueError, SyntaxError):
+        existing = {}
+    if existing.get('version') == str(version):
+        return False
+    log.info("writing build manifest %s", filename)
+    # Remove the file first in case it is hard-linked to the source
+    if os.path.exists(filename):
+        os.unlink(filename)
+    with open(filename, 'w') as manifest:
+        manifest.write(format_build_manifest(version, source))
+    return True
+
+
+def _write_build_manifests(dist, package_dirs):
+    """Write build manifest into each top-level package in `package_dirs`."""
+    distribution_version(dist)
+    for package, package_dir in package_dirs:
+        if '.' not in package:
+            write_build_manifest(package_dir, dist.katversion_version_object,
+                                 dist.katversion_source)
 
 
 class NewStyleBuildPy(OriginalBuildPy, object):
@@ -69,12 +192,15 @@ class AddVersionToInitBuildPy(NewStyleBuildPy):
     def run(self):
         # First do normal build (via super, so this can call custom builds too)
         super(NewStyleBuildPy, self).run()
-        # Obtain distribution package version (set up via setuptools metadata)
-        version = self.distribution.get_version()
+        # Obtain distribution package version (resolved once per setup.py run)
+        version = distribution_version(self.distribution)
         # Patch top-level __init__.py in all import packages
-        for package, _, build_dir, _ in self.data_files:
-            init_py = os.path.join(build_dir, '__init__.py')
-            patch_init_py(init_py, version)
+        patch_init_pys([os.path.join(build_dir, '__init__.py')
+                        for package, _, build_dir, _ in self.data_files], version)
+        # Add build info module to top-level packages
+        _write_build_manifests(self.distribution,
+                               [(package, build_dir) for package, _, build_dir, _
+                                in self.data_files])
 
 
 class NewStyleSdist(OriginalSdist, object):
@@ -88,11 +214,12 @@ class AddVersionToInitSdist(NewStyleSdist):
     def make_release_tree(self, base_dir, files):
         # First do normal sdist (via super, so this can call custom sdists too)
         super(NewStyleSdist, self).make_release_tree(base_dir, files)
-        # Obtain distribution package version (set up via setuptools metadata)
-        version = self.distribution.get_version()
+        # Obtain distribution package version (resolved once per setup.py run)
+        version = distribution_version(self.distribution)
         # We need build_py command for this as sdist is unaware of import packages
         build_py = self.get_finalized_command('build_py')
         # Patch __init__.py in source directories of all import packages
+        init_pys = []
         for package, input_src_dir, _, _ in build_py.data_files:
             output_src_dir = os.path.join(base_dir, input_src_dir)
             # Ensure __init__.py is not hard-linked so that we don't change source
@@ -100,8 +227,13 @@ class AddVersionToInitSdist(NewStyleSdist):
             if hasattr(os, 'link') and os.path.exists(dest):
                 os.unlink(dest)
                 self.copy_file(os.path.join(input_src_dir, '__init__.py'), dest)
-            # Patch top-level __init__.py
-            patch_init_py(dest, version)
+            init_pys.append(dest)
+        # Patch top-level __init__.py files
+        patch_init_pys(init_pys, version)
+        # Add build info module to top-level packages
+        _write_build_manifests(self.distribution,
+                               [(package, os.path.join(base_dir, src_dir))
+                                for package, src_dir, _, _ in build_py.data_files])
 
 
 def setuptools_entry(dist, keyword, value):
@@ -110,11 +242,12 @@ def setuptools_entry(dist, keyword, value):
     if not value:
         return
     # Enforce the version obtained by katversion, overriding user setting
-    version = get_version()
+    source, version = _get_version_and_source()
     if dist.metadata.version is not None:
         s = "Ignoring explicit version='{0}' in setup.py, using '{1}' instead"
         warnings.warn(s.format(dist.metadata.version, version))
-    dist.metadata.version = version
+    # Record version on distribution so that commands don't resolve it again
+    _record_version(dist, source, version)
 
     # Extend build_py command to bake version string into installed package
     ExistingCustomBuildPy = dist.cmdclass.get('build_py', object)
@@ -0,0 +1,466 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Caches of version information, in memory and inside the git directory.
+
+The persistent cache stores git history info and is keyed on repository
+state that is cheap to stat: the HEAD ref and commit, and the modification
+times of the tag refs. A warm lookup therefore costs a few stat() calls and
+one small file read instead of running git. In addition, the number of
+commits in the history of recent HEADs is kept, so that after HEAD moves the
+new count only involves the commits that changed.
+
+The in-process cache remembers complete results (and the tag index) per git
+directory and revalidates them by stat-ing HEAD, the current branch ref, the
+tags and the index on every lookup.
+
+Processes that look up the same repository at the same moment coordinate
+via an advisory lock file in the git directory: one of them computes the
+result and shares it in a file, which the others that waited for it read
+instead of running git themselves.
+
+Set the environment variable KATVERSION_NO_CACHE to bypass all caches.
+
+"""
+
+import os
+import time
+import json
+import errno
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks (e.g. on Windows), so every process computes
+    fcntl = None
+
+from . import trace
+from .gitreader import GitReaderError, GitRepository, find_common_dir
+
+
+CACHE_FILENAME = 'katversion-cache'
+# Bump this if the format of cached info changes
+CACHE_FORMAT = 1
+NO_CACHE_ENV = 'KATVERSION_NO_CACHE'
+# Persistent map of commit oid to number of commits in its history
+COUNTS_FILENAME = 'katversion-counts'
+MAX_COUNTS = 16
+# Lock file and result shared between processes computing the same version
+LOCK_FILENAME = 'katversion.lock'
+SHARED_FILENAME = 'katversion-shared'
+# Maximum time to wait for another process to finish before computing anyway
+LOCK_WAIT = 10.0
+
+
+def cache_enabled():
+    """True unless the cache is disabled via environment variable."""
+    return os.environ.get(NO_CACHE_ENV, '').strip().lower() in ('', '0', 'false')
+
+
+# In-process cache mapping (git dir, name) to (watched files, stats, value)
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def _mtime(path):
+    """Modification time of `path` (in ns if available) or None if missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return getattr(st, 'st_mtime_ns', st.st_mtime)
+
+
+def repo_state_key(git_dir):
+    """Key describing the state of the repository in `git_dir`.
+
+    Parameters
+    ----------
+    git_dir : string
+        Path to git directory of repository
+
+    Returns
+    -------
+    key : list or None
+        JSON-serialisable key that changes whenever the history info of the
+        repository could change, or None if the cache is disabled or the
+        repository state could not be determined
+
+    """
+    if not cache_enabled():
+        return None
+    try:
+        repo = GitRepository(git_dir)
+        ref, head = repo.head()
+    except (GitReaderError, IOError, OSError):
+        return None
+    # Deepening a shallow clone adds history without touching HEAD or refs
+    return [CACHE_FORMAT, ref, head, _shallow_signature(repo.common_dir)] + \
+        [_mtime(f) for f in tag_files(repo)]
+
+
+def _shallow_signature(common_dir):
+    """Stat data of the shallow file in `common_dir` as list (None if absent)."""
+    shallow = _stat_signature([os.path.join(common_dir, 'shallow')])[0]
+    return shallow and list(shallow)
+
+
+def tag_files(repo):
+    """Files and directories of :class:`GitRepository` `repo` holding tags.
+
+    This includes subdirectories of refs/tags, since adding a tag in there
+    does not touch the modification time of refs/tags itself.
+
+    """
+    tags_dir = os.path.join(repo.common_dir, 'refs', 'tags')
+    files = [os.path.join(repo.common_dir, 'packed-refs'), tags_dir]
+    for root, dirs, _ in os.walk(tags_dir):
+        dirs.sort()
+        files.extend(os.path.join(root, d) for d in dirs)
+    return files
+
+
+def load(git_dir, key):
+    """Load cached info for repository in `git_dir` if stored under `key`."""
+    try:
+        with open(os.path.join(git_dir, CACHE_FILENAME)) as f:
+            record = json.load(f)
+        if record['key'] == key:
+            return record['info']
+    except (IOError, OSError, ValueError, TypeError, KeyError):
+        # Missing, unreadable or corrupt cache is simply a cache miss
+        pass
+    return None
+
+
+def load_last(git_dir):
+    """Load the last info cached for `git_dir`, whatever its key."""
+    if not cache_enabled():
+        return None
+    try:
+        with open(os.path.join(git_dir, CACHE_FILENAME)) as f:
+            return json.load(f)['info']
+    except (IOError, OSError, ValueError, TypeError, KeyError):
+        return None
+
+
+def _write_json(git_dir, filename, record):
+    """Write `record` to `filename` inside `git_dir` as JSON, atomically."""
+    try:
+        fd, tmp_name = tempfile.mkstemp(prefix=filename + '.', dir=git_dir)
+    except (IOError, OSError):
+        # The git directory is read-only, so don't bother caching
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+        replace = getattr(os, 'replace', os.rename)
+        replace(tmp_name, os.path.join(git_dir, filename))
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+
+
+def store(git_dir, key, info):
+    """Store `info` for repository in `git_dir` under `key`, atomically."""
+    _write_json(git_dir, CACHE_FILENAME, {'key': key, 'info': info})
+
+
+def load_counts(git_dir):
+    """Load list of (commit oid, number of commits in its history) pairs.
+
+    The most recently stored count comes last. The list is empty if the
+    cache is disabled, missing or corrupt, or if the shallow boundary of the
+    repository moved since the counts were stored (as that changes them).
+
+    """
+    if not cache_enabled():
+        return []
+    try:
+        with open(os.path.join(git_dir, COUNTS_FILENAME)) as f:
+            record = json.load(f)
+        if record['format'] == CACHE_FORMAT and record['shallow'] == \
+                _shallow_signature(find_common_dir(git_dir)):
+            return [(str(oid), int(count)) for oid, count in record['counts']]
+    except (IOError, OSError, ValueError, TypeError, KeyError):
+        pass
+    return []
+
+
+def store_count(git_dir, oid, count):
+    """Remember that the history of commit `oid` contains `count` commits."""
+    if not cache_enabled():
+        return
+    counts = [entry for entry in load_counts(git_dir) if entry[0] != oid]
+    counts = counts[1 - MAX_COUNTS:] + [(oid, count)]
+    _write_json(git_dir, COUNTS_FILENAME,
+                {'format': CACHE_FORMAT, 'counts': counts,
+                 'shallow': _shallow_signature(find_common_dir(git_dir))})
+
+
+def _stat_signature(paths):
+    """Cheap fingerprint of the current state of files in `paths`."""
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((getattr(st, 'st_mtime_ns', st.st_mtime),
+                              st.st_size, st.st_ino))
+    return signature
+
+
+def ref_files(git_dir):
+    """Files in `git_dir` that change when HEAD or the tags change."""
+    try:
+        repo = GitRepository(git_dir)
+        ref = repo.head()[0]
+    except (GitReaderError, IOError, OSError):
+        return None
+    files = [os.path.join(git_dir, 'HEAD')]
+    files.extend(tag_files(repo))
+    if ref is not None:
+        files.append(os.path.join(repo.common_dir, *ref.split('/')))
+    return files
+
+
+def _watched_files(git_dir):
+    """Files in `git_dir` that change when the version could change."""
+    files = ref_files(git_dir)
+    return None if files is None else files + [os.path.join(git_dir, 'index')]
+
+
+def memo_get(git_dir, name='version'):
+    """Look up value remembered for `git_dir` (see :func:`memoise`).
+
+    Returns
+    -------
+    hit : bool
+        True if a value was found and the repository is unchanged since
+    value : object
+        The remembered value if `hit`, otherwise None
+
+    """
+    if not cache_enabled():
+        return False, None
+    entry = _memo.get((git_dir, name))
+    hit = entry is not None and _stat_signature(entry[0]) == entry[1]
+    trace.mark('cache', 'memory', git_dir=git_dir, value=name, hit=hit)
+    return hit, entry[2] if hit else None
+
+
+def memo_peek(git_dir, name='version'):
+    """Value remembered for `git_dir`, even if the repo changed since (or None)."""
+    if not cache_enabled():
+        return None
+    entry = _memo.get((git_dir, name))
+    return None if entry is None else entry[2]
+
+
+def memo_snapshot(git_dir, watched=_watched_files):
+    """Snapshot of repository state to pass to :func:`memo_put` (or None).
+
+    Take the snapshot before computing the value in case the repo changes.
+
+    """
+    if not cache_enabled():
+        return None
+    files = watched(git_dir)
+    return None if files is None else (files, _stat_signature(files))
+
+
+def memo_put(git_dir, snapshot, value, name='version'):
+    """Remember `value` for `git_dir` as long as it matches `snapshot`."""
+    if snapshot is not None:
+        with _memo_lock:
+            _memo[(git_dir, name)] = snapshot + (value,)
+
+
+def memoise(git_dir, compute, name='version', watched=_watched_files):
+    """Return value computed for `git_dir`, reusing it if repo is unchanged.
+
+    Parameters
+    ----------
+    git_dir : string
+        Path to git directory of repository
+    compute : callable
+        Function without arguments that computes the value for the repo
+    name : string, optional
+        Name of value, to remember more than one value per repository
+    watched : callable, optional
+        Function of `git_dir` that returns the files that change when the
+        value could change, or None if the value should not be remembered
+
+    Returns
+    -------
+    value : object
+        Return value of `compute`, either fresh or from an earlier call
+
+    """
+    hit, value = memo_get(git_dir, name)
+    if hit:
+        return value
+    snapshot = memo_snapshot(git_dir, watched)
+    value = compute()
+    memo_put(git_dir, snapshot, value, name)
+    return value
+
+
+def _load_shared(git_dir, name, state, since):
+    """Load value shared by another process after `since`, as (hit, value).
+
+    Only values shared while we waited for the lock are used, since the
+    working tree could have become dirty since an older value was computed
+    without touching any of the watched files.
+
+    """
+    try:
+        with open(os.path.join(git_dir, SHARED_FILENAME)) as f:
+            record = json.load(f)
+        if record['name'] == name and record['state'] == state and \
+                since <= record['time']:
+            return True, record['value']
+    except (IOError, OSError, ValueError, TypeError, KeyError):
+        pass
+    return False, None
+
+
+def _lock(lock_file, wait):
+    """Lock `lock_file` exclusively, giving up after `wait` seconds."""
+    deadline = time.time() + wait
+    delay = 0.005
+    while True:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                # Locks are not supported here (e.g. some network filesystems)
+                return False
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(2 * delay, 0.1)
+
+
+def shared_state(git_dir):
+    """State of repo in `git_dir` that shared values belong to, or None.
+
+    None means that values of this repository are not shared.
+
+    """
+    files = _watched_files(git_dir) if fcntl and cache_enabled() else None
+    if files is None:
+        return None
+    # Normalise state via JSON to compare it with the one loaded from file
+    return json.loads(json.dumps([files, _stat_signature(files)]))
+
+
+def lock_shared(git_dir, name, state, wait=LOCK_WAIT):
+    """Take the lock of `git_dir` and use the value shared meanwhile, if any.
+
+    Returns
+    -------
+    lock_file : file object or None
+        Locked file if the value has to be computed (close it after calling
+        :func:`share` to release the lock), or None if the lock was not
+        taken within `wait` seconds or the value was shared while waiting
+    hit : bool
+        True if another process shared the value while we waited
+    value : object
+        The shared value if `hit`, otherwise None
+
+    """
+    since = time.time()
+    try:
+        lock_file = open(os.path.join(git_dir, LOCK_FILENAME), 'a')
+    except (IOError, OSError):
+        # The git directory is read-only, so go it alone
+        return None, False, None
+    # Don't let git processes (like long-running cat-file) inherit the lock
+    flags = fcntl.fcntl(lock_file.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(lock_file.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    with trace.span('cache', 'lock', git_dir=git_dir) as span:
+        locked = _lock(lock_file, wait)
+        span['locked'] = locked
+    # The process that held the lock may have shared the value
+    hit, value = _load_shared(git_dir, name, state, since) if locked \
+        else (False, None)
+    trace.mark('cache', 'shared', git_dir=git_dir, value=name, hit=hit)
+    if not locked or hit:
+        # Closing the file releases the lock
+        lock_file.close()
+        return None, hit, value
+    return lock_file, False, None
+
+
+def share(git_dir, name, state, value):
+    """Share `value` belonging to repo `state` with other processes."""
+    _write_json(git_dir, SHARED_FILENAME, {'name': name, 'state': state,
+                                           'time': time.time(), 'value': value})
+
+
+def single_flight(git_dir, compute, name='version', wait=LOCK_WAIT):
+    """Compute value for `git_dir` in only one of many concurrent processes.
+
+    The first process takes the lock, computes the value and shares it,
+    while the others wait for the lock and then use the shared value. Only
+    processes that waited use it, so a later call computes the value anew. The
+    operating system releases the lock if its process dies, and processes
+    stop waiting after `wait` seconds in case its owner hangs instead.
+
+    Parameters
+    ----------
+    git_dir : string
+        Path to git directory of repository
+    compute : callable
+        Function without arguments that computes the value for the repo,
+        which has to be JSON serialisable
+    name : string, optional
+        Name of value, which identifies it together with the repo state
+    wait : float, optional
+        Maximum time to wait for another process, in seconds
+
+    Returns
+    -------
+    value : object
+        Return value of `compute`, either fresh or from another process
+
+    """
+    state = shared_state(git_dir)
+    if state is None:
+        return compute()
+    lock_file, hit, value = lock_shared(git_dir, name, state, wait)
+    if hit:
+        return value
+    if lock_file is None:
+        return compute()
+    with lock_file:
+        value = compute()
+        share(git_dir, name, state, value)
+    return value
+
+
+def clear_cache():
+    """Forget all version information remembered by the current process."""
+    with _memo_lock:
+        _memo.clear()
@@ -0,0 +1,247 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Read git objects via long-running `git cat-file --batch` processes.
+
+A :class:`CatFileSession` keeps one `git cat-file --batch` process per
+repository (plus a `--batch-check` one to test abbreviations) and asks it
+for objects over a pipe, which costs a round trip instead of a fork. The
+session also remembers the parsed commits, which never change, so a repeat
+lookup after HEAD moved only reads the new commits. The processes are
+stopped when the session has been idle for a while (and restarted when it
+is used again), restarted if they die and stopped at interpreter exit. Like
+other git commands they are killed if the time budget of a lookup runs out.
+
+:class:`BatchRepository` is a :class:`GitRepository` that reads its objects
+from the session, so that git itself reads the object store while the refs
+are still read in-process and the history is walked in Python.
+
+"""
+
+import os
+import time
+import atexit
+import threading
+from subprocess import Popen, PIPE
+
+from . import trace
+from .budget import _time_left, _Watchdog
+from .gitreader import GitReaderError, GitRepository
+
+
+# Stop the git processes of a session after this many seconds without use
+IDLE_TIMEOUT = 60.0
+# Sessions by real path of git directory
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class CatFileSession(object):
+    """Long-running git cat-file processes serving the objects of a repository.
+
+    Parameters
+    ----------
+    git_dir : string
+        Path to git directory of repository
+
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        # Parsed commits by oid, shared by all repositories using the session
+        self.commits = {}
+        self._procs = {}
+        self._lock = threading.Lock()
+        self._last_used = 0.0
+        # Thread that stops the processes once idle, and event to wake it up
+        self._idle_thread = None
+        self._wakeup = threading.Event()
+
+    def _start(self, mode):
+        cmd = ('git', '--git-dir=' + self.git_dir, 'cat-file', '--' + mode)
+        with trace.span('command', 'cat-file', cmd=cmd, path=self.git_dir), \
+                open(os.devnull, 'wb') as devnull:
+            return Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=devnull)
+
+    def _stop(self, mode):
+        proc = self._procs.pop(mode, None)
+        if proc is None:
+            return
+        try:
+            # The process exits by itself at the end of its input
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+
+    def _request(self, mode, name, with_data=False):
+        """Ask cat-file process in `mode` about object `name` (restart once)."""
+        for attempt in range(2):
+            # Don't restart a process killed by the watchdog
+            _time_left(('git', 'cat-file', '--' + mode))
+            try:
+                proc = self._procs.get(mode)
+                if proc is None:
+                    proc = self._procs[mode] = self._start(mode)
+                proc.stdin.write(name.encode('ascii') + b'\n')
+                proc.stdin.flush()
+                # "<oid> <type> <size>", "<name> missing" or "<name> ambiguous"
+                fields = proc.stdout.readline().decode('ascii').split()
+                if len(fields) < 2:
+                    raise IOError('No reply from git cat-file')
+                data = None
+                if with_data and len(fields) == 3:
+                    size = int(fields[2])
+                    data = proc.stdout.read(size + 1)
+                    if len(data) != size + 1:
+                        raise IOError('Truncated reply from git cat-file')
+                    data = data[:-1]
+                return fields, data
+            except (IOError, OSError, ValueError):
+                # The process died or got confused, so start a fresh one
+                self._stop(mode)
+        raise GitReaderError('git cat-file --%s failed in %s' % (mode, self.git_dir))
+
+    def read_object(self, oid):
+        """Read git object with hex `oid` as (type, data) tuple."""
+        with self._lock:
+            fields, data = self._request('batch', oid, with_data=True)
+        if data is None:
+            raise GitReaderError('Object %s is %s' % (oid, fields[-1]))
+        return fields[1], data
+
+    def is_ambiguous(self, prefix):
+        """True if hex `prefix` is the start of more than one object id."""
+        with self._lock:
+            fields, _ = self._request('batch-check', prefix)
+        return fields[-1] == 'ambiguous'
+
+    def count_commits(self, oid):
+        """Number of commits in history of `oid` (a one-off git rev-list)."""
+        cmd = ('git', '--git-dir=' + self.git_dir, 'rev-list', '--count', oid)
+        with trace.span('command', 'rev-list', cmd=cmd, path=self.git_dir) as span, \
+                open(os.devnull, 'wb') as devnull:
+            remaining = _time_left(cmd)
+            proc = Popen(cmd, stdout=PIPE, stderr=devnull)
+            watchdog = _Watchdog(proc, cmd, remaining, False)
+            try:
+                output = proc.communicate()[0]
+            finally:
+                watchdog.stop()
+            watchdog.check(span)
+        try:
+            return int(output)
+        except ValueError:
+            raise GitReaderError('Could not count commits of %s' % (oid,))
+
+    def watch(self):
+        """Watchdog that kills the processes when the time budget runs out.
+
+        Stop it once the lookup using the session is done.
+
+        """
+        cmd = ('git', 'cat-file', '--batch')
+        return _Watchdog(self, cmd, _time_left(cmd), False)
+
+    def poll(self):
+        """None while any process is running (for :class:`_Watchdog`)."""
+        return None if self._procs else 0
+
+    def kill(self):
+        """Kill the processes, even while a request is waiting for them."""
+        for proc in list(self._procs.values()):
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    def release(self):
+        """Stop the processes unless the session is used again soon."""
+        with self._lock:
+            self._last_used = time.time()
+            if self._idle_thread is None and self._procs:
+                self._wakeup.clear()
+                self._idle_thread = threading.Thread(
+                    target=self._close_when_idle, name='katversion-cat-file')
+                self._idle_thread.daemon = True
+                self._idle_thread.start()
+
+    def _close_when_idle(self):
+        while True:
+            with self._lock:
+                self._wakeup.clear()
+                idle = time.time() - self._last_used
+                if idle >= IDLE_TIMEOUT or not self._procs:
+                    for mode in list(self._procs):
+                        self._stop(mode)
+                    self._idle_thread = None
+                    return
+            self._wakeup.wait(IDLE_TIMEOUT - idle)
+
+    def close(self):
+        """Stop the processes (they are restarted if the session is used)."""
+        with self._lock:
+            for mode in list(self._procs):
+                self._stop(mode)
+        self._wakeup.set()
+
+
+def get_session(git_dir):
+    """The :class:`CatFileSession` of repository in `git_dir`."""
+    git_dir = os.path.realpath(git_dir)
+    with _sessions_lock:
+        session = _sessions.get(git_dir)
+        if session is None:
+            session = _sessions[git_dir] = CatFileSession(git_dir)
+    return session
+
+
+def close_sessions():
+    """Stop the processes of all sessions and forget their commits."""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+atexit.register(close_sessions)
+
+
+class BatchRepository(GitRepository):
+    """A :class:`GitRepository` that reads objects via a cat-file session."""
+
+    def __init__(self, git_dir):
+        GitRepository.__init__(self, git_dir)
+        self.session = get_session(git_dir)
+        self._commits = self.session.commits
+
+    def read_object(self, oid):
+        return self.session.read_object(oid)
+
+    def count_commits(self, oid):
+        # One git process counts long histories faster than many round trips
+        return self.session.count_commits(oid)
+
+    def abbreviate(self, oid):
+        """Shortest unique abbreviation of hex `oid`, like git's `%h`."""
+        length = self._default_abbrev()
+        while length < len(oid) and self.session.is_ambiguous(oid[:length]):
+            length += 1
+        return oid[:length]
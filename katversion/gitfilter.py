@@ -0,0 +1,158 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Long-running git filter process that smudges files with the version.
+
+Git starts the filter once per checkout (instead of once per file) if it is
+configured as a `filter.<driver>.process` command and then talks to it over
+stdin / stdout using the pkt-line based protocol described in the
+gitattributes(5) man page. The version is computed once and every smudge
+request is answered from memory by replacing the file contents with it.
+
+"""
+
+# Maximum size of pkt-line payload
+MAX_PACKET_DATA = 65516
+
+
+class FilterProtocolError(Exception):
+    """Git filter process protocol was violated."""
+
+
+def read_packet(stream):
+    """Read one pkt-line from binary `stream`.
+
+    Returns
+    -------
+    data : bytes or None
+        Packet payload, or None for a flush packet
+
+    Raises
+    ------
+    EOFError
+        If the stream ended cleanly before the packet
+    FilterProtocolError
+        If the packet is malformed or truncated
+
+    """
+    header = stream.read(4)
+    if not header:
+        raise EOFError('Git closed the filter process pipe')
+    try:
+        length = int(header, 16)
+    except ValueError:
+        raise FilterProtocolError('Invalid pkt-line header %r' % (header,))
+    if length == 0:
+        return None
+    if length < 4:
+        raise FilterProtocolError('Invalid pkt-line length %d' % (length,))
+    data = stream.read(length - 4)
+    if len(data) != length - 4:
+        raise FilterProtocolError('Truncated pkt-line')
+    return data
+
+
+def read_packet_text(stream):
+    """Read list of text pkt-lines up to flush packet, without newlines."""
+    lines = []
+    while True:
+        data = read_packet(stream)
+        if data is None:
+            return lines
+        lines.append(data.decode('utf-8').rstrip('\n'))
+
+
+def read_packet_content(stream):
+    """Read binary content sent as pkt-lines up to flush packet."""
+    chunks = []
+    while True:
+        data = read_packet(stream)
+        if data is None:
+            return b''.join(chunks)
+        chunks.append(data)
+
+
+def write_packet(stream, data):
+    """Write `data` bytes as one pkt-line to binary `stream`."""
+    stream.write(('%04x' % (len(data) + 4,)).encode('ascii') + data)
+
+
+def write_flush(stream):
+    """Write flush packet to binary `stream` and flush it."""
+    stream.write(b'0000')
+    stream.flush()
+
+
+def write_packet_text(stream, lines):
+    """Write text `lines` as pkt-lines followed by a flush packet."""
+    for line in lines:
+        write_packet(stream, (line + '\n').encode('utf-8'))
+    write_flush(stream)
+
+
+def write_packet_content(stream, content):
+    """Write binary `content` as pkt-lines followed by a flush packet."""
+    for start in range(0, len(content), MAX_PACKET_DATA):
+        write_packet(stream, content[start:start + MAX_PACKET_DATA])
+    write_flush(stream)
+
+
+def filter_process(get_version, stdin, stdout):
+    """Serve git's long-running filter protocol until git closes the pipe.
+
+    Parameters
+    ----------
+    get_version : callable
+        Function without arguments that returns the version string, which
+        is called the first time a file is smudged
+    stdin, stdout : binary file-like objects
+        Streams connected to git
+
+    """
+    # Handshake
+    welcome = read_packet_text(stdin)
+    if not welcome or welcome[0] != 'git-filter-client':
+        raise FilterProtocolError('Unexpected welcome %r' % (welcome,))
+    if 'version=2' not in welcome[1:]:
+        raise FilterProtocolError('Git does not support filter version 2')
+    write_packet_text(stdout, ['git-filter-server', 'version=2'])
+    capabilities = read_packet_text(stdin)
+    if 'capability=smudge' not in capabilities:
+        raise FilterProtocolError('Git does not support the smudge capability')
+    write_packet_text(stdout, ['capability=smudge'])
+    # Answer requests, computing the version once
+    content = None
+    while True:
+        try:
+            request = read_packet_text(stdin)
+        except EOFError:
+            return
+        command = dict(line.partition('=')[::2] for line in request)
+        # Consume the original contents of the file, which we ignore
+        read_packet_content(stdin)
+        if command.get('command') != 'smudge':
+            write_packet_text(stdout, ['status=error'])
+            continue
+        if content is None:
+            try:
+                content = (get_version() + '\n').encode('utf-8')
+            except Exception:
+                write_packet_text(stdout, ['status=error'])
+                continue
+        write_packet_text(stdout, ['status=success'])
+        write_packet_content(stdout, content)
+        # Empty list keeps status as "success"
+        write_flush(stdout)
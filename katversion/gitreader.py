@@ -0,0 +1,757 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Minimal pure-Python reader of git repositories that never runs git itself.
+
+This understands just enough of the on-disk repository format to reproduce
+what katversion asks of git: the current branch, the abbreviated HEAD commit
+hash, the tags and the commit history. Anything out of the ordinary (SHA-256
+repositories, alternates, grafts, replace refs, ...) raises
+:class:`GitReaderError` so that the caller can fall back to the git binary.
+
+"""
+
+import os
+import re
+import zlib
+import heapq
+import stat
+import struct
+import binascii
+
+
+# Object types as stored in pack files
+_PACK_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+# Minimum length of abbreviated commit hash (git's FALLBACK_DEFAULT_ABBREV)
+MIN_ABBREV = 7
+HEX_OID = re.compile(r'^[0-9a-f]{40}$')
+# Errors raised while decoding damaged (e.g. truncated) objects and packs
+_CORRUPT_DATA_ERRORS = (zlib.error, struct.error, IOError, OSError, ValueError,
+                        IndexError, TypeError)
+
+
+class GitReaderError(Exception):
+    """Repository could not be read without the help of the git binary."""
+
+
+def _find_dot_git(path):
+    """Find working tree containing `path` and its ".git" dir / file."""
+    for var in ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_CEILING_DIRECTORIES',
+                'GIT_DISCOVERY_ACROSS_FILESYSTEM', 'GIT_COMMON_DIR',
+                'GIT_INDEX_FILE'):
+        if var in os.environ:
+            raise GitReaderError('Environment variable %s is set' % (var,))
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.exists(dot_git):
+            return path, dot_git
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None, None
+        path = parent
+
+
+def find_git_dir(path):
+    """Find the git directory of the working tree containing `path`.
+
+    Parameters
+    ----------
+    path : string
+        A directory inside a git working tree
+
+    Returns
+    -------
+    git_dir : string or None
+        The git directory (usually ".git" at the top of the working tree),
+        or None if `path` is not inside a git working tree
+
+    Raises
+    ------
+    GitReaderError
+        If git's environment variables modify the repository discovery
+
+    """
+    work_tree, dot_git = _find_dot_git(path)
+    if dot_git is None or os.path.isdir(dot_git):
+        return dot_git
+    # Submodules and linked worktrees have a "gitdir: <path>" file
+    with open(dot_git) as f:
+        line = f.readline().strip()
+    if not line.startswith('gitdir: '):
+        raise GitReaderError('Invalid .git file %r' % (dot_git,))
+    return os.path.normpath(os.path.join(work_tree, line[8:]))
+
+
+def find_work_tree(path):
+    """Find top-level directory of the working tree containing `path`."""
+    return _find_dot_git(path)[0]
+
+
+def find_common_dir(git_dir):
+    """Directory with the refs and objects shared by all worktrees of `git_dir`."""
+    # Linked worktrees keep shared refs and objects in a common directory
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = f.read().strip()
+    except IOError:
+        common_dir = '.'
+    return os.path.normpath(os.path.join(git_dir, common_dir))
+
+
+def _hex(oid):
+    return binascii.hexlify(oid).decode('ascii')
+
+
+def _read_varint(data, pos):
+    """Read little-endian base-128 size used in delta headers."""
+    result = shift = 0
+    while True:
+        c = ord(data[pos:pos + 1])
+        pos += 1
+        result |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return result, pos
+
+
+def apply_delta(base, delta):
+    """Reconstruct object from `base` object and git pack `delta`."""
+    src_size, pos = _read_varint(delta, 0)
+    dst_size, pos = _read_varint(delta, pos)
+    if src_size != len(base):
+        raise GitReaderError('Delta base size mismatch')
+    out = []
+    end = len(delta)
+    while pos < end:
+        op = ord(delta[pos:pos + 1])
+        pos += 1
+        if op & 0x80:
+            # Copy a slice of the base object
+            offset = size = 0
+            for n in range(4):
+                if op & (1 << n):
+                    offset |= ord(delta[pos:pos + 1]) << (8 * n)
+                    pos += 1
+            for n in range(3):
+                if op & (0x10 << n):
+                    size |= ord(delta[pos:pos + 1]) << (8 * n)
+                    pos += 1
+            out.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            # Insert literal data from delta itself
+            out.append(delta[pos:pos + op])
+            pos += op
+        else:
+            raise GitReaderError('Invalid delta opcode')
+    result = b''.join(out)
+    if len(result) != dst_size:
+        raise GitReaderError('Delta result size mismatch')
+    return result
+
+
+class PackFile(object):
+    """A git pack file (*.pack) and its version 2 index (*.idx)."""
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-4] + '.pack'
+        with open(idx_path, 'rb') as f:
+            self._idx = idx = f.read()
+        if idx[:8] != b'\377tOc\x00\x00\x00\x02':
+            raise GitReaderError('Unsupported pack index %r' % (idx_path,))
+        self.fanout = struct.unpack('>256I', idx[8:8 + 1024])
+        self.num_objects = self.fanout[255]
+        self._names_start = 8 + 1024
+        self._offsets_start = self._names_start + 24 * self.num_objects
+        self._file = None
+
+    def name(self, n):
+        """Binary object id of `n`th object in (sorted) pack index."""
+        start = self._names_start + 20 * n
+        return self._idx[start:start + 20]
+
+    def bisect(self, oid):
+        """Index where binary `oid` is (or would be) in sorted pack index."""
+        first = ord(oid[0:1])
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, oid):
+        """Index of binary `oid` in pack, or None if the pack lacks it."""
+        n = self.bisect(oid)
+        return n if n < self.num_objects and self.name(n) == oid else None
+
+    def offset(self, n):
+        """Offset in pack file of `n`th object in pack index."""
+        start = self._offsets_start + 4 * n
+        offset, = struct.unpack('>I', self._idx[start:start + 4])
+        if offset & 0x80000000:
+            start = self._offsets_start + 4 * self.num_objects
+            start += 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack('>Q', self._idx[start:start + 8])
+        return offset
+
+    def read_at(self, offset, read_by_oid):
+        """Read (type, data) of object at `offset`, resolving any deltas."""
+        if self._file is None:
+            self._file = open(self.pack_path, 'rb')
+        return self._read_at(self._file, offset, read_by_oid)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_at(self, f, offset, read_by_oid):
+        f.seek(offset)
+        header = f.read(32)
+        c = ord(header[0:1])
+        obj_type = (c >> 4) & 7
+        pos = 1
+        while c & 0x80:
+            c = ord(header[pos:pos + 1])
+            pos += 1
+        if obj_type == _OFS_DELTA:
+            c = ord(header[pos:pos + 1])
+            pos += 1
+            base_offset = c & 0x7f
+            while c & 0x80:
+                c = ord(header[pos:pos + 1])
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (c & 0x7f)
+            delta = self._inflate(f, offset + pos)
+            base_type, base = self._read_at(f, offset - base_offset, read_by_oid)
+            return base_type, apply_delta(base, delta)
+        elif obj_type == _REF_DELTA:
+            base_oid = header[pos:pos + 20]
+            delta = self._inflate(f, offset + pos + 20)
+            base_type, base = read_by_oid(base_oid)
+            return base_type, apply_delta(base, delta)
+        elif obj_type in _PACK_TYPES:
+            return _PACK_TYPES[obj_type], self._inflate(f, offset + pos)
+        raise GitReaderError('Unknown pack object type %d' % (obj_type,))
+
+    @staticmethod
+    def _inflate(f, offset):
+        f.seek(offset)
+        decomp = zlib.decompressobj()
+        out = []
+        while not decomp.unused_data:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            out.append(decomp.decompress(chunk))
+            if getattr(decomp, 'eof', False):
+                break
+        return b''.join(out)
+
+
+class Commit(object):
+    """The parts of a git commit object that katversion cares about."""
+
+    __slots__ = ('oid', 'tree', 'parents', 'time')
+
+    def __init__(self, oid, data):
+        self.oid = oid
+        self.parents = []
+        self.tree = None
+        self.time = 0
+        header = data.split(b'\n\n', 1)[0]
+        for line in header.split(b'\n'):
+            key, _, value = line.partition(b' ')
+            if key == b'tree':
+                self.tree = value.decode('ascii')
+            elif key == b'parent':
+                self.parents.append(value.decode('ascii'))
+            elif key == b'committer':
+                # "committer Name <email> 1589367543 +0200"
+                self.time = int(value.rsplit(b' ', 2)[-2])
+
+    def without_parents(self):
+        """Copy of commit without parents (for the edge of shallow clones)."""
+        commit = Commit(self.oid, b'')
+        commit.tree = self.tree
+        commit.time = self.time
+        return commit
+
+
+class GitRepository(object):
+    """Read-only view on a git repository, via its git directory.
+
+    Parameters
+    ----------
+    git_dir : string
+        Path to the git directory of repository (typically ".git")
+
+    Raises
+    ------
+    GitReaderError
+        If the repository uses features that this reader does not support
+
+    """
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.common_dir = find_common_dir(git_dir)
+        self.objects_dir = os.path.join(self.common_dir, 'objects')
+        self.abbrev = self._read_config()
+        for unsupported in ('info/grafts', 'objects/info/alternates',
+                            'objects/info/http-alternates', 'refs/replace'):
+            if os.path.exists(os.path.join(self.common_dir, unsupported)):
+                raise GitReaderError('Repository has %s' % (unsupported,))
+        self._shallow = self._read_shallow()
+        self._packs = None
+        self._packed_refs = None
+        self._fully_peeled = False
+        self._commits = {}
+
+    def _read_config(self):
+        """Check repository config for unsupported settings and get abbrev."""
+        abbrev = None
+        section = ''
+        try:
+            with open(os.path.join(self.common_dir, 'config')) as f:
+                lines = f.readlines()
+        except IOError:
+            return abbrev
+        for line in lines:
+            line = line.split('#', 1)[0].split(';', 1)[0].strip()
+            if line.startswith('['):
+                section = line.strip('[]').strip().lower()
+                if section == 'extensions' or section.startswith('include'):
+                    raise GitReaderError('Repository config has [%s]' % (section,))
+                continue
+            key, _, value = line.partition('=')
+            key, value = key.strip().lower(), value.strip()
+            if section == 'core' and key == 'repositoryformatversion':
+                if value not in ('0', '1'):
+                    raise GitReaderError('Unknown repository format ' + value)
+            elif section == 'core' and key == 'abbrev':
+                if value.lower() == 'auto':
+                    abbrev = None
+                elif value.isdigit():
+                    abbrev = max(4, int(value))
+                else:
+                    raise GitReaderError('Unsupported core.abbrev ' + value)
+        return abbrev
+
+    def _read_shallow(self):
+        try:
+            with open(os.path.join(self.common_dir, 'shallow')) as f:
+                return set(line.strip() for line in f if line.strip())
+        except IOError:
+            return set()
+
+    # -- References --------------------------------------------------------
+
+    @property
+    def packed_refs(self):
+        """Dict mapping ref name to (oid, peeled oid or None) for packed refs."""
+        if self._packed_refs is None:
+            refs = {}
+            last = None
+            try:
+                with open(os.path.join(self.common_dir, 'packed-refs')) as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if line.startswith('# pack-refs with:'):
+                            self._fully_peeled = 'fully-peeled' in line.split()
+                        if not line or line.startswith('#'):
+                            continue
+                        if line.startswith('^'):
+                            refs[last] = (refs[last][0], line[1:])
+                        else:
+                            oid, _, last = line.partition(' ')
+                            refs[last] = (oid, None)
+            except IOError:
+                pass
+            self._packed_refs = refs
+        return self._packed_refs
+
+    def _ref_file(self, name):
+        # HEAD and other pseudo-refs live in the per-worktree git dir
+        base = self.common_dir if name.startswith('refs/') else self.git_dir
+        return os.path.join(base, *name.split('/'))
+
+    def read_ref(self, name):
+        """Raw contents of ref `name` (oid or "ref: <target>"), or None."""
+        try:
+            with open(self._ref_file(name)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            pass
+        packed = self.packed_refs.get(name)
+        return packed[0] if packed else None
+
+    def resolve_ref(self, name):
+        """Follow ref `name` through symbolic refs to a hex object id."""
+        for _ in range(5):
+            value = self.read_ref(name)
+            if value is None:
+                raise GitReaderError('Could not resolve ref %r' % (name,))
+            if not value.startswith('ref: '):
+                if not HEX_OID.match(value):
+                    raise GitReaderError('Invalid ref %r: %r' % (name, value))
+                return value
+            name = value[5:]
+        raise GitReaderError('Symbolic ref loop for %r' % (name,))
+
+    def head(self):
+        """The branch (full ref name, or None if detached) and oid of HEAD."""
+        value = self.read_ref('HEAD')
+        if value is None:
+            raise GitReaderError('Repository has no HEAD')
+        ref = value[5:] if value.startswith('ref: ') else None
+        return ref, self.resolve_ref('HEAD')
+
+    def branch_name(self):
+        """Name of current branch, like `git rev-parse --abbrev-ref HEAD`."""
+        ref, _ = self.head()
+        if ref is None:
+            return 'HEAD'
+        if not ref.startswith('refs/heads/'):
+            raise GitReaderError('HEAD points to unusual ref %r' % (ref,))
+        return self.unambiguous_branch(ref[11:])
+
+    def unambiguous_branch(self, short):
+        """Short branch name, prefixed by "heads/" if another ref shares it."""
+        # Git prefixes "heads/" if short name could also refer to another ref
+        for other in (short, 'refs/' + short, 'refs/tags/' + short,
+                      'refs/remotes/' + short, 'refs/remotes/%s/HEAD' % short):
+            if self.read_ref(other) is not None:
+                return 'heads/' + short
+        return short
+
+    def _loose_refs(self, prefix):
+        top = self._ref_file(prefix)
+        for root, _, files in os.walk(top):
+            for filename in files:
+                full = os.path.join(root, filename)
+                name = prefix + os.path.relpath(full, top).replace(os.sep, '/')
+                with open(full) as f:
+                    yield name, f.read().strip()
+
+    def tags(self):
+        """Dict mapping tag name (without "refs/tags/") to commit oid."""
+        tags = {}
+        for name, (oid, peeled) in self.packed_refs.items():
+            if name.startswith('refs/tags/'):
+                # A fully peeled packed-refs file lists all annotated tags
+                if peeled or self._fully_peeled:
+                    tags[name[10:]] = peeled or oid
+                else:
+                    tags[name[10:]] = self.peel(oid)
+        # Loose refs take precedence over packed ones
+        for name, oid in self._loose_refs('refs/tags/'):
+            if HEX_OID.match(oid):
+                tags[name[10:]] = self.peel(oid)
+        return dict((name, oid) for name, oid in tags.items() if oid)
+
+    def peel(self, oid):
+        """Follow annotated tag objects to a commit oid (None if no commit)."""
+        for _ in range(10):
+            obj_type, data = self.read_object(oid)
+            if obj_type == 'commit':
+                return oid
+            if obj_type != 'tag':
+                return None
+            oid = data.split(b'\n', 1)[0].partition(b' ')[2].decode('ascii')
+        raise GitReaderError('Tag chain too long at %s' % (oid,))
+
+    # -- Objects -----------------------------------------------------------
+
+    @property
+    def packs(self):
+        if self._packs is None:
+            pack_dir = os.path.join(self.objects_dir, 'pack')
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except OSError:
+                names = []
+            try:
+                self._packs = [PackFile(os.path.join(pack_dir, name))
+                               for name in names if name.endswith('.idx')]
+            except _CORRUPT_DATA_ERRORS as err:
+                raise GitReaderError('Could not read pack index: %s' % (err,))
+        return self._packs
+
+    def read_object(self, oid):
+        """Read git object with hex `oid` as (type, data) tuple."""
+        try:
+            return self._read_binary_oid(binascii.unhexlify(oid))
+        except _CORRUPT_DATA_ERRORS as err:
+            raise GitReaderError('Could not read object %s: %s' % (oid, err))
+
+    def _read_binary_oid(self, oid):
+        hex_oid = _hex(oid)
+        loose = os.path.join(self.objects_dir, hex_oid[:2], hex_oid[2:])
+        try:
+            with open(loose, 'rb') as f:
+                raw = zlib.decompress(f.read())
+        except (IOError, OSError):
+            pass
+        else:
+            header, _, data = raw.partition(b'\x00')
+            return header.split(b' ', 1)[0].decode('ascii'), data
+        for pack in self.packs:
+            n = pack.find(oid)
+            if n is not None:
+                return pack.read_at(pack.offset(n), self._read_binary_oid)
+        raise GitReaderError('Object %s not found' % (hex_oid,))
+
+    def commit(self, oid):
+        """Parsed commit object with hex `oid` (cached)."""
+        commit = self._commits.get(oid)
+        if commit is None:
+            obj_type, data = self.read_object(oid)
+            if obj_type != 'commit':
+                raise GitReaderError('Object %s is a %s' % (oid, obj_type))
+            try:
+                commit = self._commits[oid] = Commit(oid, data)
+            except _CORRUPT_DATA_ERRORS as err:
+                raise GitReaderError('Bad commit %s: %s' % (oid, err))
+        if oid in self._shallow:
+            # Keep the cached commit intact, as the shallow boundary can move
+            return commit.without_parents()
+        return commit
+
+    def walk(self, oid):
+        """Iterate over commits reachable from `oid` in `git log` order.
+
+        Like git's default revision walk, this repeatedly emits the newest
+        commit (by committer date) of those whose children have been emitted.
+
+        """
+        seen = set([oid])
+        queue = [(-self.commit(oid).time, 0, oid)]
+        counter = 1
+        while queue:
+            _, _, oid = heapq.heappop(queue)
+            commit = self.commit(oid)
+            yield commit
+            for parent in commit.parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    heapq.heappush(queue, (-self.commit(parent).time,
+                                           counter, parent))
+                    counter += 1
+
+    def count_commits(self, oid):
+        """Number of commits reachable from `oid`, like `git rev-list --count`."""
+        return sum(1 for _ in self.walk(oid))
+
+    def left_right_count(self, left, right):
+        """Numbers of commits only reachable from `left` and only from `right`.
+
+        This is what `git rev-list --left-right --count left...right` prints.
+        Like git, it walks newest commits first and stops once all commits
+        left to visit are reachable from both sides.
+
+        """
+        if left == right:
+            return 0, 0
+        # Bit 1 marks commits reachable from left, bit 2 those from right
+        flags = {left: 1, right: 2}
+        queue = [(-self.commit(oid).time, n, oid)
+                 for n, oid in enumerate((left, right))]
+        heapq.heapify(queue)
+        counter = 2
+        counts = [0, 0, 0, 0]
+        while any(flags[oid] != 3 for _, _, oid in queue):
+            _, _, oid = heapq.heappop(queue)
+            flag = flags[oid]
+            counts[flag] += 1
+            for parent in self.commit(oid).parents:
+                old_flag = flags.get(parent, 0)
+                if old_flag | flag != old_flag:
+                    flags[parent] = old_flag | flag
+                    if not old_flag:
+                        heapq.heappush(queue, (-self.commit(parent).time,
+                                               counter, parent))
+                        counter += 1
+        return counts[1], counts[2]
+
+    def read_index(self):
+        """Read stat data of entries in the git index and its cached root tree.
+
+        Returns
+        -------
+        entries : list of tuple
+            One (mtime seconds, mtime nanoseconds, inode, mode, size, path)
+            tuple per index entry, with the path as bytes
+        root_tree : string or None
+            Tree oid of whole index as cached by git, or None if not valid
+        mtime : tuple of int
+            Modification time of index file as (seconds, nanoseconds), see
+            :func:`_stat_mtime`
+
+        Raises
+        ------
+        GitReaderError
+            If the index does not exist, has an unsupported format or
+            contains conflicts, submodules or entries not checked out
+
+        """
+        index_path = os.path.join(self.git_dir, 'index')
+        try:
+            with open(index_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except (IOError, OSError):
+            raise GitReaderError('Could not read git index')
+        mtime = _stat_mtime(st)
+        signature, version, num_entries = struct.unpack('>4sII', data[:12])
+        if signature != b'DIRC' or version not in (2, 3):
+            raise GitReaderError('Unsupported git index version %d' % (version,))
+        entries = []
+        pos = 12
+        for _ in range(num_entries):
+            (_, _, mtime_s, mtime_ns, _, ino, mode, _, _, size, _, flags) = \
+                struct.unpack('>10I20sH', data[pos:pos + 62])
+            if flags & 0x4000:
+                # Extended flags: skip-worktree or intent-to-add
+                raise GitReaderError('Index has skip-worktree or i-t-a entries')
+            if flags & 0x8000:
+                raise GitReaderError('Index has assume-unchanged entries')
+            if flags & 0x3000:
+                raise GitReaderError('Index has unmerged entries')
+            if mode & 0o170000 == 0o160000:
+                raise GitReaderError('Index has submodules')
+            name_end = data.index(b'\x00', pos + 62)
+            entries.append((mtime_s, mtime_ns, ino, mode, size,
+                            data[pos + 62:name_end]))
+            # Entries are padded with 1-8 NULs to a multiple of 8 bytes
+            pos += (name_end - pos + 8) & ~7
+        # Look for cache tree extension, which caches tree oid of index
+        root_tree = None
+        while pos + 8 <= len(data) - 20:
+            ext, size = struct.unpack('>4sI', data[pos:pos + 8])
+            if ext == b'TREE':
+                # Root entry: "<empty path>\0<entry count> <subtrees>\n<oid>"
+                path, _, rest = data[pos + 8:pos + 8 + size].partition(b'\x00')
+                counts, _, rest = rest.partition(b'\n')
+                if not path and not counts.startswith(b'-'):
+                    root_tree = _hex(rest[:20])
+            elif b'A' <= ext[0:1] <= b'Z':
+                pass
+            else:
+                raise GitReaderError('Index has required extension %r' % (ext,))
+            pos += 8 + size
+        return entries, root_tree, mtime
+
+    def worktree_matches_head(self, work_tree):
+        """Check whether index and working tree are unchanged relative to HEAD.
+
+        This relies purely on the index (which caches the tree of its
+        contents and the stat data of its files), so it does not read any
+        file contents. A True answer is trustworthy, but False only means
+        that stat data differs and a proper content check is needed.
+
+        Raises
+        ------
+        GitReaderError
+            If the index has features that prevent the check
+
+        """
+        entries, root_tree, index_mtime = self.read_index()
+        if root_tree is None or root_tree != self.commit(self.head()[1]).tree:
+            return False
+        for entry in entries:
+            if not _index_entry_matches(entry, work_tree, index_mtime):
+                return False
+        return True
+
+    def _default_abbrev(self):
+        """Minimum length of abbreviated object ids, from config or estimate."""
+        if self.abbrev is not None:
+            return self.abbrev
+        # Git's automatic abbreviation length based on packed object count
+        count = sum(pack.num_objects for pack in self.packs)
+        return max(MIN_ABBREV, (count.bit_length() + 1) // 2)
+
+    def abbreviate(self, oid):
+        """Shortest unique abbreviation of hex `oid`, like git's `%h`."""
+        length = self._default_abbrev()
+        binary = binascii.unhexlify(oid)
+        for pack in self.packs:
+            n = pack.bisect(binary)
+            for m in range(max(n - 1, 0), min(n + 2, pack.num_objects)):
+                neighbour = pack.name(m)
+                if neighbour != binary:
+                    length = max(length, _common_hex_prefix(neighbour, binary) + 1)
+        try:
+            loose = os.listdir(os.path.join(self.objects_dir, oid[:2]))
+        except OSError:
+            loose = []
+        for name in loose:
+            other = oid[:2] + name
+            if other != oid and len(other) == 40:
+                common = len(os.path.commonprefix([other, oid]))
+                length = max(length, common + 1)
+        return oid[:length]
+
+
+def _stat_mtime(st):
+    """Modification time of stat result `st` as (seconds, nanoseconds).
+
+    The nanoseconds are None if unknown, as the float mtime of Python 2 is
+    too coarse to represent them exactly.
+
+    """
+    if hasattr(st, 'st_mtime_ns'):
+        return divmod(st.st_mtime_ns, 1000000000)
+    return int(st.st_mtime), None
+
+
+def _index_entry_matches(entry, work_tree, index_mtime):
+    """Check whether stat data of index entry matches file in working tree."""
+    (mtime_s, mtime_ns, ino, mode, size, name) = entry
+    try:
+        st = os.lstat(os.path.join(work_tree, name.decode('utf-8')))
+    except (OSError, UnicodeDecodeError):
+        return False
+    st_mtime_s, st_mtime_ns = _stat_mtime(st)
+    # A file modified at or after the time the index was written could have
+    # changed without its stat data changing ("racy git"), so don't trust it
+    # (and only compare whole seconds if the index time is not more precise)
+    index_s, index_ns = index_mtime
+    if mtime_s > index_s or mtime_s == index_s and (index_ns is None or
+                                                    mtime_ns >= index_ns):
+        return False
+    if mode & 0o170000 == 0o120000:
+        file_type_ok = stat.S_ISLNK(st.st_mode)
+    else:
+        file_type_ok = (stat.S_ISREG(st.st_mode) and
+                        bool(mode & 0o100) == bool(st.st_mode & 0o100))
+    return (file_type_ok and size == st.st_size & 0xffffffff and
+            mtime_s == st_mtime_s & 0xffffffff and
+            (mtime_ns == 0 or st_mtime_ns is None or mtime_ns == st_mtime_ns) and
+            (ino == 0 or ino == st.st_ino & 0xffffffff))
+
+
+def _common_hex_prefix(a, b):
+    """Number of leading hex digits shared by binary object ids `a` and `b`."""
+    return len(os.path.commonprefix([_hex(a), _hex(b)]))
@@ -0,0 +1,60 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Helpers for building throwaway git repositories in tests."""
+
+import os
+import shutil
+import tempfile
+import subprocess
+
+
+GIT_ENV = {'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+           'GIT_COMMITTER_NAME': 'Test', 'GIT_COMMITTER_EMAIL': 'test@example.com',
+           'GIT_CONFIG_NOSYSTEM': '1', 'HOME': tempfile.gettempdir()}
+
+
+class TempRepo(object):
+    """A git repository in a temporary directory, deleted on cleanup."""
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='katversion-test-')
+        self._time = 1500000000
+        self.git('init', '-q')
+        self.git('config', 'commit.gpgsign', 'false')
+
+    def git(self, *args):
+        env = dict(os.environ)
+        env.update(GIT_ENV)
+        # Give every commit a distinct, increasing timestamp
+        self._time += 10
+        env['GIT_COMMITTER_DATE'] = env['GIT_AUTHOR_DATE'] = \
+            '@%d +0000' % (self._time,)
+        return subprocess.check_output(('git',) + args, cwd=self.path, env=env,
+                                       universal_newlines=True).strip()
+
+    def write(self, filename, text):
+        with open(os.path.join(self.path, filename), 'a') as f:
+            f.write(text)
+
+    def commit(self, filename='file.txt', text='change\n'):
+        self.write(filename, text)
+        self.git('add', filename)
+        self.git('commit', '-q', '-m', 'Change %s' % (filename,))
+        return self.git('rev-parse', 'HEAD')
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
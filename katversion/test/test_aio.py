@@ -0,0 +1,135 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for the asyncio versions of the main functions."""
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+import katversion.version as kv
+from katversion import cache, trace
+
+from repo_helpers import TempRepo
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from katversion import aio
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio module needs Python 3.5')
+class TestAsyncVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.repo.git('tag', 'v1.0')
+        self.repo.commit()
+        self.repo.commit()
+        self.addCleanup(kv.clear_cache)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        # Subprocesses need the loop to be set on Python 3.7 and older
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_same_as_blocking_version(self):
+        for dirty in (False, True):
+            if dirty:
+                self.repo.write('file.txt', 'modified\n')
+            for backend in ('subprocess', 'python', 'batch'):
+                os.environ[kv.GIT_BACKEND_ENV] = backend
+                os.environ[cache.NO_CACHE_ENV] = '1'
+                try:
+                    expected = kv.get_version(self.repo.path)
+                    self.assertTrue(expected.startswith('1.1.dev3+'))
+                    self.assertEqual(
+                        self.run_async(aio.get_version_async(self.repo.path)),
+                        expected)
+                finally:
+                    del os.environ[kv.GIT_BACKEND_ENV]
+                    del os.environ[cache.NO_CACHE_ENV]
+        self.assertEqual(
+            self.run_async(aio.build_info_async('test', self.repo.path)),
+            kv.build_info('test', self.repo.path))
+
+    def test_many_lookups(self):
+        empty = TempRepo()
+        self.addCleanup(empty.cleanup)
+        not_repo = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, not_repo)
+        paths = [self.repo.path, empty.path, not_repo, not_repo + '/missing']
+        versions = self.run_async(aio.get_versions_async(paths, 2))
+        self.assertTrue(versions[self.repo.path].startswith('1.1.dev3+'))
+        # A repo without commits is an error, just like in get_version
+        self.assertTrue(isinstance(versions[empty.path], RuntimeError))
+        self.assertTrue(versions[not_repo].startswith('0.0+unknown'))
+        self.assertTrue(isinstance(versions[paths[3]], ValueError))
+
+    def test_walk_counts_untagged_history(self):
+        untagged = TempRepo()
+        self.addCleanup(untagged.cleanup)
+        for n in range(3):
+            untagged.commit()
+        events = []
+        trace.add_trace_hook(events.append)
+        self.addCleanup(trace.remove_trace_hook, events.append)
+        version = self.run_async(aio.get_version_async(untagged.path))
+        commands = [event['name'] for event in events
+                    if event['kind'] == 'command']
+        # Without version tags the walk covers the history, so don't count it
+        self.assertTrue('log' in commands)
+        self.assertFalse('rev-list' in commands)
+        kv.clear_cache()
+        self.assertEqual(version, kv.get_version(untagged.path))
+
+    @unittest.skipUnless(os.name == 'posix', 'needs a shell script as git')
+    def test_timeout_fallback(self):
+        good_version = kv.get_version(self.repo.path)
+        self.repo.commit()
+        # Replace git by a command that hangs, like git on a stale mount
+        fake_git = os.path.join(self.repo.path, '.git', 'fake-bin', 'git')
+        os.makedirs(os.path.dirname(fake_git))
+        with open(fake_git, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 30\n')
+        os.chmod(fake_git, 0o755)
+        original_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(fake_git) + os.pathsep + original_path
+        self.addCleanup(os.environ.__setitem__, 'PATH', original_path)
+        start = time.time()
+        version = self.run_async(aio.get_version_async(self.repo.path,
+                                                       timeout=0.3))
+        self.assertLess(time.time() - start, 5.0)
+        self.assertEqual(version, good_version)
+        self.repo.write(kv.VERSION_FILE, '4.2\n')
+        self.assertEqual(self.run_async(
+            aio.get_version_async(self.repo.path, timeout=0.3)), '4.2')
+
+    def test_loop_errors_are_not_hidden(self):
+        def broken_loop(*args, **kwargs):
+            raise RuntimeError('Cannot add child handler')
+        original = asyncio.create_subprocess_exec
+        asyncio.create_subprocess_exec = broken_loop
+        self.addCleanup(setattr, asyncio, 'create_subprocess_exec', original)
+        # A failure to run git is not mistaken for a missing git repository
+        self.assertRaises(RuntimeError, self.run_async,
+                          aio.get_version_async(self.repo.path))
@@ -0,0 +1,199 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for the build module."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import katversion.version as kv
+from katversion import build
+from katversion.build import (patch_init_py, patch_init_pys,
+                              distribution_version, write_build_manifest)
+
+
+LAZY_INIT_PY = '''\
+"""My package."""
+
+from .core import stuff
+
+# BEGIN VERSION CHECK
+# Get package version when locally imported from repo or via -e develop install
+try:
+    import katversion as _katversion
+except ImportError:  # pragma: no cover
+    import time as _time
+    __version__ = "0.0+unknown.{}".format(_time.strftime('%Y%m%d%H%M'))
+else:  # pragma: no cover
+    _katversion.install_lazy_version(globals())
+# END VERSION CHECK
+
+CONSTANT = 1
+'''
+
+
+class TestPatchInitPy(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.init_py = os.path.join(self.tempdir, '__init__.py')
+
+    def patch(self, contents, version='1.2'):
+        with open(self.init_py, 'w') as f:
+            f.write(contents)
+        patch_init_py(self.init_py, version)
+        with open(self.init_py) as f:
+            return f.read()
+
+    def test_lazy_block(self):
+        patched = self.patch(LAZY_INIT_PY)
+        self.assertFalse('katversion as _katversion' in patched)
+        self.assertFalse('VERSION CHECK' in patched)
+        self.assertTrue("\n# Automatically added by katversion\n"
+                        "__version__ = '1.2'\n\nCONSTANT = 1\n" in patched)
+        self.assertTrue(patched.startswith('"""My package."""\n\n'))
+        # Patching again changes nothing
+        self.assertEqual(self.patch(patched), patched)
+
+    def test_no_block(self):
+        patched = self.patch('CONSTANT = 1\n')
+        self.assertEqual(patched, "CONSTANT = 1\n\n# Automatically added by "
+                                  "katversion\n__version__ = '1.2'\n")
+
+    def test_unchanged_file_is_not_rewritten(self):
+        patched = self.patch(LAZY_INIT_PY)
+        # Whole seconds survive the float round trip of os.utime on Python 2
+        old = int(os.stat(self.init_py).st_mtime) - 100
+        os.utime(self.init_py, (old, old))
+        self.assertFalse(patch_init_py(self.init_py, '1.2'))
+        self.assertEqual(int(os.stat(self.init_py).st_mtime), old)
+        self.assertTrue(patch_init_py(self.init_py, '1.3'))
+        with open(self.init_py) as f:
+            self.assertTrue(f.read().startswith(patched))
+
+    def test_many_packages(self):
+        init_pys = []
+        for n in range(2 * build.PARALLEL_PATCH_THRESHOLD):
+            init_pys.append(os.path.join(self.tempdir, '%d.py' % (n,)))
+            with open(init_pys[-1], 'w') as f:
+                f.write(LAZY_INIT_PY)
+        patch_init_pys(init_pys, '2.0')
+        for init_py in init_pys:
+            with open(init_py) as f:
+                self.assertTrue("__version__ = '2.0'\n" in f.read())
+
+
+class FakeMetadata(object):
+    version = None
+
+
+class FakeDistribution(object):
+
+    def __init__(self):
+        self.metadata = FakeMetadata()
+
+
+class TestDistributionVersion(unittest.TestCase):
+
+    def test_resolved_once(self):
+        calls = []
+        original = build._get_version_and_source
+
+        def fake_get_version_and_source():
+            calls.append(1)
+            return 'scm', '1.0.dev3+master.gabcdef0'
+        build._get_version_and_source = fake_get_version_and_source
+        self.addCleanup(setattr, build, '_get_version_and_source', original)
+        dist = FakeDistribution()
+        for _ in range(3):
+            self.assertEqual(distribution_version(dist),
+                             '1.0.dev3+master.gabcdef0')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(dist.katversion_source, 'scm')
+        self.assertEqual(dist.metadata.version, '1.0.dev3+master.gabcdef0')
+        self.assertEqual(dist.katversion_version_object.dev, 3)
+
+    def test_explicit_version(self):
+        original = build._get_version_and_source
+
+        def fake_get_version_and_source():
+            info = {'tag': [1, 0], 'tagged_head': False, 'branch': 'master',
+                    'commit': 'abcdef0', 'num_commits': 3}
+            return 'scm', kv.Version.from_git_info(info, False)
+        build._get_version_and_source = fake_get_version_and_source
+        self.addCleanup(setattr, build, '_get_version_and_source', original)
+        # Our own setup.py passes version=get_version(), which keeps git details
+        dist = FakeDistribution()
+        dist.metadata.version = '1.1.dev3+master.abcdef0'
+        self.assertEqual(distribution_version(dist), '1.1.dev3+master.abcdef0')
+        self.assertEqual(dist.katversion_source, 'scm')
+        self.assertEqual(dist.katversion_version_object.commit, 'abcdef0')
+        dist = FakeDistribution()
+        dist.metadata.version = '2.0'
+        self.assertEqual(distribution_version(dist), '2.0')
+        self.assertEqual(dist.katversion_source, 'setup.py')
+        self.assertEqual(dist.katversion_version_object.commit, None)
+
+
+class TestBuildManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        info = {'tag': [1, 2], 'tagged_head': False, 'branch': 'master',
+                'commit': 'abc1234', 'num_commits': 7}
+        self.version = kv.Version.from_git_info(info, False)
+
+    def test_runtime_build_info(self):
+        self.assertTrue(write_build_manifest(self.tempdir, self.version, 'scm'))
+        manifest = kv.get_build_manifest(self.tempdir)
+        self.assertEqual(manifest['version'], '1.3.dev7+master.abc1234')
+        self.assertEqual(manifest['version_info'], (1, 3, 'dev7+master.abc1234'))
+        self.assertEqual((manifest['branch'], manifest['commit'],
+                          manifest['dirty']), ('master', 'abc1234', False))
+        self.assertEqual(kv.build_info('pkg', self.tempdir),
+                         ('pkg', 1, 3, 'dev7+master.abc1234'))
+        version = kv.get_version_object(self.tempdir)
+        self.assertEqual((version, version.commit), (self.version, 'abc1234'))
+        # Manifest for the same version (e.g. from sdist) is kept as is
+        plain = kv.Version.parse(str(self.version))
+        self.assertFalse(write_build_manifest(self.tempdir, plain, 'unpacked_sdist'))
+        self.assertEqual(kv.get_build_manifest(self.tempdir), manifest)
+        self.assertTrue(write_build_manifest(self.tempdir,
+                                             kv.Version.parse('1.3'), 'file'))
+        self.assertEqual(kv.get_version(self.tempdir), '1.3')
+
+    def test_manifest_of_module_is_not_imported(self):
+        # Two copies of a package whose code must not run, one on sys.path
+        for copy, version in (('installed', '1.3'), ('other', '2.0')):
+            package_dir = os.path.join(self.tempdir, copy, 'kvmanifestpkg')
+            os.makedirs(package_dir)
+            with open(os.path.join(package_dir, '__init__.py'), 'w') as f:
+                f.write("raise AssertionError('package code ran')\n")
+            write_build_manifest(package_dir, kv.Version.parse(version), 'scm')
+        sys.path.insert(0, os.path.join(self.tempdir, 'installed'))
+        self.addCleanup(sys.path.remove, sys.path[0])
+        manifest = kv.get_build_manifest(module='kvmanifestpkg.core')
+        self.assertEqual(manifest['version'], '1.3')
+        # The package at path takes precedence over the one on sys.path
+        other_dir = os.path.join(self.tempdir, 'other', 'kvmanifestpkg')
+        manifest = kv.get_build_manifest(other_dir, 'kvmanifestpkg.core')
+        self.assertEqual(manifest['version'], '2.0')
+        self.assertFalse('kvmanifestpkg' in sys.modules)
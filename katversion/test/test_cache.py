@@ -0,0 +1,254 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for the version caches."""
+
+import os
+import sys
+import json
+import time
+import unittest
+import threading
+import subprocess
+
+import katversion.version as kv
+from katversion import cache
+
+from repo_helpers import TempRepo
+
+
+def restore_env(name, value):
+    """Set environment variable `name` back to `value` (unset if None)."""
+    if value is None:
+        os.environ.pop(name, None)
+    else:
+        os.environ[name] = value
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.cache_file = os.path.join(self.repo.path, '.git', cache.CACHE_FILENAME)
+        self.addCleanup(restore_env, cache.NO_CACHE_ENV,
+                        os.environ.pop(cache.NO_CACHE_ENV, None))
+
+    def tamper(self, **changes):
+        """Modify the cached info to check whether it is used."""
+        with open(self.cache_file) as f:
+            record = json.load(f)
+        record['info'].update(changes)
+        with open(self.cache_file, 'w') as f:
+            json.dump(record, f)
+
+    def test_warm_lookup_and_invalidation(self):
+        version = kv.get_git_version(self.repo.path)
+        self.assertTrue(os.path.isfile(self.cache_file))
+        self.tamper(num_commits=999)
+        self.assertTrue('.dev999+' in kv.get_git_version(self.repo.path))
+        # New tag and new commit both invalidate the cache
+        self.repo.git('tag', 'v1.0')
+        self.assertEqual(kv.get_git_version(self.repo.path), '1.0')
+        self.repo.commit()
+        self.assertTrue('1.1.dev2+' in kv.get_git_version(self.repo.path))
+        self.assertNotEqual(kv.get_git_version(self.repo.path), version)
+
+    def test_corrupt_cache(self):
+        version = kv.get_git_version(self.repo.path)
+        with open(self.cache_file, 'w') as f:
+            f.write('{"key": [1, "refs/heads/mas')
+        self.assertEqual(kv.get_git_version(self.repo.path), version)
+
+    def test_deepen_shallow_clone(self):
+        for n in range(2):
+            self.repo.commit()
+        clone = TempRepo()
+        self.addCleanup(clone.cleanup)
+        clone.git('fetch', '-q', '--depth', '1', 'file://' + self.repo.path,
+                  'master')
+        clone.git('reset', '-q', '--hard', 'FETCH_HEAD')
+        self.assertTrue('.dev1+' in kv.get_git_version(clone.path))
+        # Deepening adds history but leaves HEAD and the refs alone
+        clone.git('fetch', '-q', '--deepen', '1', 'file://' + self.repo.path,
+                  'master')
+        self.assertTrue('.dev2+' in kv.get_git_version(clone.path))
+
+    def test_deepen_shallow_clone_below_tag(self):
+        for n in range(3):
+            self.repo.commit()
+        self.repo.git('tag', '0.9')
+        self.repo.commit()
+        clone = TempRepo()
+        self.addCleanup(clone.cleanup)
+        url = 'file://' + self.repo.path
+        clone.git('fetch', '-q', '--depth', '2', url, 'master', 'tag', '0.9')
+        clone.git('reset', '-q', '--hard', 'FETCH_HEAD')
+        # The walk stops at the tag and the rest of the history is counted
+        version = kv.get_git_version(clone.path)
+        self.assertTrue(version.startswith('0.10.dev'))
+        clone.git('fetch', '-q', '--deepen', '3', url, 'master')
+        deeper = kv.get_git_version(clone.path)
+        self.assertNotEqual(deeper, version)
+        os.environ[cache.NO_CACHE_ENV] = '1'
+        try:
+            self.assertEqual(kv.get_git_version(clone.path), deeper)
+        finally:
+            del os.environ[cache.NO_CACHE_ENV]
+
+    def test_bypass(self):
+        kv.get_git_version(self.repo.path)
+        self.tamper(num_commits=999)
+        os.environ[cache.NO_CACHE_ENV] = '1'
+        try:
+            self.assertFalse('.dev999+' in kv.get_git_version(self.repo.path))
+        finally:
+            del os.environ[cache.NO_CACHE_ENV]
+
+
+class TestMemoisation(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.addCleanup(restore_env, cache.NO_CACHE_ENV,
+                        os.environ.pop(cache.NO_CACHE_ENV, None))
+        # Count the number of times that git history is actually queried
+        self.queries = 0
+        original_git_info = kv._git_info
+
+        def counting_git_info(*args, **kwargs):
+            self.queries += 1
+            return original_git_info(*args, **kwargs)
+        kv._git_info = counting_git_info
+        self.addCleanup(setattr, kv, '_git_info', original_git_info)
+        self.addCleanup(kv.clear_cache)
+
+    def test_repeat_calls(self):
+        version = kv.get_version(self.repo.path)
+        self.assertEqual(kv.get_version(self.repo.path), version)
+        self.assertEqual(kv.build_info('test', self.repo.path)[1:3], (0, 1))
+        self.assertEqual(self.queries, 1)
+        kv.clear_cache()
+        self.assertEqual(kv.get_version(self.repo.path), version)
+        self.assertEqual(self.queries, 2)
+
+    def test_settings_changes_invalidate(self):
+        self.repo.git('tag', 'pkg-v3.1')
+        self.repo.write('file.txt', 'dirty\n')
+        os.environ[kv.DIRTY_CHECK_ENV] = 'none'
+        self.addCleanup(os.environ.pop, kv.DIRTY_CHECK_ENV)
+        self.assertTrue(kv.get_version(self.repo.path).startswith('0.1.dev1+'))
+        os.environ[kv.TAG_PATTERN_ENV] = r'pkg-v(\d+(\.\d+)*)$'
+        self.addCleanup(os.environ.pop, kv.TAG_PATTERN_ENV)
+        self.assertEqual(kv.get_version(self.repo.path), '3.1')
+        os.environ[kv.DIRTY_CHECK_ENV] = 'git'
+        self.assertTrue(kv.get_version(self.repo.path).endswith('.dirty'))
+
+    def test_repo_changes_invalidate(self):
+        version = kv.get_version(self.repo.path)
+        self.repo.commit()
+        version2 = kv.get_version(self.repo.path)
+        self.assertNotEqual(version2, version)
+        self.repo.git('checkout', '-q', '-b', 'other')
+        self.assertTrue('+other.' in kv.get_version(self.repo.path))
+        self.repo.git('tag', '2.0')
+        self.assertEqual(kv.get_version(self.repo.path), '2.0')
+        self.assertEqual(self.queries, 4)
+
+
+@unittest.skipIf(cache.fcntl is None, 'needs advisory file locks')
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.git_dir = kv.find_git_dir(self.repo.path)
+        self.addCleanup(kv.clear_cache)
+
+    def test_later_calls_compute_again(self):
+        self.assertEqual(cache.single_flight(self.git_dir, lambda: [1, 'a']),
+                         [1, 'a'])
+        # Only calls that waited for the lock owner share its value
+        self.assertEqual(cache.single_flight(self.git_dir, lambda: 2), 2)
+        self.assertEqual(cache.single_flight(self.git_dir, lambda: 3, 'other'), 3)
+
+    def test_waiters_use_result_of_lock_owner(self):
+        results = []
+
+        def slow_compute():
+            time.sleep(0.3)
+            return 'first'
+
+        def no_compute():
+            raise AssertionError('value should be shared')
+        owner = threading.Thread(target=lambda: results.append(
+            cache.single_flight(self.git_dir, slow_compute)))
+        owner.start()
+        time.sleep(0.05)
+        results.append(cache.single_flight(self.git_dir, no_compute))
+        owner.join()
+        self.assertEqual(results, ['first', 'first'])
+
+    def test_hung_lock_owner(self):
+        with open(os.path.join(self.git_dir, cache.LOCK_FILENAME), 'a') as f:
+            cache.fcntl.flock(f.fileno(), cache.fcntl.LOCK_EX)
+            start = time.time()
+            self.assertEqual(cache.single_flight(self.git_dir, lambda: 'mine',
+                                                 wait=0.2), 'mine')
+            self.assertLess(time.time() - start, 2.0)
+        # The lock is free again once its owner is gone
+        self.assertEqual(cache.single_flight(self.git_dir, lambda: 'new',
+                                             'other'), 'new')
+
+    def run_processes(self, num_processes):
+        """Get version in separate processes, also counting their git commands."""
+        script = ('import katversion.version as kv, katversion.trace as t; '
+                  'n = []; t.add_trace_hook(lambda e: e["kind"] == "command" '
+                  'and n.append(e)); v = kv.get_version(%r); '
+                  'print("%%s %%d" %% (v, len(n)))' % (self.repo.path,))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(kv.__file__))
+        env.pop(cache.NO_CACHE_ENV, None)
+        # Don't pass on the lock held by the test (Python 2 does by default)
+        return [subprocess.Popen([sys.executable, '-c', script], env=env,
+                                 stdout=subprocess.PIPE, close_fds=True,
+                                 universal_newlines=True)
+                for n in range(num_processes)]
+
+    def test_concurrent_processes(self):
+        # Hold the lock until all processes are waiting for it
+        with open(os.path.join(self.git_dir, cache.LOCK_FILENAME), 'a') as f:
+            cache.fcntl.flock(f.fileno(), cache.fcntl.LOCK_EX)
+            procs = self.run_processes(4)
+            time.sleep(1.0)
+        outputs = [proc.communicate()[0].split() for proc in procs]
+        self.assertEqual(len(set(version for version, _ in outputs)), 1)
+        # Only one process ran git commands
+        self.assertEqual(sorted(int(n) > 0 for _, n in outputs),
+                         [False, False, False, True])
+
+    def test_edit_between_processes(self):
+        self.repo.git('tag', '1.0')
+        output = self.run_processes(1)[0].communicate()[0].split()
+        self.assertEqual(output[0], '1.0')
+        # The next process must not reuse the clean version of the first one
+        self.repo.write('file.txt', 'modified\n')
+        output = self.run_processes(1)[0].communicate()[0].split()
+        self.assertTrue(output[0].endswith('.dirty'))
@@ -0,0 +1,72 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for the git filter process."""
+
+import io
+import unittest
+
+from katversion.gitfilter import (filter_process, write_packet_text,
+                                  write_packet_content, read_packet_text,
+                                  read_packet_content, FilterProtocolError)
+
+
+def fake_git_session(requests):
+    """Input that git sends to filter process for list of (command, path)."""
+    stream = io.BytesIO()
+    write_packet_text(stream, ['git-filter-client', 'version=2'])
+    write_packet_text(stream, ['capability=clean', 'capability=smudge'])
+    for command, path in requests:
+        write_packet_text(stream, ['command=' + command, 'pathname=' + path])
+        write_packet_content(stream, b'placeholder\n')
+    stream.seek(0)
+    return stream
+
+
+class TestFilterProcess(unittest.TestCase):
+
+    def test_smudge_session(self):
+        calls = []
+
+        def get_version():
+            calls.append(1)
+            return '1.2.dev3+master.abcdef0'
+        requests = [('smudge', '___version___'), ('clean', 'other'),
+                    ('smudge', 'pkg/___version___')]
+        stdout = io.BytesIO()
+        filter_process(get_version, fake_git_session(requests), stdout)
+        stdout.seek(0)
+        self.assertEqual(read_packet_text(stdout),
+                         ['git-filter-server', 'version=2'])
+        self.assertEqual(read_packet_text(stdout), ['capability=smudge'])
+        for command, path in requests:
+            if command == 'smudge':
+                self.assertEqual(read_packet_text(stdout), ['status=success'])
+                self.assertEqual(read_packet_content(stdout),
+                                 b'1.2.dev3+master.abcdef0\n')
+                self.assertEqual(read_packet_text(stdout), [])
+            else:
+                self.assertEqual(read_packet_text(stdout), ['status=error'])
+        self.assertEqual(stdout.read(), b'')
+        # Version is only computed once
+        self.assertEqual(len(calls), 1)
+
+    def test_bad_handshake(self):
+        stream = io.BytesIO()
+        write_packet_text(stream, ['git-filter-client', 'version=1'])
+        stream.seek(0)
+        self.assertRaises(FilterProtocolError, filter_process,
+                          lambda: '1.0', stream, io.BytesIO())
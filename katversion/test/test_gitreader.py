@@ -0,0 +1,236 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for the pure-Python git reader."""
+
+import os
+import time
+import unittest
+
+import katversion.version as kv
+from katversion import gitbatch, trace
+from katversion.gitreader import GitReaderError, GitRepository, apply_delta
+
+from repo_helpers import TempRepo
+
+
+class TestGitReader(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+
+    def assertBackendsAgree(self):
+        path = self.repo.path
+        expected = kv._git_info_subprocess(path)
+        git_dir = kv.find_git_dir(path)
+        self.assertEqual(kv._git_info_in_process(git_dir), expected)
+        return kv._format_git_version(expected, kv._git_is_dirty(path))
+
+    def test_history_with_tags_and_merges(self):
+        for n in range(5):
+            self.repo.commit()
+        self.repo.git('tag', 'v1.2', 'HEAD~3')
+        self.repo.git('tag', '-a', '1.3', '-m', 'Release 1.3', 'HEAD~1')
+        self.repo.git('tag', 'not-a-version')
+        self.assertBackendsAgree()
+        self.repo.git('checkout', '-q', '-b', 'feature/shiny', 'HEAD~2')
+        self.repo.commit('other.txt')
+        self.assertTrue('+feature.shiny.' in self.assertBackendsAgree())
+        self.repo.git('checkout', '-q', 'master')
+        self.repo.git('merge', '-q', '--no-edit', 'feature/shiny')
+        self.assertBackendsAgree()
+        # Move everything into a pack file and packed-refs
+        self.repo.git('gc', '-q')
+        self.assertBackendsAgree()
+        self.repo.git('checkout', '-q', '1.3')
+        self.assertEqual(self.assertBackendsAgree(), '1.3')
+        self.repo.write('file.txt', 'dirty\n')
+        self.assertTrue(self.assertBackendsAgree().endswith('.dirty'))
+
+    def test_tag_named_like_branch(self):
+        self.repo.commit()
+        self.repo.git('tag', 'master')
+        self.assertTrue('+heads.master.' in self.assertBackendsAgree())
+        git_dir = kv.find_git_dir(self.repo.path)
+        self.assertEqual(kv._git_info_subprocess(self.repo.path, git_dir)['branch'],
+                         'heads.master')
+
+    def test_stops_at_tag_and_reuses_count(self):
+        for n in range(20):
+            self.repo.commit()
+        self.repo.git('tag', '1.0', 'HEAD~2')
+        git_dir = kv.find_git_dir(self.repo.path)
+        self.assertBackendsAgree()
+        self.repo.commit()
+        reads = []
+        original_read_object = GitRepository.read_object
+
+        def counting_read_object(repo, oid):
+            reads.append(oid)
+            return original_read_object(repo, oid)
+        GitRepository.read_object = counting_read_object
+        self.addCleanup(setattr, GitRepository, 'read_object',
+                        original_read_object)
+        info = kv._git_info_in_process(git_dir)
+        self.assertEqual(info['num_commits'], 21)
+        # Walk to the tag plus a short count from the previous HEAD
+        self.assertLess(len(set(reads)), 10)
+
+    def test_corrupt_object(self):
+        head = self.repo.commit()
+        git_dir = kv.find_git_dir(self.repo.path)
+        loose = os.path.join(git_dir, 'objects', head[:2], head[2:])
+        os.chmod(loose, 0o644)
+        with open(loose, 'wb') as f:
+            f.write(b'not zlib data')
+        self.assertRaises(GitReaderError, kv._git_info_in_process, git_dir)
+
+    def test_untagged(self):
+        self.repo.commit()
+        self.assertEqual(self.assertBackendsAgree()[:10], '0.1.dev1+m')
+
+    def test_unsupported_repository(self):
+        self.repo.commit()
+        self.repo.git('config', 'extensions.worktreeConfig', 'true')
+        git_dir = kv.find_git_dir(self.repo.path)
+        self.assertRaises(GitReaderError, GitRepository, git_dir)
+
+
+class TestBatchBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.addCleanup(gitbatch.close_sessions)
+        self.git_dir = kv.find_git_dir(self.repo.path)
+        self.starts = []
+
+        def record_start(event):
+            if event['kind'] == 'command':
+                self.starts.append(event['name'])
+        trace.add_trace_hook(record_start)
+        self.addCleanup(trace.remove_trace_hook, record_start)
+
+    def assertBackendsAgree(self):
+        self.assertEqual(kv._git_info_in_process(self.git_dir, 'batch'),
+                         kv._git_info_subprocess(self.repo.path))
+
+    def test_history_with_tags_and_merges(self):
+        for n in range(4):
+            self.repo.commit()
+        self.repo.git('tag', '-a', '1.3', '-m', 'Release 1.3', 'HEAD~1')
+        self.repo.git('checkout', '-q', '-b', 'feature', 'HEAD~2')
+        self.repo.commit('other.txt')
+        self.repo.git('checkout', '-q', 'master')
+        self.repo.git('merge', '-q', '--no-edit', 'feature')
+        self.assertBackendsAgree()
+        self.repo.git('gc', '-q')
+        self.assertBackendsAgree()
+
+    def test_session_reuse_and_reconnect(self):
+        self.repo.commit()
+        self.repo.git('tag', '0.1')
+        self.assertBackendsAgree()
+        self.assertEqual(self.starts.count('cat-file'), 2)
+        self.repo.commit()
+        session = gitbatch.get_session(self.git_dir)
+        known_commits = len(session.commits)
+        del self.starts[:]
+        self.assertBackendsAgree()
+        self.assertEqual(self.starts.count('cat-file'), 0)
+        # Only the new commit was read
+        self.assertEqual(len(session.commits), known_commits + 1)
+        # A dead process is replaced on the next request
+        session._procs['batch'].kill()
+        session._procs['batch'].wait()
+        session.commits.clear()
+        self.assertBackendsAgree()
+        self.assertEqual(self.starts.count('cat-file'), 1)
+        session.close()
+        self.assertEqual(session._procs, {})
+        self.assertBackendsAgree()
+
+    def test_shallow_clone(self):
+        for n in range(3):
+            self.repo.commit()
+        clone = TempRepo()
+        self.addCleanup(clone.cleanup)
+        clone.git('fetch', '-q', '--depth', '1', 'file://' + self.repo.path,
+                  'master')
+        clone.git('reset', '-q', '--hard', 'FETCH_HEAD')
+        git_dir = kv.find_git_dir(clone.path)
+        head = clone.git('rev-parse', 'HEAD')
+        info = kv._git_info_in_process(git_dir, 'batch')
+        self.assertEqual(info['num_commits'], 1)
+        self.assertEqual(gitbatch.BatchRepository(git_dir).commit(head).parents, [])
+        # The commit shared by the session keeps its parents
+        session = gitbatch.get_session(git_dir)
+        self.assertEqual(len(session.commits[head].parents), 1)
+        clone.git('fetch', '-q', '--deepen', '1', 'file://' + self.repo.path,
+                  'master')
+        self.assertEqual(len(gitbatch.BatchRepository(git_dir).commit(head).parents),
+                         1)
+
+    def test_idle_timeout(self):
+        self.repo.commit()
+        self.repo.git('tag', '0.1')
+        original_timeout = gitbatch.IDLE_TIMEOUT
+        gitbatch.IDLE_TIMEOUT = 0.2
+        self.addCleanup(setattr, gitbatch, 'IDLE_TIMEOUT', original_timeout)
+        self.assertBackendsAgree()
+        session = gitbatch.get_session(self.git_dir)
+        idle_thread = session._idle_thread
+        self.assertTrue(session._procs)
+        self.assertBackendsAgree()
+        # Each session has a single idle thread, which is reused
+        self.assertTrue(session._idle_thread is idle_thread)
+        idle_thread.join(5.0)
+        self.assertEqual(session._procs, {})
+        self.assertEqual(session._idle_thread, None)
+        self.assertBackendsAgree()
+
+    @unittest.skipUnless(os.name == 'posix', 'needs a shell script as git')
+    def test_time_budget(self):
+        for n in range(3):
+            self.repo.commit()
+        self.repo.git('tag', '0.1', 'HEAD~1')
+        # Replace git by a command that hangs, like git on a stale mount
+        fake_git = os.path.join(self.git_dir, 'fake-bin', 'git')
+        os.makedirs(os.path.dirname(fake_git))
+        with open(fake_git, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 30\n')
+        os.chmod(fake_git, 0o755)
+        original_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(fake_git) + os.pathsep + original_path
+        self.addCleanup(os.environ.__setitem__, 'PATH', original_path)
+        session = gitbatch.get_session(self.git_dir)
+        for func, args in [(kv._git_info_in_process, (self.git_dir, 'batch')),
+                           (session.count_commits, ('HEAD',))]:
+            start = time.time()
+            with kv._TimeBudget(0.3):
+                self.assertRaises(kv.GitTimeoutError, func, *args)
+            self.assertLess(time.time() - start, 5.0)
+        self.assertEqual(session._procs, {})
+
+
+class TestDelta(unittest.TestCase):
+
+    def test_apply_delta(self):
+        base = b'0123456789'
+        # Sizes (10 -> 7), copy 4 bytes at offset 2, insert 'abc'
+        delta = b'\x0a\x07' + b'\x91\x02\x04' + b'\x03abc'
+        self.assertEqual(apply_delta(base, delta), b'2345abc')
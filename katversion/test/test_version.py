@@ -16,8 +16,22 @@
 
 """Tests for the version module."""
 
+import os
+import sys
+import copy
+import pickle
+import time
+import shutil
+import tempfile
 import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 import katversion.version as kv
+from katversion import cache, trace
+
+from repo_helpers import TempRepo
 
 
 class TestVersion(unittest.TestCase):
@@ -29,3 +43,443 @@ class TestVersion(unittest.TestCase):
         for ver, test_verlist in t_ver.items():
             verlist = kv._sane_version_list(ver.split(".", 2))
             self.assertEquals(verlist, test_verlist)
+
+    def test_iter_cmd_stops_early(self):
+        script = 'import itertools\nfor n in itertools.count(): print(n)'
+        lines = kv.iter_cmd(None, sys.executable, '-c', script)
+        self.assertEqual([next(lines) for n in range(3)], ['0', '1', '2'])
+        # Closing the iterator kills the (otherwise endless) process
+        lines.close()
+        output = list(kv.iter_cmd(None, sys.executable, '-c', 'print(42)'))
+        self.assertEqual(output, ['42'])
+
+    def test_normalised(self):
+        t_ver = {"1.1.dev34+new.shiny.feature.gfa973da":
+                 "1.1.dev34+new.shiny.feature.gfa973da",
+                 "v2.4": "2.4",
+                 "1!2.0RC1.POST2-dev3+UBUNTU-01": "1!2.0rc1.post2.dev3+ubuntu.1",
+                 "1.0-1": "1.0.post1",
+                 "1.0.alpha": "1.0a0",
+                 "0.0+unknown.git.201402031023": "0.0+unknown.git.201402031023",
+                 "V1.not_pep440+Weird_Branch": "1.not_pep440+weird.branch"}
+        for ver, norm_ver in t_ver.items():
+            self.assertEqual(kv.normalised(ver), norm_ver)
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'Needs module __getattr__')
+    def test_install_lazy_version(self):
+        calls = []
+        original_get_version = kv.get_version
+
+        def fake_get_version(path=None, module=None):
+            calls.append(path)
+            return '1.2'
+        kv.get_version = fake_get_version
+        self.addCleanup(setattr, kv, 'get_version', original_get_version)
+        namespace = {'__name__': 'pkg', '__path__': ['/path/to/pkg']}
+        kv.install_lazy_version(namespace)
+        self.assertEqual(calls, [])
+        self.assertEqual(namespace['__getattr__']('__version__'), '1.2')
+        self.assertEqual(namespace['__version__'], '1.2')
+        self.assertEqual(calls, ['/path/to/pkg'])
+        self.assertRaises(AttributeError, namespace['__getattr__'], 'other')
+
+
+class TestManyVersions(unittest.TestCase):
+
+    def test_get_versions(self):
+        repos = [TempRepo() for n in range(3)]
+        for n, repo in enumerate(repos):
+            self.addCleanup(repo.cleanup)
+            repo.commit()
+            repo.git('tag', '1.%d' % (n,))
+        paths = [repo.path for repo in repos] + ['/does/not/exist']
+        versions = kv.get_versions(paths, max_workers=2)
+        self.assertEqual(set(versions), set(paths))
+        for n, repo in enumerate(repos):
+            self.assertEqual(versions[repo.path], '1.%d' % (n,))
+        self.assertTrue(isinstance(versions['/does/not/exist'], ValueError))
+
+
+class TestDirtyCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.repo.commit('other.txt')
+        self.addCleanup(os.environ.pop, kv.DIRTY_CHECK_ENV, None)
+
+    def is_dirty(self, mode):
+        os.environ[kv.DIRTY_CHECK_ENV] = mode
+        return kv._git_is_dirty(self.repo.path, kv._find_git_dir(self.repo.path))
+
+    def test_modes(self):
+        for mode in ('git', 'index', 'status', 'none'):
+            self.assertFalse(self.is_dirty(mode))
+        self.repo.write('file.txt', 'unstaged\n')
+        for mode in ('git', 'index', 'status'):
+            self.assertTrue(self.is_dirty(mode))
+        self.assertFalse(self.is_dirty('none'))
+        self.repo.git('add', 'file.txt')
+        for mode in ('git', 'index', 'status'):
+            self.assertTrue(self.is_dirty(mode))
+
+    def test_index_mode_trusts_stat_data(self):
+        # Backdate files so that index is not racy, and refresh its stat data
+        old = time.time() - 100
+        for filename in ('file.txt', 'other.txt'):
+            os.utime(os.path.join(self.repo.path, filename), (old, old))
+        self.repo.git('update-index', '--refresh')
+
+        def no_git(*args):
+            raise AssertionError('git should not be called')
+        original_run_cmd_status = kv.run_cmd_status
+        kv.run_cmd_status = no_git
+        self.addCleanup(setattr, kv, 'run_cmd_status', original_run_cmd_status)
+        self.assertFalse(self.is_dirty('index'))
+
+
+class TestVersionObject(unittest.TestCase):
+
+    def test_ordering(self):
+        versions = ['0.9', '1.0.dev1', '1.0a2.dev3', '1.0a2', '1.0rc1', '1.0',
+                    '1.0+abc', '1.0.post1', '1.1.dev3+master.abc1234', '1!0.1']
+        parsed = [kv.Version.parse(v) for v in reversed(versions)]
+        self.assertEqual([str(v) for v in sorted(parsed)], versions)
+        self.assertEqual(kv.Version.parse('v1.0.0'), kv.Version.parse('1.0'))
+        self.assertEqual(len(set(parsed + [kv.Version((1, 0, 0))])), len(parsed))
+        self.assertTrue(kv.Version.parse('1.2') < '1.10')
+        self.assertTrue(kv.Version.parse('not a version') < '0.0')
+
+    def test_from_git_info(self):
+        info = {'tag': [1, 2], 'tagged_head': True, 'branch': 'Feature.X',
+                'commit': 'abc1234', 'num_commits': 7}
+        release = kv.Version.from_git_info(info, False)
+        self.assertEqual(str(release), '1.2')
+        self.assertTrue(release.is_release)
+        dev = kv.Version.from_git_info(info, True)
+        self.assertEqual(str(dev), '1.3.dev7+feature.x.abc1234.dirty')
+        self.assertEqual((dev.release, dev.dev), ((1, 3), 7))
+        self.assertEqual(dev.version_list,
+                         [None, 1, 3, 'dev7+feature.x.abc1234.dirty'])
+        self.assertTrue(release < dev)
+        self.assertRaises(AttributeError, setattr, dev, 'dev', 8)
+        # The version string matches that of normalised() in all cases
+        info.update(branch='odd..branch', tagged_head=False)
+        self.assertEqual(str(kv.Version.from_git_info(info, False)),
+                         kv.normalised('1.3.dev7+odd..branch.abc1234'))
+
+    def test_pickle_and_copy(self):
+        info = {'tag': [1, 2], 'tagged_head': False, 'branch': 'master',
+                'commit': 'abc1234', 'num_commits': 7}
+        versions = [kv.Version.from_git_info(info, True),
+                    kv.Version.parse('2!1.0rc1.post2'),
+                    kv.Version.parse('not a version')]
+        for version in versions:
+            for other in (pickle.loads(pickle.dumps(version)),
+                          copy.copy(version), copy.deepcopy(version)):
+                self.assertEqual(str(other), str(version))
+                self.assertEqual(other.sort_key, version.sort_key)
+                self.assertEqual((other.branch, other.commit, other.dirty),
+                                 (version.branch, version.commit, version.dirty))
+                self.assertRaises(AttributeError, setattr, other, 'dev', 8)
+
+
+class TestManyVersionStrings(unittest.TestCase):
+
+    VERSIONS = ['1.1.dev34+new.shiny.feature.gfa973da', 'V1.0', '01.2',
+                '0.0+unknown.git.201402031023', '1.0.DEV1', '1.1', '1.0rc1',
+                '1.1.dev34+Master.007', 'not a version', '1.0.dev2+master.abc']
+
+    def test_normalise_many(self):
+        self.assertEqual(kv.normalise_many(self.VERSIONS),
+                         [kv.normalised(v) for v in self.VERSIONS])
+        # Fast path gives the same result as the full parser
+        for version in self.VERSIONS:
+            self.assertEqual(kv.parse_version(version),
+                             kv.Version.parse(version))
+            self.assertEqual(str(kv.parse_version(version)),
+                             kv.normalised(version))
+
+    def test_sort_versions(self):
+        self.assertEqual(kv.sort_versions(self.VERSIONS, reverse=True), [
+            '01.2', '1.1', '1.1.dev34+new.shiny.feature.gfa973da',
+            '1.1.dev34+Master.007', 'V1.0', '1.0rc1',
+            '1.0.dev2+master.abc', '1.0.DEV1', '0.0+unknown.git.201402031023',
+            'not a version'])
+
+
+class TestGitQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.commands = []
+        original_popen = kv.Popen
+
+        def recording_popen(cmd, *args, **kwargs):
+            self.commands.append(cmd[1])
+            return original_popen(cmd, *args, **kwargs)
+        kv.Popen = recording_popen
+        self.addCleanup(setattr, kv, 'Popen', original_popen)
+
+    def test_at_most_two_history_queries(self):
+        self.repo.commit()
+        self.repo.git('checkout', '-q', '-b', 'feature/x')
+        self.repo.commit()
+        git_dir = kv.find_git_dir(self.repo.path)
+        info = kv._git_info_subprocess(self.repo.path, git_dir)
+        self.assertEqual(self.commands, ['log'])
+        self.assertEqual(info['branch'], 'feature.x')
+        self.assertEqual(info['num_commits'], 2)
+        self.repo.git('tag', 'v1.0', 'HEAD~1')
+        self.repo.git('checkout', '-q', '--detach')
+        del self.commands[:]
+        os.environ[cache.NO_CACHE_ENV] = '1'
+        self.addCleanup(os.environ.pop, cache.NO_CACHE_ENV)
+        info = kv._git_info_subprocess(self.repo.path, git_dir)
+        self.assertEqual(self.commands, ['log', 'rev-list'])
+        self.assertEqual(info['branch'], 'HEAD')
+        self.assertEqual(info['tag'], [1, 0])
+        self.assertEqual(info['num_commits'], 2)
+
+    def test_tag_index(self):
+        self.repo.commit()
+        self.repo.git('tag', 'build-1')
+        self.repo.git('tag', '-a', '-m', 'Release', 'V1.2')
+        self.repo.git('tag', 'v0.9')
+        self.repo.git('tag', 'mypkg-3.4')
+        head = self.repo.git('rev-parse', 'HEAD').strip()
+        git_dir = kv.find_git_dir(self.repo.path)
+        # Tags can be listed in-process or by git, including annotated ones
+        for tag_dir in (git_dir, None):
+            tags = kv._git_tags(self.repo.path, tag_dir)
+            self.assertEqual(sorted(tags), [('V1.2', head), ('build-1', head),
+                                            ('mypkg-3.4', head), ('v0.9', head)])
+        # The first version tag in reverse alphabetical order wins
+        self.assertEqual(kv._build_tag_index(tags, kv.VALID_VERSION),
+                         {head: [0, 9]})
+        os.environ[kv.TAG_PATTERN_ENV] = r'mypkg-(\d+(\.\d+)*)$'
+        self.addCleanup(os.environ.pop, kv.TAG_PATTERN_ENV)
+        self.assertEqual(kv._tag_index(self.repo.path, git_dir), {head: [3, 4]})
+        self.assertEqual(kv.get_version(self.repo.path), '3.4')
+
+    def test_incremental_commit_count(self):
+        git_dir = kv.find_git_dir(self.repo.path)
+        first = self.repo.commit()
+        self.assertEqual(kv._commit_count(self.repo.path, git_dir, first), 1)
+        for _ in range(3):
+            self.repo.commit()
+        self.repo.git('checkout', '-q', '-b', 'side', 'HEAD~2')
+        self.repo.commit('side.txt')
+        self.repo.git('checkout', '-q', 'master')
+        self.repo.git('merge', '-q', '--no-edit', 'side')
+        del self.commands[:]
+        head = self.repo.git('rev-parse', 'HEAD')
+        # Fast-forward with merge: 1 + 3 + 1 side commit + 1 merge commit
+        self.assertEqual(kv._commit_count(self.repo.path, git_dir, head), 6)
+        self.assertEqual(self.commands, ['rev-list'])
+        self.assertEqual(cache.load_counts(git_dir)[-1], (head, 6))
+        # Rewind onto the side branch, which shares 2 commits with master
+        side = self.repo.git('rev-parse', 'side')
+        self.assertEqual(kv._commit_count(self.repo.path, git_dir, side), 3)
+        # Already known counts need no git at all
+        del self.commands[:]
+        self.assertEqual(kv._commit_count(self.repo.path, git_dir, head), 6)
+        self.assertEqual(self.commands, [])
+        # Fall back to a full count if the base commit disappeared
+        cache.store_count(git_dir, 'f' * 40, 100)
+        self.assertEqual(kv._commit_count(self.repo.path, git_dir, first), 1)
+
+    def test_not_a_repo(self):
+        self.assertEqual(kv.get_version_from_scm(self.repo.path + '/..'),
+                         (None, None))
+        self.assertEqual(self.commands, [])
+
+
+class TestMonorepo(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        for name in ('foo', 'bar'):
+            os.makedirs(os.path.join(self.repo.path, 'pkgs', name, name))
+            self.repo.commit('pkgs/%s/setup.py' % (name,))
+        self.repo.git('tag', 'foo-v1.0')
+        self.repo.commit('pkgs/foo/foo/__init__.py')
+        self.repo.commit('README')
+        self.repo.git('tag', 'bar-v2.3')
+        os.environ[kv.MONOREPO_ENV] = '1'
+        self.addCleanup(os.environ.pop, kv.MONOREPO_ENV)
+        self.addCleanup(kv.clear_cache)
+
+    def test_project_versions(self):
+        git_dir = kv.find_git_dir(self.repo.path)
+        foo = os.path.join(self.repo.path, 'pkgs', 'foo', 'foo')
+        bar = os.path.join(self.repo.path, 'pkgs', 'bar')
+        self.assertEqual(kv._monorepo_scope(foo, git_dir), 'pkgs/foo')
+        self.assertEqual(kv._monorepo_scope(self.repo.path, git_dir), '')
+        foo_commit = self.repo.git('rev-parse', '--short=7', 'HEAD~1')
+        self.assertEqual(kv.get_version(foo),
+                         '1.1.dev2+master.%s' % (foo_commit[:7],))
+        # Bar has not changed since its tag, which is on a later commit
+        self.assertEqual(kv.get_version(bar), '2.3')
+        # Changes elsewhere in the repo do not make bar dirty
+        self.repo.write('pkgs/foo/setup.py', 'modified\n')
+        kv.clear_cache()
+        self.assertEqual(kv.get_version(bar), '2.3')
+        self.assertTrue(kv.get_version(foo).endswith('.dirty'))
+        # The whole repo still gets the repo-wide version
+        self.assertTrue(kv.get_version(self.repo.path).startswith('0.1.dev4+'))
+
+    def test_shared_history_walk(self):
+        walks = []
+        original_iter_cmd = kv.iter_cmd
+
+        def recording_iter_cmd(path, *cmd):
+            walks.append(cmd)
+            return original_iter_cmd(path, *cmd)
+        kv.iter_cmd = recording_iter_cmd
+        self.addCleanup(setattr, kv, 'iter_cmd', original_iter_cmd)
+        for name in ('foo', 'bar', 'foo'):
+            kv.get_version(os.path.join(self.repo.path, 'pkgs', name))
+        self.assertEqual(len(walks), 1)
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write(self, filename, text):
+        filename = os.path.join(self.tempdir, filename)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(text)
+
+    def test_headers_only(self):
+        self.write('PKG-INFO', 'Metadata-Version: 1.1\nName: foo\n'
+                   'Version: 1.2.3\n\nVersion: 9.9\n' + 100000 * 'x')
+        self.assertEqual(kv.get_version_from_unpacked_sdist(self.tempdir),
+                         '1.2.3')
+        self.write('UNKNOWN/PKG-INFO', 'Name: foo\nVersion: UNKNOWN\n')
+        self.assertEqual(kv.get_version_from_unpacked_sdist(
+            os.path.join(self.tempdir, 'UNKNOWN')), None)
+
+    def test_installed_and_built_trees(self):
+        self.write('site/My_Pkg-2.0.dist-info/METADATA', 'Version: 2.0\n')
+        self.write('site/other-3.0.dist-info/METADATA', 'Version: 3.0\n')
+        self.write('site/my_pkg/__init__.py', '')
+        self.write('project/proj.egg-info/PKG-INFO', 'Version: 0.4.dev2\n')
+        self.write('project/proj/__init__.py', '')
+        self.assertEqual(kv.get_version(os.path.join(self.tempdir, 'site',
+                                                     'my_pkg')), '2.0')
+        for path in ('project', 'project/proj'):
+            self.assertEqual(kv._get_version_and_source(
+                os.path.join(self.tempdir, path)),
+                ('metadata', kv.Version.parse('0.4.dev2')))
+        # Unrelated distributions next door are ignored
+        self.assertEqual(kv.get_version_from_metadata(
+            os.path.join(self.tempdir, 'site')), None)
+
+    def test_ignored_inside_git(self):
+        repo = TempRepo()
+        self.addCleanup(repo.cleanup)
+        repo.commit()
+        self.write(os.path.join(repo.path, 'x.egg-info', 'PKG-INFO'),
+                   'Version: 5.0\n')
+        self.assertEqual(kv.get_version_from_metadata(repo.path), None)
+
+
+class TestTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.repo.git('tag', '1.0')
+        self.repo.commit()
+        self.addCleanup(kv.clear_cache)
+        self.addCleanup(os.environ.pop, kv.TIMEOUT_ENV, None)
+
+    def hang_git(self):
+        """Replace git by a command that hangs, like git on a stale mount."""
+        fake_git = os.path.join(self.repo.path, '.git', 'fake-bin', 'git')
+        os.makedirs(os.path.dirname(fake_git))
+        with open(fake_git, 'w') as f:
+            f.write('#!/bin/sh\nexec sleep 30\n')
+        os.chmod(fake_git, 0o755)
+        original_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(fake_git) + os.pathsep + original_path
+        self.addCleanup(os.environ.__setitem__, 'PATH', original_path)
+
+    def timed_source(self, timeout=None):
+        start = time.time()
+        source, version = kv._get_version_and_source(self.repo.path,
+                                                     timeout=timeout)
+        self.assertLess(time.time() - start, 5.0)
+        return source, str(version)
+
+    @unittest.skipUnless(os.name == 'posix', 'needs a shell script as git')
+    def test_fallbacks(self):
+        good_version = kv.get_version(self.repo.path)
+        # HEAD moves on, so the remembered version is stale
+        self.repo.commit()
+        self.hang_git()
+        self.assertEqual(self.timed_source(0.3), ('cache', good_version))
+        os.environ[kv.TIMEOUT_ENV] = '0.3'
+        os.environ[cache.NO_CACHE_ENV] = '1'
+        self.addCleanup(os.environ.pop, cache.NO_CACHE_ENV)
+        source, version = self.timed_source()
+        self.assertEqual(source, 'date')
+        self.assertTrue(version.startswith('0.0+unknown.git.'))
+        self.repo.write(kv.VERSION_FILE, '4.2\n')
+        self.assertEqual(self.timed_source(), ('file', '4.2'))
+
+    def test_generous_budget(self):
+        version = kv.get_version(self.repo.path)
+        kv.clear_cache()
+        self.assertEqual(kv.get_version(self.repo.path, timeout=60), version)
+        self.assertEqual(getattr(kv._budget, 'deadline', None), None)
+
+
+class TestTrace(unittest.TestCase):
+
+    def test_trace_hook(self):
+        repo = TempRepo()
+        self.addCleanup(repo.cleanup)
+        repo.commit()
+        events = []
+        trace.add_trace_hook(events.append)
+        self.addCleanup(trace.remove_trace_hook, events.append)
+        self.addCleanup(kv.clear_cache)
+        version = kv.get_version(repo.path)
+        steps = [(event['kind'], event['name']) for event in events]
+        self.assertEqual(steps[:3], [('stage', 'manifest'), ('stage', 'module'),
+                                     ('stage', 'unpacked_sdist')])
+        self.assertTrue(('command', 'log') in steps)
+        self.assertEqual(steps[-2:], [('stage', 'scm'), ('resolve', 'get_version')])
+        self.assertEqual(events[-1]['source'], 'scm')
+        self.assertEqual(events[-1]['version'], version)
+        self.assertTrue(all(event['duration'] >= 0 for event in events))
+        trace.remove_trace_hook(events.append)
+        del events[:]
+        kv.get_version(repo.path)
+        self.assertEqual(events, [])
+
+    def test_enable_logging_twice(self):
+        repo = TempRepo()
+        self.addCleanup(repo.cleanup)
+        repo.commit()
+        self.addCleanup(kv.clear_cache)
+        first, second = StringIO(), StringIO()
+        trace.enable_trace_logging(first)
+        trace.enable_trace_logging(second)
+        self.addCleanup(trace.logger.removeHandler, trace._handler)
+        self.addCleanup(trace.remove_trace_hook, trace.log_event)
+        kv.get_version(repo.path)
+        self.assertEqual(first.getvalue(), '')
+        lines = second.getvalue().splitlines()
+        self.assertEqual(len([line for line in lines if 'resolve' in line]), 1)
@@ -0,0 +1,62 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Tests for the background version watcher."""
+
+import time
+import unittest
+
+import katversion.version as kv
+from katversion.watch import VersionWatcher
+
+from repo_helpers import TempRepo
+
+
+class TestVersionWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = TempRepo()
+        self.addCleanup(self.repo.cleanup)
+        self.repo.commit()
+        self.repo.git('tag', '1.0')
+        self.addCleanup(kv.clear_cache)
+
+    def test_check(self):
+        watcher = VersionWatcher(self.repo.path)
+        changes = []
+        watcher.add_callback(lambda old, new: changes.append((str(old), str(new))))
+        self.assertEqual(str(watcher), '1.0')
+        self.assertEqual(watcher.build_info('test'),
+                         kv.build_info('test', self.repo.path))
+        self.assertFalse(watcher.check())
+        self.repo.commit()
+        self.assertTrue(watcher.check())
+        self.assertEqual(watcher.version, kv.get_version_object(self.repo.path))
+        self.assertEqual(changes, [('1.0', str(watcher.version))])
+        self.assertFalse(watcher.check())
+
+    def test_background_thread(self):
+        changes = []
+        with VersionWatcher(self.repo.path, interval=0.02) as watcher:
+            watcher.add_callback(lambda old, new: changes.append(new))
+            self.repo.git('tag', '1.1')
+            for n in range(250):
+                if changes:
+                    break
+                time.sleep(0.02)
+        self.assertEqual(changes, [kv.Version.parse('1.1')])
+        self.assertEqual(watcher.version, '1.1')
+        self.assertEqual(watcher._thread, None)
@@ -0,0 +1,160 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Instrumentation of version resolution via trace hooks and logging.
+
+A trace hook is a callable that receives one event dict per traced step.
+Every event has these keys:
+
+  - 'kind': 'resolve' (a complete :func:`get_version` call), 'stage' (one of
+    its version sources), 'command' (an external command such as git),
+    'cache' (a cache lookup) or 'fallback' (git ran out of time budget)
+  - 'name': name of the step, e.g. 'scm' for a stage or 'log' for git log
+  - 'duration': time taken by the step, in seconds
+
+Other keys depend on the step, like 'version', 'source', 'cmd' or 'hit',
+plus 'error' if the step raised an exception. Tracing is disabled (and
+practically free) while there are no hooks. Set the environment variable
+KATVERSION_TRACE=1 to log all events to stderr.
+
+"""
+
+import os
+import sys
+import time
+import logging
+
+
+TRACE_ENV = 'KATVERSION_TRACE'
+logger = logging.getLogger('katversion.trace')
+# Registered hooks (replaced rather than modified, to be thread-safe)
+_hooks = ()
+# Log handler installed by enable_trace_logging (if any)
+_handler = None
+
+
+def add_trace_hook(hook):
+    """Register callable `hook`, which will be called with each trace event."""
+    global _hooks
+    _hooks = _hooks + (hook,)
+
+
+def remove_trace_hook(hook):
+    """Unregister a trace hook added by :func:`add_trace_hook`."""
+    global _hooks
+    _hooks = tuple(h for h in _hooks if h != hook)
+
+
+def log_event(event):
+    """Trace hook that logs events to the 'katversion.trace' logger."""
+    details = ', '.join('%s=%r' % (key, event[key]) for key in sorted(event)
+                        if key not in ('kind', 'name', 'duration'))
+    logger.info('%s %s took %.1f ms%s', event['kind'], event['name'],
+                1000 * event['duration'], (': ' + details) if details else '')
+
+
+def enable_trace_logging(stream=None):
+    """Log all trace events to `stream` (stderr by default).
+
+    Calling this again replaces the stream instead of logging events twice.
+
+    """
+    global _handler
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter('katversion: %(message)s'))
+    if _handler is not None:
+        logger.removeHandler(_handler)
+    logger.addHandler(handler)
+    _handler = handler
+    logger.setLevel(logging.INFO)
+    if log_event not in _hooks:
+        add_trace_hook(log_event)
+
+
+def emit(event):
+    """Pass trace `event` to all registered hooks."""
+    for hook in _hooks:
+        try:
+            hook(event)
+        except Exception:
+            logger.exception('Trace hook %r failed', hook)
+
+
+class _Span(object):
+    """Context manager that times a step and emits its trace event."""
+
+    __slots__ = ('event', 'start')
+
+    def __init__(self, kind, name, details):
+        self.event = details
+        details['kind'] = kind
+        details['name'] = name
+
+    def __setitem__(self, key, value):
+        self.event[key] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.event['duration'] = time.time() - self.start
+        if exc_type is not None:
+            self.event['error'] = repr(exc_value)
+        emit(self.event)
+
+
+class _NullSpan(object):
+    """Stand-in for :class:`_Span` that does nothing while tracing is off."""
+
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(kind, name, **details):
+    """Context manager that traces a step, to which details can be added.
+
+    Use it like this::
+
+        with span('stage', 'scm', path=path) as s:
+            s['version'] = get_version_from_scm(path)
+
+    """
+    if not _hooks:
+        return _NULL_SPAN
+    return _Span(kind, name, details)
+
+
+def mark(kind, name, **details):
+    """Emit trace event for an instantaneous step (e.g. a cache hit)."""
+    if _hooks:
+        details.update(kind=kind, name=name, duration=0.0)
+        emit(details)
+
+
+if os.environ.get(TRACE_ENV, '').strip().lower() not in ('', '0', 'false'):
+    enable_trace_logging()
@@ -17,31 +17,167 @@
 """Module with functions taking care of proper Python package versioning."""
 
 import os
+import sys
 import time
 import re
+import ast
+import logging
+import tempfile
+import threading
+import importlib
+from collections import OrderedDict
 from subprocess import Popen, PIPE
 from email.parser import Parser
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
 
-import pkg_resources  # part of setuptools
+from . import cache, trace
+from .cache import clear_cache  # noqa: F401 (part of public API)
+from .gitreader import (GitReaderError, GitRepository, find_git_dir,
+                        find_work_tree)
+from .gitbatch import BatchRepository
+from .budget import GitTimeoutError, _budget, _TimeBudget, _time_left, _Watchdog
+from .budget import TIMEOUT_ENV, _timeout_from_env  # noqa: F401 (re-exported)
 
 
 VERSION_FILE = '___version___'
 NON_ALPHANUMERIC = re.compile('[^a-z0-9]')
+# Regular expression for PEP 440 versions (taken from the packaging package)
+PEP440_VERSION = re.compile(r"""
+    ^\s*v?
+    (?:
+        (?:(?P<epoch>[0-9]+)!)?                           # epoch
+        (?P<release>[0-9]+(?:\.[0-9]+)*)                  # release segment
+        (?P<pre>                                          # pre-release
+            [-_\.]?
+            (?P<pre_l>(a|b|c|rc|alpha|beta|pre|preview))
+            [-_\.]?
+            (?P<pre_n>[0-9]+)?
+        )?
+        (?P<post>                                         # post release
+            (?:-(?P<post_n1>[0-9]+))
+            |
+            (?:
+                [-_\.]?
+                (?P<post_l>post|rev|r)
+                [-_\.]?
+                (?P<post_n2>[0-9]+)?
+            )
+        )?
+        (?P<dev>                                          # dev release
+            [-_\.]?
+            (?P<dev_l>dev)
+            [-_\.]?
+            (?P<dev_n>[0-9]+)?
+        )?
+    )
+    (?:\+(?P<local>[a-z0-9]+(?:[-_\.][a-z0-9]+)*))?       # local version
+    \s*$
+""", re.VERBOSE | re.IGNORECASE)
+# Versions in katversion's own canonical formats (release, dev and unknown)
+KATVERSION_FORMAT = re.compile(r'^(\d+(?:\.\d+)*)(?:\.dev(\d+))?'
+                               r'(?:\+([a-z0-9]+(?:\.[a-z0-9]+)*))?$')
+LEADING_ZERO = re.compile(r'(?:^|[.+])0\d')
+_PRE_RELEASE_LABELS = {'a': 'a', 'alpha': 'a', 'b': 'b', 'beta': 'b',
+                       'c': 'rc', 'rc': 'rc', 'pre': 'rc', 'preview': 'rc'}
+# A valid version is sequence of dotted numbers optionally prefixed by 'v'
+VALID_VERSION = re.compile(r'^v?([\.\d]+)$', re.IGNORECASE)
+# Environment variable that selects how git repositories are queried:
+# 'subprocess' (run the git binary, the default), 'python' (read in-process)
+# or 'batch' (read objects via a long-running git cat-file process)
+GIT_BACKEND_ENV = 'KATVERSION_GIT_BACKEND'
+# Environment variable that selects how to check for modified files
+DIRTY_CHECK_ENV = 'KATVERSION_DIRTY_CHECK'
+# Environment variable with regular expression that selects version tags
+# instead of VALID_VERSION (the version numbers are in its first group)
+TAG_PATTERN_ENV = 'KATVERSION_TAG_PATTERN'
+# Environment variable that enables per-project versions inside a monorepo
+MONOREPO_ENV = 'KATVERSION_MONOREPO'
+# Files that mark the top-level directory of a project in a monorepo
+PROJECT_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml')
+# Module with build info that is generated inside packages at build time
+MANIFEST_MODULE = '_katversion_info'
+MANIFEST_FIELDS = ('version', 'version_info', 'commit', 'branch', 'dirty',
+                   'source', 'build_time')
+# Directories with metadata of built or installed distributions (and file)
+METADATA_DIRS = (('.dist-info', 'METADATA'), ('.egg-info', 'PKG-INFO'))
+logger = logging.getLogger(__name__)
+
+
+def _cmd_env():
+    """Environment for commands, which stops git from rewriting its index."""
+    env = dict(os.environ)
+    # Avoid index.lock contention and needless invalidation of our caches
+    env['GIT_OPTIONAL_LOCKS'] = '0'
+    return env
+
+
+def _cmd_name(cmd):
+    """Short name of command for tracing (e.g. 'log' for git log)."""
+    return cmd[1] if os.path.basename(cmd[0]) == 'git' and len(cmd) > 1 else cmd[0]
+
+
+def _lock_wait():
+    """Time to wait for another process computing the version, in seconds."""
+    deadline = getattr(_budget, 'deadline', None)
+    if deadline is None:
+        return cache.LOCK_WAIT
+    return max(0.0, min(cache.LOCK_WAIT, deadline - time.time()))
+
+
+def _start_cmd(path, cmd, **kwargs):
+    """Start `cmd` in `path`, returning the process and its watchdog."""
+    remaining = _time_left(cmd)
+    group = remaining is not None and os.name == 'posix' and \
+        sys.version_info >= (3, 2)
+    if group:
+        kwargs['start_new_session'] = True
+    proc = Popen(cmd, cwd=path, env=_cmd_env(), universal_newlines=True,
+                 **kwargs)
+    return proc, _Watchdog(proc, cmd, remaining, group)
 
 
 def run_cmd(path, *cmd):
-    proc = Popen(cmd, cwd=path, stdout=PIPE, stderr=PIPE,
-                 universal_newlines=True)
-    res, stderr = proc.communicate()
+    with trace.span('command', _cmd_name(cmd), cmd=cmd, path=path) as span:
+        proc, watchdog = _start_cmd(path, cmd, stdout=PIPE, stderr=PIPE)
+        try:
+            res, stderr = proc.communicate()
+        finally:
+            watchdog.stop()
+        watchdog.check(span)
     if stderr:
         raise RuntimeError('###\nCalled process gave error:\n%s\n###' % stderr)
     return res
 
 
+def iter_cmd(path, *cmd):
+    """Run command and iterate over its output lines as they are produced.
+
+    If the iteration is abandoned before the end (i.e. the generator is
+    closed), the command is killed so that it does no unnecessary work.
+
+    """
+    # Collect stderr in a file to avoid deadlock while reading stdout pipe
+    with trace.span('command', _cmd_name(cmd), cmd=cmd, path=path) as span, \
+            tempfile.TemporaryFile() as stderr_file:
+        proc, watchdog = _start_cmd(path, cmd, stdout=PIPE, stderr=stderr_file)
+        finished = False
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                yield line.rstrip('\n')
+            finished = True
+        finally:
+            if not finished and proc.poll() is None:
+                proc.kill()
+                span['killed'] = True
+            proc.stdout.close()
+            proc.wait()
+            watchdog.stop()
+        watchdog.check(span)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode('utf-8', 'replace')
+    if stderr:
+        raise RuntimeError('###\nCalled process gave error:\n%s\n###' % stderr)
+
+
 def is_git(path):
     """Return True if this is a git repo."""
     try:
@@ -61,6 +197,11 @@ def date_version(scm=None):
     return version
 
 
+def _clean_branch_name(branch_name):
+    """Scrub branch name to only contain letters, digits and periods."""
+    return re.sub(r"[^A-Za-z0-9]+", ".", branch_name.strip())
+
+
 def get_git_cleaned_branch_name(path):
     """Get the git branch name of the current HEAD in path. The branch name is
     scrubbed to conform to PEP-440.
@@ -78,54 +219,558 @@ def get_git_cleaned_branch_name(path):
     """
     # Get name of current branch (or 'HEAD' for a detached HEAD)
     branch_name = run_cmd(path, 'git', 'rev-parse', '--abbrev-ref', 'HEAD')
-    branch_name = re.sub(r"[^A-Za-z0-9]+", ".", branch_name.strip())
-    return branch_name
+    return _clean_branch_name(branch_name)
 
 
-def get_git_version(path):
-    """Get the GIT version."""
-    branch_name = get_git_cleaned_branch_name(path)
-    # Determine whether working copy is dirty (i.e. contains modified files)
-    mods = run_cmd(path, 'git', 'status', '--porcelain', '--untracked-files=no')
-    dirty = '.dirty' if mods else ''
-    # Get a list of all commits on branch, with corresponding branch/tag refs
-    # Each line looks something like: "d3e4d42 (HEAD, master, tag: v0.1)"
-    git_output = run_cmd(path, 'git', 'log', '--pretty="%h%d"')
-    commits = git_output.strip().replace('"', '').split('\n')
-    num_commits_since_branch = len(commits)
-    # Short hash of the latest commit
-    short_commit_name = commits[0].partition(' ')[0]
-    # A valid version is sequence of dotted numbers optionally prefixed by 'v'
-    valid_version = re.compile(r'^v?([\.\d]+)$')
-
-    def tagged_version(commit):
-        """First tag on commit that is valid version, as a list of numbers."""
-        refs = commit.partition(' ')[2]
-        for ref in refs.lstrip('(').rstrip(')').split(', '):
-            if ref.startswith('tag: '):
-                tag = ref[5:].lower()
-                found = valid_version.match(tag)
-                if found:
-                    return [int(v) for v in found.group(1).split('.') if v]
-        return []
-    # Walk back along branch and find first valid tagged version (or use 0.0)
-    for commit in commits:
-        version_numbers = tagged_version(commit)
-        if version_numbers:
-            break
+def _git_backend():
+    """Name of the selected git backend ('subprocess', 'python' or 'batch')."""
+    return os.environ.get(GIT_BACKEND_ENV, 'subprocess').strip().lower()
+
+
+def _tag_pattern():
+    """Regular expression selecting version tags, with the version in group 1.
+
+    This is `VALID_VERSION` unless overridden by the KATVERSION_TAG_PATTERN
+    environment variable. Tags are matched case-insensitively.
+
+    """
+    pattern = os.environ.get(TAG_PATTERN_ENV, '').strip()
+    return re.compile(pattern, re.IGNORECASE) if pattern else VALID_VERSION
+
+
+def _tag_version_numbers(tags, pattern=None):
+    """First tag in `tags` that is a valid version, as a list of numbers."""
+    pattern = pattern or _tag_pattern()
+    for tag in tags:
+        found = pattern.match(tag)
+        if found:
+            try:
+                version_numbers = [int(v) for v in found.group(1).split('.') if v]
+            except (ValueError, IndexError):
+                continue
+            if version_numbers:
+                return version_numbers
+    return []
+
+
+def _git_tags(path, git_dir):
+    """List of (tag name, commit oid) pairs of repo at `path` / `git_dir`."""
+    if git_dir:
+        try:
+            return list(GitRepository(git_dir).tags().items())
+        except (GitReaderError, IOError, OSError):
+            pass
+    # Use the peeled oid (%(*objectname)) for annotated tags
+    tags = []
+    refs = run_cmd(path, 'git', 'for-each-ref', '--format=%(objectname) '
+                   '%(*objectname) %(refname)', 'refs/tags')
+    for line in refs.splitlines():
+        oid, peeled, name = line.split(' ', 2)
+        tags.append((name[10:], peeled or oid))
+    return tags
+
+
+def _build_tag_index(tags, pattern):
+    """Map commit oid to version numbers of its first tag matching `pattern`.
+
+    Git decorates a commit with its tags in reverse alphabetical order, which
+    decides the version if a commit has more than one version tag.
+
+    """
+    index = {}
+    for name, oid in sorted(tags, reverse=True):
+        if oid not in index:
+            version_numbers = _tag_version_numbers([name], pattern)
+            if version_numbers:
+                index[oid] = version_numbers
+    return index
+
+
+def _watched_tag_files(git_dir):
+    try:
+        return cache.tag_files(GitRepository(git_dir))
+    except (GitReaderError, IOError, OSError):
+        return None
+
+
+def _tag_index(path, git_dir, pattern=None):
+    """Index of version tags of repo at `path`, mapping commit oid to version.
+
+    The index is built once from all tags and only rebuilt when the tags
+    change (if `git_dir` is known), so that looking up the version of each
+    commit in the history is cheap even if there are many tags. The tags
+    are selected by `pattern` (see :func:`_tag_pattern` for the default).
+
+    """
+    pattern = pattern or _tag_pattern()
+
+    def build():
+        return _build_tag_index(_git_tags(path, git_dir), pattern)
+    if not git_dir:
+        return build()
+    return cache.memoise(git_dir, build, name='tags:' + pattern.pattern,
+                         watched=_watched_tag_files)
+
+
+def run_cmd_status(path, *cmd):
+    """Run command, discard its output and return its exit status."""
+    with trace.span('command', _cmd_name(cmd), cmd=cmd, path=path) as span, \
+            open(os.devnull, 'w') as devnull:
+        proc, watchdog = _start_cmd(path, cmd, stdout=devnull, stderr=PIPE)
+        try:
+            _, stderr = proc.communicate()
+        finally:
+            watchdog.stop()
+        watchdog.check(span)
+        span['returncode'] = proc.returncode
+    if stderr:
+        raise RuntimeError('###\nCalled process gave error:\n%s\n###' % stderr)
+    return proc.returncode
+
+
+def _dirty_check_mode():
+    """Name of the selected dirty check mode (see :func:`_git_is_dirty`)."""
+    mode = os.environ.get(DIRTY_CHECK_ENV, 'git').strip().lower()
+    return 'none' if mode in ('none', 'skip', 'off') else mode
+
+
+def _git_is_dirty(path, git_dir=None, scope=''):
+    """Determine whether working copy is dirty (i.e. contains modified files).
+
+    If `scope` is given, only files in that subdirectory of the working tree
+    are considered.
+
+    The method is selected by the KATVERSION_DIRTY_CHECK environment variable:
+
+      - 'git' (default): ask git whether any tracked file differs from HEAD,
+        stopping at the first difference
+      - 'index': first compare the stat data cached in the git index with the
+        files in the working tree in-process, and only ask git if they differ
+      - 'status': list all modifications with `git status` (slowest)
+      - 'none': skip the check and assume the working copy is clean (useful
+        for CI builds from clean clones)
+
+    """
+    mode = _dirty_check_mode()
+    if mode == 'none':
+        return False
+    pathspec = (':(top)' + scope,) if scope else ()
+    if mode == 'status':
+        mods = run_cmd(path, 'git', 'status', '--porcelain',
+                       '--untracked-files=no', '--', *pathspec)
+        return bool(mods)
+    if mode == 'index' and git_dir is not None:
+        try:
+            work_tree = find_work_tree(path or os.getcwd())
+            if GitRepository(git_dir).worktree_matches_head(work_tree):
+                return False
+        except (GitReaderError, IOError, OSError):
+            pass
+    # Exit status is 1 if there are differences (including staged ones)
+    return run_cmd_status(path, 'git', 'diff', '--quiet', 'HEAD', '--',
+                          *pathspec) != 0
+
+
+def _format_git_version(info, dirty):
+    """Assemble version string from git history info and dirty flag."""
+    return str(Version.from_git_info(info, dirty))
+
+
+def _parse_head_line(line):
+    """Short hash and branch name (or None) from first line of git log."""
+    short_hash, _, refs = line[41:].partition(' ')
+    # HEAD is "HEAD -> branch", or simply "HEAD" if detached
+    for ref in refs.strip('()').split(', ') if refs else []:
+        if ref == 'HEAD' or ref.startswith('HEAD -> '):
+            return short_hash, ref[8:] or ref
+    return short_hash, None
+
+
+def _unambiguous_branch(git_dir, branch_name):
+    """Branch name from HEAD decoration as `git rev-parse --abbrev-ref` has it.
+
+    The decoration always shows the plain branch name, while git prefixes it
+    with "heads/" if a tag or other ref has the same name. Returns None if
+    this cannot be decided in-process.
+
+    """
+    if branch_name == 'HEAD':
+        return branch_name
+    if git_dir is None:
+        return None
+    try:
+        return GitRepository(git_dir).unambiguous_branch(branch_name)
+    except (GitReaderError, IOError, OSError):
+        return None
+
+
+def _count_plan(git_dir, head):
+    """Plan how to count the commits in the history of commit `head`.
+
+    If an earlier count is cached for a commit `base`, the number of commits
+    only reachable from `base` (left) and only from `head` (right) gives
+    count(head) = count(base) - left + right, which holds for any pair of
+    commits (fast-forwards, rewinds, rebases and merges alike) and costs git
+    a walk over the changed commits instead of the full history.
+
+    Returns
+    -------
+    count : int or None
+        Cached count of `head`, or count of `base` if a command is needed
+    cmd : tuple of string or None
+        Git command whose output completes the count (see
+        :func:`_finish_count`), or None if `count` is already final
+
+    """
+    base, count = _cached_count(git_dir, head)
+    if base == head:
+        return count, None
+    if base is not None:
+        return count, ('git', 'rev-list', '--left-right', '--count',
+                       '%s...%s' % (base, head))
+    return 0, ('git', 'rev-list', '--count', head)
+
+
+def _cached_count(git_dir, head):
+    """Cached commit `base` and its count, preferring `head` (or None, 0)."""
+    counts = cache.load_counts(git_dir) if git_dir else []
+    for oid, count in counts:
+        if oid == head:
+            return oid, count
+    return counts[-1] if counts else (None, 0)
+
+
+def _finish_count(count, output):
+    """Combine base `count` with output of command from :func:`_count_plan`."""
+    numbers = [int(v) for v in output.split()]
+    return count - numbers[0] + numbers[1] if len(numbers) == 2 else numbers[0]
+
+
+def _commit_count(path, git_dir, head):
+    """Number of commits in the history of commit `head`, using cache."""
+    count, cmd = _count_plan(git_dir, head)
+    if cmd is not None:
+        try:
+            count = _finish_count(count, run_cmd(path, *cmd))
+        except (RuntimeError, ValueError, IndexError):
+            # The base commit is gone (or the cache is bad), so count it all
+            if '--left-right' not in cmd:
+                raise
+            count = int(run_cmd(path, 'git', 'rev-list', '--count', head))
+        if git_dir:
+            cache.store_count(git_dir, head, count)
+    return count
+
+
+def _git_info_subprocess(path, git_dir=None):
+    """Get git history info of repo at `path` by running the git binary.
+
+    Returns
+    -------
+    info : dict
+        Cleaned branch name ('branch'), short hash of HEAD ('commit'), first
+        version tag found in history as list of ints ('tag'), whether this
+        tag is on HEAD itself ('tagged_head') and number of commits in
+        history ('num_commits')
+
+    """
+    tag_index = _tag_index(path, git_dir)
+    # Stream all commits on branch, with the refs of HEAD on the first line
+    # Each line looks something like: "d3e4d42... d3e4d42 (HEAD -> master)"
+    # This single git process provides everything except the dirty check and
+    # the commit count in case we stop early (it also serves as git probe)
+    commits = iter_cmd(path, 'git', 'log', '--pretty=%H %h%d')
+    branch_name = None
+    short_commit_name = ''
+    version_numbers = []
+    n = -1
+    try:
+        # Walk back along branch and find first valid tagged version (or 0.0)
+        for n, commit in enumerate(commits):
+            if n == 0:
+                head = commit[:40]
+                short_commit_name, branch_name = _parse_head_line(commit)
+            version_numbers = tag_index.get(commit[:40], [])
+            if version_numbers:
+                break
+    finally:
+        commits.close()
+    if version_numbers:
+        # Stopped early, so let git count the rest of the history
+        num_commits_since_branch = _commit_count(path, git_dir, head)
     else:
-        version_numbers = [0, 0]
-    # It is a release if current commit has a version tag (and dir is clean)
-    release = (commit == commits[0]) and not dirty
-    if not release:
-        # We are working towards the next (minor) release according to PEP 440
-        version_numbers[-1] += 1
-    version = '.'.join([str(v) for v in version_numbers])
-    if not release:
-        # Development version contains extra embellishments
-        version = ("%s.dev%d+%s.%s%s" % (version, num_commits_since_branch,
-                                         branch_name, short_commit_name, dirty))
-    return version
+        # The walk went through the entire history already
+        num_commits_since_branch = n + 1
+        if git_dir and n >= 0:
+            cache.store_count(git_dir, head, num_commits_since_branch)
+    if branch_name is not None:
+        branch_name = _unambiguous_branch(git_dir, branch_name)
+    if branch_name is None:
+        # HEAD decoration could be suppressed by git config
+        branch_name = get_git_cleaned_branch_name(path)
+    return {'branch': _clean_branch_name(branch_name),
+            'commit': short_commit_name, 'tag': list(version_numbers),
+            'tagged_head': bool(version_numbers) and n == 0,
+            'num_commits': num_commits_since_branch}
+
+
+def _git_info_in_process(git_dir, backend='python'):
+    """Get git history info by reading the repository files directly.
+
+    This returns the same info as :func:`_git_info_subprocess` without
+    running git, and raises :class:`GitReaderError` if the repository in
+    `git_dir` is beyond our simple reader. The 'batch' `backend` reads the
+    objects via a long-running git process instead, which is reused by
+    later lookups in the same repository.
+
+    """
+    if backend == 'batch':
+        repo = BatchRepository(git_dir)
+        watchdog = repo.session.watch()
+        try:
+            return _walk_repository(repo, git_dir)
+        finally:
+            watchdog.stop()
+            repo.session.release()
+    return _walk_repository(GitRepository(git_dir), git_dir)
+
+
+def _walk_repository(repo, git_dir):
+    """Get git history info from the :class:`GitRepository` `repo`."""
+    branch_name = _clean_branch_name(repo.branch_name())
+    _, head = repo.head()
+    tag_index = _tag_index(None, git_dir)
+    # Walk back along history and find first valid tagged version (or use 0.0)
+    version_numbers = []
+    tagged_commit = None
+    num_commits_since_branch = None
+    if tag_index:
+        n = -1
+        for n, commit in enumerate(repo.walk(head)):
+            if commit.oid in tag_index:
+                version_numbers = list(tag_index[commit.oid])
+                tagged_commit = commit.oid
+                break
+        else:
+            # The walk went through the entire history already
+            num_commits_since_branch = n + 1
+            cache.store_count(git_dir, head, num_commits_since_branch)
+    if num_commits_since_branch is None:
+        num_commits_since_branch = _commit_count_in_process(repo, git_dir, head)
+    return {'branch': branch_name, 'commit': repo.abbreviate(head),
+            'tag': version_numbers, 'tagged_head': tagged_commit == head,
+            'num_commits': num_commits_since_branch}
+
+
+def _commit_count_in_process(repo, git_dir, head):
+    """Like :func:`_commit_count` but counting via :class:`GitRepository`."""
+    base, count = _cached_count(git_dir, head)
+    if base == head:
+        return count
+    if base is not None:
+        try:
+            left, right = repo.left_right_count(base, head)
+        except GitReaderError:
+            # The base commit is gone, so count it all
+            base = None
+        else:
+            count = count - left + right
+    if base is None:
+        count = repo.count_commits(head)
+    cache.store_count(git_dir, head, count)
+    return count
+
+
+def _find_git_dir(path):
+    """Git directory of repo containing `path`, or None if not found in-process."""
+    try:
+        return find_git_dir(path or os.getcwd())
+    except GitReaderError:
+        return None
+
+
+def _cached_git_info(git_dir):
+    """Look up git history info in on-disk cache, returning (key, info)."""
+    # Determine cache key before querying repo, in case it changes meanwhile
+    key = cache.repo_state_key(git_dir) if git_dir else None
+    if key:
+        key.append(_tag_pattern().pattern)
+    info = cache.load(git_dir, key) if key else None
+    if key:
+        trace.mark('cache', 'disk', git_dir=git_dir, hit=info is not None)
+    return key, info
+
+
+def _git_info(path, git_dir, probe=False):
+    """Get git history info of repo at `path` via the selected backend.
+
+    The info is taken from the on-disk cache if the state of the repository
+    in `git_dir` (which may be None if unknown) has not changed since it was
+    stored there. If `probe` is True, return None if `path` turns out not to
+    be in a git repo instead of raising an exception.
+
+    """
+    key, info = _cached_git_info(git_dir)
+    if info is not None:
+        return info
+    backend = _git_backend()
+    if backend in ('python', 'batch') and git_dir:
+        try:
+            info = _git_info_in_process(git_dir, backend)
+        except GitReaderError:
+            pass
+    if info is None:
+        try:
+            info = _git_info_subprocess(path, git_dir)
+        except (OSError, RuntimeError):
+            # Only ask git whether this is a repo at all once the query failed
+            if probe and not is_git(path):
+                return None
+            raise
+    if key:
+        cache.store(git_dir, key, info)
+    return info
+
+
+def _monorepo_mode():
+    """True if per-project versions in a monorepo are enabled."""
+    return os.environ.get(MONOREPO_ENV, '').strip().lower() not in ('', '0',
+                                                                   'false')
+
+
+def _project_scope(path, work_tree):
+    """Project directory containing `path`, relative to `work_tree`.
+
+    The project directory is the nearest one at or above `path` with a
+    setup.py, setup.cfg or pyproject.toml file, below the top of the working
+    tree. It is returned with forward slashes, or as '' if there is none.
+
+    """
+    directory = os.path.abspath(path)
+    work_tree = os.path.abspath(work_tree)
+    while directory.startswith(work_tree + os.sep):
+        for filename in PROJECT_FILES:
+            if os.path.isfile(os.path.join(directory, filename)):
+                scope = os.path.relpath(directory, work_tree)
+                return scope.replace(os.sep, '/')
+        directory = os.path.dirname(directory)
+    return ''
+
+
+def _monorepo_scope(path, git_dir):
+    """Project scope of `path` in monorepo mode, or '' for the whole repo."""
+    if not git_dir or not _monorepo_mode():
+        return ''
+    try:
+        work_tree = find_work_tree(path or os.getcwd())
+    except GitReaderError:
+        return ''
+    return _project_scope(path or os.getcwd(), work_tree) if work_tree else ''
+
+
+def _project_tag_pattern(scope):
+    """Version tags of project in `scope` look like '<name>-v1.2' or '<name>-1.2'."""
+    name = scope.rsplit('/', 1)[-1]
+    return re.compile(r'^%s-v?(\d+(?:\.\d+)*)$' % (re.escape(name),),
+                      re.IGNORECASE)
+
+
+def _history_with_dirs(path, git_dir):
+    """Walk whole history once, noting the directories touched by each commit.
+
+    The walk is shared by all projects in the repository and remembered
+    until HEAD or the tags change.
+
+    Returns
+    -------
+    head_line : string
+        First line of git log (with HEAD oid, short hash and decoration)
+    history : list of (string, string, frozenset of string)
+        Oid, short hash and touched directories of each commit, in the same
+        order as `git log` (merge commits touch no directories)
+
+    """
+    def walk():
+        history = []
+        head_line = ''
+        oid = short_hash = None
+        dirs = set()
+        lines = iter_cmd(path, 'git', '-c', 'core.quotePath=false', 'log',
+                         '--name-only', '--format=%x00%H %h%d')
+        try:
+            for line in lines:
+                if line.startswith('\0'):
+                    if oid is not None:
+                        history.append((oid, short_hash, frozenset(dirs)))
+                    else:
+                        head_line = line[1:]
+                    oid, short_hash = line[1:41], line[42:].partition(' ')[0]
+                    dirs = set()
+                elif line:
+                    parts = line.split('/')[:-1]
+                    for n in range(1, len(parts) + 1):
+                        dirs.add('/'.join(parts[:n]))
+        finally:
+            lines.close()
+        if oid is not None:
+            history.append((oid, short_hash, frozenset(dirs)))
+        return head_line, history
+    return cache.memoise(git_dir, walk, name='history', watched=cache.ref_files)
+
+
+def _scoped_git_info(path, git_dir, scope):
+    """Get git history info of the project in subdirectory `scope` of repo.
+
+    The info has the same form as that of :func:`_git_info_subprocess`, but
+    the commits are limited to those touching the project directory and the
+    version tags to those with the project name as prefix (e.g. 'pkg-v1.2').
+    The short hash is that of the latest commit touching the project, and it
+    is a release if no commits touched the project since its version tag.
+
+    """
+    head_line, history = _history_with_dirs(path, git_dir)
+    tag_index = _tag_index(path, git_dir, _project_tag_pattern(scope))
+    short_commit_name, branch_name = _parse_head_line(head_line)
+    if branch_name is None:
+        branch_name = get_git_cleaned_branch_name(path)
+    version_numbers = []
+    tagged_head = False
+    project_commit = None
+    num_commits = 0
+    for oid, short_hash, dirs in history:
+        if not version_numbers and oid in tag_index:
+            version_numbers = list(tag_index[oid])
+            tagged_head = project_commit is None
+        if scope in dirs:
+            num_commits += 1
+            if project_commit is None:
+                project_commit = short_hash
+    return {'branch': _clean_branch_name(branch_name),
+            'commit': project_commit or short_commit_name,
+            'tag': version_numbers, 'tagged_head': tagged_head,
+            'num_commits': num_commits}
+
+
+def get_git_version(path):
+    """Get the GIT version.
+
+    The repository is queried via the git binary unless the environment
+    variable KATVERSION_GIT_BACKEND is set to 'python', in which case the
+    repository files are read in-process instead (falling back to git if the
+    repository is too exotic for the built-in reader), or to 'batch', which
+    walks the history in-process as well but reads the objects from a git
+    cat-file process that is kept running for later lookups. The history info is
+    cached inside the git directory, but the dirty check is always redone.
+
+    """
+    return str(_git_version(path))
+
+
+def _git_version(path):
+    """Get the GIT version as a :class:`Version` object."""
+    git_dir = _find_git_dir(path)
+    info = _git_info(path, git_dir)
+    return Version.from_git_info(info, _git_is_dirty(path, git_dir))
 
 
 def get_version_from_scm(path=None):
@@ -143,24 +788,212 @@ def get_version_from_scm(path=None):
     version : string
         The version string for this package
 
+    Notes
+    -----
+    The result is remembered for the rest of the process and reused as long
+    as HEAD, the current branch, the tags and the git index are unchanged.
+    Use :func:`clear_cache` to forget it, e.g. after editing tracked files.
+
+    """
+    scm, version = _version_from_scm(path)
+    return scm, None if version is None else str(version)
+
+
+def _version_from_scm(path=None):
+    """Like :func:`get_version_from_scm` but with a :class:`Version` object."""
+    try:
+        git_dir = find_git_dir(path or os.getcwd())
+    except GitReaderError:
+        git_dir = None
+    else:
+        if git_dir is None:
+            # There is no .git anywhere in or above path, so don't ask git
+            return None, None
+
+    # In monorepo mode, the version of the project containing path
+    scope = _monorepo_scope(path, git_dir)
+
+    def info_and_dirty():
+        if scope:
+            info = _scoped_git_info(path, git_dir, scope)
+        else:
+            info = _git_info(path, git_dir, probe=True)
+        if info is None:
+            return None
+        return info, _git_is_dirty(path, git_dir, scope)
+
+    def version_from_scm():
+        if git_dir is None:
+            result = info_and_dirty()
+        else:
+            # Only one of many processes starting together has to ask git
+            result = cache.single_flight(git_dir, info_and_dirty,
+                                         _memo_name(scope), _lock_wait())
+        if result is None:
+            return None, None
+        info, dirty = result
+        return 'git', Version.from_git_info(info, dirty)
+    if git_dir is None:
+        return version_from_scm()
+    # Reuse the result of an earlier call in this process if repo is unchanged
+    return cache.memoise(git_dir, version_from_scm, name=_memo_name(scope))
+
+
+def _memo_name(scope=''):
+    """Name under which the version of project `scope` is cached.
+
+    The name includes the settings that affect the version, so that a
+    change in the tag pattern or dirty check mode takes effect immediately.
+
     """
-    if is_git(path):
-        return 'git', get_git_version(path)
-    return None, None
+    return 'version:%s:%s:%s' % (scope, _tag_pattern().pattern,
+                                 _dirty_check_mode())
+
+
+def _installed_version(name):
+    """Version of installed distribution `name` from its metadata, or None."""
+    try:
+        from importlib import metadata
+    except ImportError:
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            metadata = None
+    if metadata is not None:
+        try:
+            return metadata.version(name)
+        except metadata.PackageNotFoundError:
+            return None
+    # Last resort for old Pythons: the slow pkg_resources (part of setuptools)
+    import pkg_resources
+    try:
+        return pkg_resources.get_distribution(name).version
+    except pkg_resources.DistributionNotFound:
+        return None
 
 
 def get_version_from_module(module):
-    """Use pkg_resources to get version of installed module by name."""
+    """Use package metadata to get version of installed module by name."""
     if module is not None:
         # Setup.py will not pass in a module, but creating __version__ from
         # __init__ will.
         module = str(module).split('.', 1)[0]
+        # If None, there you have it the module is not installed.
+        return _installed_version(module)
+
+
+def format_build_manifest(version, source, build_time=None):
+    """Contents of build manifest module for :class:`Version` `version`.
+
+    Parameters
+    ----------
+    version : :class:`Version` object
+        The package version, including git info if it came from git
+    source : string
+        Name of the source of the version, e.g. 'scm'
+    build_time : None or float, optional
+        Time of the build as a Unix timestamp (default is now)
+
+    Returns
+    -------
+    text : string
+        Python module that defines the variables in `MANIFEST_FIELDS`
+
+    """
+    build_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(build_time))
+    values = {'version': str(version),
+              'version_info': tuple(version.version_list[1:]),
+              'commit': version.commit, 'branch': version.branch,
+              'dirty': version.dirty, 'source': source,
+              'build_time': build_time}
+    lines = ['# Build info generated by katversion - do not edit\n']
+    lines += ['%s = %r\n' % (name, values[name]) for name in MANIFEST_FIELDS]
+    return ''.join(lines)
+
+
+def _read_build_manifest(filename):
+    """Read build manifest module as a dict without importing it."""
+    manifest = {}
+    with open(filename) as f:
+        for line in f:
+            name, sep, value = line.partition(' = ')
+            if sep and name in MANIFEST_FIELDS:
+                manifest[name] = ast.literal_eval(value.strip())
+    return manifest
+
+
+def _package_dir(package):
+    """Directory of top-level `package` on the module path, without importing it.
+
+    Returns None if `package` is not found or is not a directory (e.g. in a
+    zip file). An imported package is found where it was imported from.
+
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python 2
+        import imp
         try:
-            package = pkg_resources.get_distribution(module)
-            return package.version
-        except pkg_resources.DistributionNotFound:
-            # So there you have it the module is not installed.
-            pass
+            f, pathname, description = imp.find_module(package)
+        except ImportError:
+            return None
+        if f is not None:
+            f.close()
+        return pathname if description[2] == imp.PKG_DIRECTORY else None
+    try:
+        spec = find_spec(package)
+    except (ImportError, ValueError):
+        return None
+    locations = spec and spec.submodule_search_locations
+    return locations[0] if locations and os.path.isdir(locations[0]) else None
+
+
+def get_build_manifest(path=None, module=None):
+    """Get build info baked into an installed package, if available.
+
+    The build manifest is the `_katversion_info` module generated inside
+    the top-level package by the katversion build_py and sdist commands. It
+    is read from directory `path` (but only if that is not inside a git
+    working tree), or if there is no `path`, from the directory of the
+    installed package of `module`. The package code is not run, except if
+    the manifest has to be imported because the package is in a zip file.
+
+    Returns
+    -------
+    manifest : dict or None
+        Values of the variables in `MANIFEST_FIELDS`, or None if not found
+
+    """
+    if path is None and module is not None:
+        package = str(module).split('.', 1)[0]
+        path = _package_dir(package)
+        if path is None:
+            try:
+                info = importlib.import_module(package + '.' + MANIFEST_MODULE)
+            except ImportError:
+                return None
+            return dict((name, getattr(info, name, None))
+                        for name in MANIFEST_FIELDS)
+    if path is not None:
+        if os.path.isfile(path):
+            path = os.path.dirname(path)
+        filename = os.path.join(path, MANIFEST_MODULE + '.py')
+        if os.path.isfile(filename) and _find_git_dir(path) is None:
+            try:
+                return _read_build_manifest(filename)
+            except (IOError, OSError, ValueError, SyntaxError):
+                pass
+    return None
+
+
+def _version_from_manifest(manifest):
+    """Turn build manifest into :class:`Version` object."""
+    version = Version.parse(manifest['version'])
+    if manifest.get('commit') is not None:
+        version = version.with_git(manifest['branch'], manifest['commit'],
+                                   manifest['dirty'])
+    return version
 
 
 def _must_decode(value):
@@ -173,22 +1006,80 @@ def _must_decode(value):
     return value
 
 
-def get_version_from_unpacked_sdist(path):
-    """Assume path points to unpacked source distribution and get version."""
-    # This is a condensed version of the relevant code in pkginfo 1.4.1
+def _read_metadata_version(filename):
+    """Get Version header from metadata file, without reading its body."""
+    lines = []
     try:
-        with open(os.path.join(path, 'PKG-INFO')) as f:
-            data = f.read()
+        with open(filename, 'rb') as f:
+            # The headers end at the first blank line (long_description follows)
+            for line in f:
+                if not line.strip():
+                    break
+                lines.append(line)
     except IOError:
-        # Could not load path as an unpacked sdist as it had no PKG-INFO file
         return
-    fp = StringIO(_must_decode(data))
-    msg = Parser().parse(fp)
+    msg = Parser().parsestr(_must_decode(b''.join(lines)), headersonly=True)
     value = msg.get('Version')
     if value != 'UNKNOWN':
         return value
 
 
+def get_version_from_unpacked_sdist(path):
+    """Assume path points to unpacked source distribution and get version."""
+    # This is a condensed version of the relevant code in pkginfo 1.4.1
+    return _read_metadata_version(os.path.join(path, 'PKG-INFO'))
+
+
+def _dist_name(name):
+    """Normalised distribution name, as found in metadata directory names."""
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def _metadata_files(path):
+    """Metadata files in `path` or its parent that could describe `path`.
+
+    These are the ones of distributions named after `path` or, failing that,
+    the only one inside `path` itself (like a project with its egg-info).
+
+    """
+    name = _dist_name(os.path.basename(path))
+    matches, inside = [], []
+    for directory in (path, os.path.dirname(path)):
+        try:
+            entries = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            for suffix, filename in METADATA_DIRS:
+                if not entry.endswith(suffix):
+                    continue
+                metadata = os.path.join(directory, entry, filename)
+                if _dist_name(entry[:-len(suffix)].split('-')[0]) == name:
+                    matches.append(metadata)
+                elif directory == path:
+                    inside.append(metadata)
+    return matches or (inside if len(inside) == 1 else [])
+
+
+def get_version_from_metadata(path):
+    """Get version from metadata of a built or installed distribution.
+
+    This looks for `*.dist-info/METADATA` and `*.egg-info/PKG-INFO` files in
+    path and its parent, but only outside git repositories (where git knows
+    better than metadata that might be out of date).
+
+    """
+    try:
+        if find_git_dir(path) is not None:
+            return
+    except GitReaderError:
+        return
+    for filename in _metadata_files(path):
+        version = _read_metadata_version(filename)
+        if version:
+            return version
+
+
 def get_version_from_file(path):
     """Find the VERSION_FILE and return its contents.
 
@@ -211,25 +1102,382 @@ def get_version_from_file(path):
                 return version
 
 
+def _parse_pep440(version):
+    """Split a PEP 440 version string into its components (None if invalid).
+
+    Returns
+    -------
+    parts : dict or None
+        Dict with integer 'epoch', tuple of ints 'release', optional tuples
+        ('a' | 'b' | 'rc', int) 'pre', ('post', int) 'post' and ('dev', int)
+        'dev', and tuple of strings and ints 'local', or None if `version`
+        does not comply with PEP 440
+
+    """
+    match = PEP440_VERSION.match(version)
+    if not match:
+        return None
+    pre_label = match.group('pre_l')
+    post_number = match.group('post_n1') or match.group('post_n2')
+    local = match.group('local')
+    return {
+        'epoch': int(match.group('epoch') or 0),
+        'release': tuple(int(v) for v in match.group('release').split('.')),
+        'pre': ((_PRE_RELEASE_LABELS[pre_label.lower()],
+                 int(match.group('pre_n') or 0)) if pre_label else None),
+        'post': (('post', int(post_number or 0))
+                 if match.group('post') else None),
+        'dev': (('dev', int(match.group('dev_n') or 0))
+                if match.group('dev') else None),
+        'local': (tuple(int(part) if part.isdigit() else part.lower()
+                        for part in re.split(r'[-_\.]', local))
+                  if local else ()),
+    }
+
+
+def _format_pep440(parts):
+    """Turn components produced by :func:`_parse_pep440` into a string."""
+    version = '.'.join(str(v) for v in parts['release'])
+    if parts['epoch']:
+        version = '%d!%s' % (parts['epoch'], version)
+    if parts['pre']:
+        version += '%s%d' % parts['pre']
+    if parts['post']:
+        version += '.post%d' % parts['post'][1]
+    if parts['dev']:
+        version += '.dev%d' % parts['dev'][1]
+    if parts['local']:
+        version += '+' + '.'.join(str(part) for part in parts['local'])
+    return version
+
+
 def normalised(version):
     """Normalise a version string according to PEP 440, if possible."""
-    norm_version = pkg_resources.parse_version(version)
-    if not isinstance(norm_version, tuple):
-        # Let setuptools (>= 8) do the normalisation
-        return str(norm_version)
-    else:
-        # Homegrown normalisation for older setuptools (< 8)
-        public, sep, local = version.lower().partition('+')
-        # Remove leading 'v' from public version
-        if len(public) >= 2:
-            if public[0] == 'v' and public[1] in '0123456789':
-                public = public[1:]
-        # Turn all chars except alphanumerics into periods in local version
-        local = NON_ALPHANUMERIC.sub('.', local)
-        return public + sep + local
-
-
-def get_version(path=None, module=None):
+    parts = _parse_pep440(version)
+    if parts is not None:
+        return _format_pep440(parts)
+    # Do a best effort on a version string that does not comply with PEP 440
+    public, sep, local = version.lower().partition('+')
+    # Remove leading 'v' from public version
+    if len(public) >= 2:
+        if public[0] == 'v' and public[1] in '0123456789':
+            public = public[1:]
+    # Turn all chars except alphanumerics into periods in local version
+    local = NON_ALPHANUMERIC.sub('.', local)
+    return public + sep + local
+
+
+class Version(object):
+    """Immutable, hashable and comparable package version.
+
+    The version is kept as the components of a PEP 440 version, which are
+    compared like `pkg_resources.parse_version` (or `packaging`) does. A
+    version string that does not comply with PEP 440 is kept as is (after
+    a best-effort clean-up) and sorts before all compliant versions. The
+    string form and the version list are computed once and then cached.
+
+    Parameters
+    ----------
+    release : sequence of int
+        Release segment, e.g. (1, 2) for version 1.2
+    pre : None or tuple of ('a' | 'b' | 'rc', int), optional
+        Pre-release segment
+    post, dev : None or int, optional
+        Post-release and development release numbers
+    local : sequence of int or string, optional
+        Local version label, split into its parts
+    epoch : int, optional
+        Version epoch
+
+    """
+
+    __slots__ = ('epoch', 'release', 'pre', 'post', 'dev', 'local',
+                 '_legacy', '_str', '_key', '_list', '_git')
+
+    def __init__(self, release, pre=None, post=None, dev=None, local=(),
+                 epoch=0):
+        _set = object.__setattr__
+        _set(self, 'epoch', int(epoch))
+        _set(self, 'release', tuple(map(int, release)))
+        _set(self, 'pre', tuple(pre) if pre else None)
+        _set(self, 'post', post)
+        _set(self, 'dev', dev)
+        _set(self, 'local', tuple(local))
+        _set(self, '_legacy', None)
+        _set(self, '_str', None)
+        _set(self, '_key', None)
+        _set(self, '_list', None)
+        _set(self, '_git', (None, None, None))
+
+    @classmethod
+    def parse(cls, version):
+        """Turn version string into :class:`Version`, normalising it."""
+        parts = _parse_pep440(version)
+        if parts is None:
+            obj = cls(())
+            object.__setattr__(obj, '_legacy', normalised(version))
+            return obj
+        return cls(parts['release'], parts['pre'],
+                   parts['post'] and parts['post'][1],
+                   parts['dev'] and parts['dev'][1], parts['local'],
+                   parts['epoch'])
+
+    @classmethod
+    def from_git_info(cls, info, dirty):
+        """Build version from git history `info` dict and `dirty` flag."""
+        version_numbers = list(info['tag']) or [0, 0]
+        # It is a release if current commit has a version tag (and dir is clean)
+        if info['tagged_head'] and not dirty:
+            version = cls(version_numbers)
+        else:
+            # We are working towards the next (minor) release as per PEP 440
+            version_numbers[-1] += 1
+            # Development version contains extra embellishments
+            local = [info['branch'], info['commit']] + (['dirty'] if dirty
+                                                        else [])
+            local = [part.lower() for part in '.'.join(local).split('.')]
+            if all(part.isalnum() for part in local):
+                local = [int(part) if part.isdigit() else part
+                         for part in local]
+                version = cls(version_numbers, dev=info['num_commits'],
+                              local=local)
+            else:
+                # Unusual branch names get the full normalisation treatment
+                version = cls.parse('%s.dev%d+%s' % (
+                    '.'.join(str(v) for v in version_numbers),
+                    info['num_commits'], '.'.join(local)))
+        return version.with_git(info['branch'], info['commit'], dirty)
+
+    def with_git(self, branch, commit, dirty):
+        """Copy of version that also records the git state it came from."""
+        version = Version(self.release, self.pre, self.post, self.dev,
+                          self.local, self.epoch)
+        object.__setattr__(version, '_legacy', self._legacy)
+        object.__setattr__(version, '_git', (branch, commit, dirty))
+        return version
+
+    @property
+    def branch(self):
+        """Cleaned git branch name, or None if not from git."""
+        return self._git[0]
+
+    @property
+    def commit(self):
+        """Short git commit hash, or None if not from git."""
+        return self._git[1]
+
+    @property
+    def dirty(self):
+        """True if git working copy was modified, or None if not from git."""
+        return self._git[2]
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Version objects are immutable')
+
+    def __reduce__(self):
+        # Pickle and copy via __init__ and __setstate__ as attributes are frozen
+        return (Version, (self.release, self.pre, self.post, self.dev,
+                          self.local, self.epoch), (self._legacy, self._git))
+
+    def __setstate__(self, state):
+        object.__setattr__(self, '_legacy', state[0])
+        object.__setattr__(self, '_git', tuple(state[1]))
+
+    def __str__(self):
+        if self._str is None:
+            if self._legacy is not None:
+                version = self._legacy
+            else:
+                version = _format_pep440({
+                    'epoch': self.epoch, 'release': self.release,
+                    'pre': self.pre,
+                    'post': None if self.post is None else ('post', self.post),
+                    'dev': None if self.dev is None else ('dev', self.dev),
+                    'local': self.local})
+            object.__setattr__(self, '_str', version)
+        return self._str
+
+    def __repr__(self):
+        return 'Version(%r)' % (str(self),)
+
+    @property
+    def sort_key(self):
+        """Tuple that orders versions according to PEP 440."""
+        if self._key is None:
+            if self._legacy is not None:
+                key = (-1, self._legacy)
+            else:
+                release = list(self.release)
+                while len(release) > 1 and release[-1] == 0:
+                    release.pop()
+                # A dev release of a final release sorts before its pre-releases
+                if self.pre is not None:
+                    pre = (1,) + self.pre
+                else:
+                    pre = (0,) if self.dev is not None and self.post is None \
+                        else (2,)
+                post = (0,) if self.post is None else (1, self.post)
+                dev = (1,) if self.dev is None else (0, self.dev)
+                local = tuple((1, part, '') if isinstance(part, int)
+                              else (0, 0, part) for part in self.local)
+                key = (0, self.epoch, tuple(release), pre, post, dev, local)
+            object.__setattr__(self, '_key', key)
+        return self._key
+
+    @property
+    def version_list(self):
+        """Version as list of [None, major, minor, patch] (see `build_info`)."""
+        if self._list is None:
+            object.__setattr__(self, '_list', _version_list(str(self)))
+        return list(self._list)
+
+    @property
+    def is_release(self):
+        """True if this is a final release without dev or local segments."""
+        return (self._legacy is None and self.dev is None and
+                self.pre is None and not self.local)
+
+    def _compare(self, other, method):
+        if not isinstance(other, Version):
+            # Compare with version strings too
+            if not hasattr(other, 'lower'):
+                return NotImplemented
+            other = Version.parse(other)
+        return method(self.sort_key, other.sort_key)
+
+    def __eq__(self, other):
+        return self._compare(other, lambda a, b: a == b)
+
+    def __ne__(self, other):
+        return self._compare(other, lambda a, b: a != b)
+
+    def __lt__(self, other):
+        return self._compare(other, lambda a, b: a < b)
+
+    def __le__(self, other):
+        return self._compare(other, lambda a, b: a <= b)
+
+    def __gt__(self, other):
+        return self._compare(other, lambda a, b: a > b)
+
+    def __ge__(self, other):
+        return self._compare(other, lambda a, b: a >= b)
+
+    def __hash__(self):
+        return hash(self.sort_key)
+
+
+class _LRUCache(object):
+    """Thread-safe mapping that forgets the least recently used items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# Parsed versions of recently seen version strings
+_parsed_versions = _LRUCache(65536)
+
+
+def _fast_parse(version):
+    """Parse version string in one of katversion's formats (None otherwise).
+
+    This handles releases like '1.2', development versions like
+    '1.3.dev34+branch.fa973da' and unknown versions like
+    '0.0+unknown.git.201402031023' with a single regex match.
+
+    """
+    match = KATVERSION_FORMAT.match(version)
+    if not match:
+        return None
+    release, dev, local = match.groups()
+    # Digit-only local parts are numbers (dropping leading zeros, as in PEP 440)
+    local = [int(part) if part.isdigit() else part
+             for part in local.split('.')] if local else ()
+    parsed = Version(release.split('.'), dev=dev and int(dev), local=local)
+    if not LEADING_ZERO.search(version):
+        # The string is already in canonical form
+        object.__setattr__(parsed, '_str', version)
+    return parsed
+
+
+def parse_version(version):
+    """Turn version string into :class:`Version`, reusing recent results.
+
+    Strings in katversion's own formats take a fast path, while all other
+    strings are parsed according to PEP 440 (see :meth:`Version.parse`).
+
+    """
+    parsed = _parsed_versions.get(version)
+    if parsed is None:
+        parsed = _fast_parse(version) or Version.parse(version)
+        _parsed_versions.put(version, parsed)
+    return parsed
+
+
+def normalise_many(versions):
+    """Normalise many version strings (see :func:`normalised`).
+
+    Parameters
+    ----------
+    versions : iterable of string
+        Version strings, typically produced by katversion
+
+    Returns
+    -------
+    normalised_versions : list of string
+        Normalised version strings, in the same order
+
+    """
+    canonical = KATVERSION_FORMAT.match
+    leading_zero = LEADING_ZERO.search
+    # Strings in katversion's own canonical form are returned as is
+    return [version if canonical(version) and not leading_zero(version)
+            else str(parse_version(version)) for version in versions]
+
+
+def sort_versions(versions, reverse=False):
+    """Sort version strings according to PEP 440.
+
+    Parameters
+    ----------
+    versions : iterable of string
+        Version strings, typically produced by katversion
+    reverse : bool, optional
+        True to put the latest version first
+
+    Returns
+    -------
+    sorted_versions : list of string
+        The original version strings in version order
+
+    """
+    return sorted(versions, key=lambda version: parse_version(version).sort_key,
+                  reverse=reverse)
+
+
+def get_version(path=None, module=None, timeout=None):
     """Return the version string.
 
     This function ensures that the version string complies with PEP 440.
@@ -265,6 +1513,11 @@ def get_version(path=None, module=None):
     module : None or string, optional
         Get version via module name (e.g. __name__ variable), which takes
         precedence over path if provided (ignore otherwise)
+    timeout : None or float, optional
+        Time budget for git commands in seconds (default is the value of the
+        KATVERSION_TIMEOUT environment variable, or no limit). Commands still
+        running when it runs out are killed and the version comes from the
+        version file, the last cached git version or the date instead.
 
     Returns
     -------
@@ -272,12 +1525,39 @@ def get_version(path=None, module=None):
         A string representation of the package version
 
     """
-    # Check the module option first.
-    version = get_version_from_module(module)
-    if version:
-        return normalised(version)
+    return str(get_version_object(path, module, timeout))
+
+
+def get_version_object(path=None, module=None, timeout=None):
+    """Return the version as a :class:`Version` object.
+
+    This is found in the same way as :func:`get_version`, but the result
+    can be compared to other versions (or version strings) directly.
+
+    """
+    return _get_version_and_source(path, module, timeout)[1]
+
 
-    # Turn path into a valid directory (default is current directory)
+def _get_version_and_source(path=None, module=None, timeout=None):
+    """Return the name of the version source and the version object, traced."""
+    with trace.span('resolve', 'get_version', path=path, module=module) as span, \
+            _TimeBudget(timeout):
+        source, version = _resolve_version(path, module)
+        span['source'] = source
+        span['version'] = str(version)
+    return source, version
+
+
+def _version_stage(name, get_version_from_source, arg):
+    """Get version from a single source, tracing how long it took."""
+    with trace.span('stage', name) as span:
+        version = get_version_from_source(arg)
+        span['version'] = version
+    return version
+
+
+def _source_dir(path):
+    """Turn path into a valid directory (default is current directory)."""
     if path is None:
         path = os.getcwd()
     path = os.path.abspath(path)
@@ -285,24 +1565,184 @@ def get_version(path=None, module=None):
         path = os.path.dirname(path)
     if not os.path.isdir(path):
         raise ValueError('No such package source directory: %r' % (path,))
+    return path
+
+
+def _resolve_version(path=None, module=None):
+    """Return the :class:`Version` and the name of the source that produced it."""
+    # Check for build info baked into an installed package first.
+    with trace.span('stage', 'manifest') as span:
+        manifest = get_build_manifest(path, module)
+        span['version'] = manifest and manifest['version']
+    if manifest:
+        return 'manifest', _version_from_manifest(manifest)
+
+    # Check the module option next.
+    version = _version_stage('module', get_version_from_module, module)
+    if version:
+        return 'module', Version.parse(version)
+
+    path = _source_dir(path)
 
     # Check for an sdist in the process of being installed by pip.
-    version = get_version_from_unpacked_sdist(path)
+    version = _version_stage('unpacked_sdist',
+                             get_version_from_unpacked_sdist, path)
     if version:
-        return normalised(version)
+        return 'unpacked_sdist', Version.parse(version)
 
-    # Check the SCM.
-    scm, version = get_version_from_scm(path)
+    # Check for metadata of a built or installed package outside git.
+    version = _version_stage('metadata', get_version_from_metadata, path)
     if version:
-        return normalised(version)
+        return 'metadata', Version.parse(version)
+
+    # Check the SCM (which produces a Version object directly).
+    try:
+        scm, version = _version_stage('scm', _version_from_scm, path)
+    except GitTimeoutError as err:
+        return _fallback_version(path, err)
+    if version is not None:
+        return 'scm', version
 
     # Check if there is a katversion file in the given path.
-    version = get_version_from_file(path)
+    version = _version_stage('file', get_version_from_file, path)
     if version:
-        return normalised(version)
+        return 'file', Version.parse(version)
 
     # None of the above got a version so we will make one up based on the date.
-    return normalised(date_version(scm))
+    return 'date', Version.parse(date_version(scm))
+
+
+def _stale_version(path):
+    """Last version of git repo at `path` remembered in the caches, if any.
+
+    The repository may have changed since, but this beats making one up.
+
+    """
+    git_dir = _find_git_dir(path)
+    if git_dir is None:
+        return None
+    scope = _monorepo_scope(path, git_dir)
+    result = cache.memo_peek(git_dir, _memo_name(scope))
+    if result is not None:
+        return result[1]
+    info = None if scope else cache.load_last(git_dir)
+    # The on-disk cache does not know whether the working tree was dirty
+    return None if info is None else Version.from_git_info(info, False)
+
+
+def _fallback_version(path, reason):
+    """Get version without git after the time budget ran out on `reason`."""
+    version = _version_stage('file', get_version_from_file, path)
+    if version:
+        source, version = 'file', Version.parse(version)
+    else:
+        version = _stale_version(path)
+        source = 'cache'
+        if version is None:
+            source, version = 'date', Version.parse(date_version('git'))
+    logger.warning('Using version %s from %s instead of git: %s',
+                   version, source, reason)
+    trace.mark('fallback', source, path=path, reason=str(reason),
+               version=str(version))
+    return source, version
+
+
+def iter_versions(paths, max_workers=None):
+    """Resolve versions of many paths concurrently, yielding each when done.
+
+    The lookups run on a pool of threads, which works well because most of
+    the time is spent waiting for git subprocesses.
+
+    Parameters
+    ----------
+    paths : iterable of string
+        Paths to pass to :func:`get_version`
+    max_workers : None or int, optional
+        Maximum number of threads (default is decided by thread pool)
+
+    Yields
+    ------
+    path : string
+        One of the input paths, in order of completion
+    version : string or Exception
+        The version string of `path`, or the exception raised trying to get it
+
+    """
+    def resolve(path):
+        try:
+            return path, get_version(path)
+        except Exception as err:
+            return path, err
+    try:
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+    except ImportError:
+        # No thread pool on Python 2 without the futures backport
+        for path in paths:
+            yield resolve(path)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(resolve, path) for path in paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def get_versions(paths, max_workers=None):
+    """Resolve versions of many paths concurrently.
+
+    Parameters
+    ----------
+    paths : iterable of string
+        Paths to pass to :func:`get_version`
+    max_workers : None or int, optional
+        Maximum number of threads (default is decided by thread pool)
+
+    Returns
+    -------
+    versions : dict
+        Mapping from path to its version string, or to the exception raised
+        while trying to get the version
+
+    """
+    return dict(iter_versions(paths, max_workers))
+
+
+def install_lazy_version(namespace, path=None, module=None):
+    """Make `__version__` of a package a lazily computed module attribute.
+
+    This installs a module-level `__getattr__` function (see PEP 562) in the
+    package namespace, which only computes the version when `__version__` is
+    first accessed and then stores it as an ordinary attribute. Importing
+    the package therefore does not have to wait for git. On Python < 3.7
+    the version is computed immediately instead.
+
+    Parameters
+    ----------
+    namespace : dict
+        Global namespace of package's __init__.py, i.e. `globals()`
+    path : None or string, optional
+        Path used to find the version (default is the package directory)
+    module : None or string, optional
+        Module name used to find the version (see :func:`get_version`)
+
+    """
+    if path is None:
+        package_path = namespace.get('__path__')
+        path = (package_path[0] if package_path
+                else os.path.dirname(namespace['__file__']))
+    if sys.version_info < (3, 7):
+        namespace['__version__'] = get_version(path, module)
+        return
+    existing_getattr = namespace.get('__getattr__')
+
+    def __getattr__(name):
+        if name == '__version__':
+            version = namespace['__version__'] = get_version(path, module)
+            return version
+        if existing_getattr is not None:
+            return existing_getattr(name)
+        raise AttributeError('module %r has no attribute %r'
+                             % (namespace.get('__name__'), name))
+    namespace['__getattr__'] = __getattr__
 
 
 def _sane_version_list(version):
@@ -344,19 +1784,13 @@ def _sane_version_list(version):
     return version
 
 
-def get_version_list(path=None, module=None):
-    """Return the version information as a tuple.
-
-    This uses get_version and breaks the string up. Would make more sense if
-    the version was a tuple throughout katversion.
-
-    """
+def _version_list(version):
+    """Break up version string into [None, major, minor, patch] list."""
     major = 0
     minor = 0
     patch = ''  # PEP440 calls this prerelease, postrelease or devrelease
-    ver = get_version(path, module)
-    if ver is not None:
-        ver_segments = _sane_version_list(ver.split(".", 2))
+    if version is not None:
+        ver_segments = _sane_version_list(version.split(".", 2))
         major = ver_segments[0]
         minor = ver_segments[1]
         patch = ".".join(ver_segments[2:])  # Rejoin the .
@@ -365,8 +1799,22 @@ def get_version_list(path=None, module=None):
     return [None, major, minor, patch]
 
 
-def build_info(name, path=None, module=None):
+def get_version_list(path=None, module=None, timeout=None):
+    """Return the version information as a list.
+
+    This is a view of the :class:`Version` object, which breaks up its
+    string form only once, or of the build manifest of installed packages.
+
+    """
+    manifest = get_build_manifest(path, module)
+    if manifest:
+        # Installed packages have this list baked in
+        return [None] + list(manifest['version_info'])
+    return get_version_object(path, module, timeout).version_list
+
+
+def build_info(name, path=None, module=None, timeout=None):
     """Return the build info tuple."""
-    verlist = get_version_list(path, module)
+    verlist = get_version_list(path, module, timeout)
     verlist[0] = name
     return tuple(verlist)
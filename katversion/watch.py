@@ -0,0 +1,162 @@
+################################################################################
+# Copyright (c) 2014-2020, National Research Foundation (Square Kilometre Array)
+#
+# Licensed under the BSD 3-Clause License (the "License"); you may not use
+# this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#   https://opensource.org/licenses/BSD-3-Clause
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+################################################################################
+
+"""Keep the version of a long-running process current as its repo changes.
+
+A :class:`VersionWatcher` polls the stat data of the files in the git
+directory that change when the version could change (HEAD, the branch and
+tag refs, packed-refs and the index). Only when these change does it run
+git again, so checking costs a handful of stat() calls per interval and
+reading the version costs nothing at all.
+
+"""
+
+import logging
+import threading
+
+from . import cache
+from .version import _find_git_dir, _get_version_and_source, _source_dir
+
+
+logger = logging.getLogger(__name__)
+
+
+class VersionWatcher(object):
+    """Version of a package that is updated in the background when it changes.
+
+    Parameters
+    ----------
+    path, module : None or string, optional
+        See :func:`katversion.get_version`
+    interval : float, optional
+        Time between checks of the git repository, in seconds
+    timeout : None or float, optional
+        Time budget of each version lookup (see :func:`katversion.get_version`)
+
+    Notes
+    -----
+    The watcher does nothing until :meth:`start` is called (or it is used as
+    a context manager), apart from getting the initial version. Use it like
+    this in a server::
+
+        watcher = VersionWatcher(__path__[0]).start()
+        watcher.add_callback(lambda old, new: logger.info('Now at %s', new))
+        ...
+        reply = watcher.build_info('mypackage')
+
+    """
+
+    def __init__(self, path=None, module=None, interval=2.0, timeout=None):
+        self.path = path
+        self.module = module
+        self.interval = interval
+        self.timeout = timeout
+        self.git_dir = _find_git_dir(_source_dir(path)) if module is None else None
+        self._callbacks = []
+        self._stopped = threading.Event()
+        self._thread = None
+        self._signature = self._repo_signature()
+        self.source, self._version = _get_version_and_source(path, module,
+                                                             timeout)
+
+    @property
+    def version(self):
+        """The current version, as a :class:`katversion.Version` object."""
+        return self._version
+
+    def __str__(self):
+        return str(self._version)
+
+    def build_info(self, name):
+        """The current build info tuple (see :func:`katversion.build_info`)."""
+        verlist = self._version.version_list
+        verlist[0] = name
+        return tuple(verlist)
+
+    def add_callback(self, callback):
+        """Call `callback(old_version, new_version)` whenever the version changes.
+
+        Callbacks run on the watcher thread.
+
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Stop calling `callback` added via :meth:`add_callback`."""
+        self._callbacks.remove(callback)
+
+    def _repo_signature(self):
+        if self.git_dir is None:
+            return None
+        files = cache._watched_files(self.git_dir)
+        return None if files is None else (files, cache._stat_signature(files))
+
+    def check(self):
+        """Check the repository once and update the version if it changed.
+
+        Returns
+        -------
+        changed : bool
+            True if the version changed
+
+        """
+        signature = self._repo_signature()
+        if signature == self._signature:
+            return False
+        try:
+            source, version = _get_version_and_source(self.path, self.module,
+                                                      self.timeout)
+        except Exception:
+            # Keep the old version and try again at the next check
+            logger.exception('Could not update version of %s', self.path)
+            return False
+        self._signature = signature
+        old_version, self.source, self._version = self._version, source, version
+        if version == old_version and version.commit == old_version.commit:
+            return False
+        for callback in list(self._callbacks):
+            try:
+                callback(old_version, version)
+            except Exception:
+                logger.exception('Version change callback %r failed', callback)
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """Start checking for changes in a daemon thread, returning self."""
+        if self.git_dir is not None and self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='katversion-watcher')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop checking for changes and wait for the watcher thread to end."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
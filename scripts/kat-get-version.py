@@ -19,22 +19,61 @@
 """Script to get the current version string of a Python package."""
 
 import os
+import sys
 import argparse
 
 from katversion import get_version
+from katversion.version import iter_versions
+from katversion.gitfilter import filter_process
+from katversion.trace import enable_trace_logging
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('-p', '--path', dest='path', action='store',
+    parser.add_argument('-p', '--path', dest='paths', action='append',
                         help='Path of SCM checkout. If not given the'
-                             ' current directory is used.')
+                             ' current directory is used. Repeat this to get'
+                             ' the versions of several checkouts at once.')
+    parser.add_argument('--stdin', action='store_true',
+                        help='Read additional checkout paths from stdin,'
+                             ' one per line')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of checkouts to query concurrently')
+    parser.add_argument('--filter-process', action='store_true',
+                        help='Act as a long-running git filter process that'
+                             ' smudges files with the version (see'
+                             ' filter.<driver>.process in gitattributes)')
+    parser.add_argument('--trace', action='store_true',
+                        help='Log the resolution stages, git commands and'
+                             ' their durations to stderr')
     args = parser.parse_args()
 
-    if args.path:
-        path = args.path
-    else:
+    if args.trace:
+        enable_trace_logging()
+    if args.filter_process:
+        path = args.paths[0] if args.paths else os.getcwd()
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        filter_process(lambda: get_version(path), stdin, stdout)
+        sys.exit(0)
+
+    paths = args.paths or []
+    if args.stdin:
+        paths.extend(line.strip() for line in sys.stdin if line.strip())
+    if not args.stdin and len(paths) <= 1:
         # If path was not given us the current working directory. This is the
         # way git smudge uses this file.
-        path = os.getcwd()
-    print(get_version(path))
+        path = paths[0] if paths else os.getcwd()
+        print(get_version(path))
+        sys.exit(0)
+    # Many paths: print "path<TAB>version" for each as soon as it is known
+    failed = False
+    for path, version in iter_versions(paths, args.jobs):
+        if isinstance(version, Exception):
+            sys.stderr.write('%s\t%s: %s\n' % (path, type(version).__name__,
+                                                version))
+            failed = True
+        else:
+            sys.stdout.write('%s\t%s\n' % (path, version))
+            sys.stdout.flush()
+    sys.exit(1 if failed else 0)